@@ -0,0 +1,36 @@
+"""account balance change
+
+Revision ID: 0b6e93d4a7c5
+Revises: f4b8c2a91d07
+Create Date: 2026-10-19 09:12:41.507326
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0b6e93d4a7c5'
+down_revision = 'f4b8c2a91d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('data_account_balance_change',
+    sa.Column('account_id', sa.String(length=64), nullable=False),
+    sa.PrimaryKeyConstraint('account_id')
+    )
+    # Balances were refreshed up to a block number before, which is replaced by the change markers; accounts with
+    # snapshots above that block are marked so the next run still applies them
+    op.execute("""
+        INSERT INTO data_account_balance_change (account_id)
+        SELECT DISTINCT account_id FROM data_account_info_snapshot
+        WHERE block_id > COALESCE(
+            (SELECT CAST(value AS SIGNED) FROM harvester_status WHERE `key` = 'BALANCE_REFRESH_HEAD'), -1
+        )
+    """)
+    op.execute("DELETE FROM harvester_status WHERE `key` = 'BALANCE_REFRESH_HEAD'")
+
+
+def downgrade():
+    op.drop_table('data_account_balance_change')
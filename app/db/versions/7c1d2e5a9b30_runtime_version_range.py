@@ -0,0 +1,30 @@
+"""runtime version range
+
+Revision ID: 7c1d2e5a9b30
+Revises: e5bd0b0f689b
+Create Date: 2026-10-18 10:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '7c1d2e5a9b30'
+down_revision = 'e5bd0b0f689b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('runtime_version_range',
+    sa.Column('spec_version', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('block_from', sa.Integer(), nullable=False),
+    sa.Column('block_to', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('spec_version')
+    )
+    op.create_index(op.f('ix_runtime_version_range_block_from'), 'runtime_version_range', ['block_from'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_runtime_version_range_block_from'), table_name='runtime_version_range')
+    op.drop_table('runtime_version_range')
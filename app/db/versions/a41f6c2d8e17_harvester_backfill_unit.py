@@ -0,0 +1,38 @@
+"""harvester backfill unit
+
+Revision ID: a41f6c2d8e17
+Revises: 7c1d2e5a9b30
+Create Date: 2026-10-18 11:03:27.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a41f6c2d8e17'
+down_revision = '7c1d2e5a9b30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('harvester_backfill_unit',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('block_from', sa.Integer(), nullable=False),
+    sa.Column('block_to', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('worker', sa.String(length=64), nullable=True),
+    sa.Column('lease_expires', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('heartbeat', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('error', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_harvester_backfill_unit_block_to'), 'harvester_backfill_unit', ['block_to'], unique=False)
+    op.create_index(op.f('ix_harvester_backfill_unit_status'), 'harvester_backfill_unit', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_harvester_backfill_unit_status'), table_name='harvester_backfill_unit')
+    op.drop_index(op.f('ix_harvester_backfill_unit_block_to'), table_name='harvester_backfill_unit')
+    op.drop_table('harvester_backfill_unit')
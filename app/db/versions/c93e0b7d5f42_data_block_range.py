@@ -0,0 +1,43 @@
+"""data block range
+
+Revision ID: c93e0b7d5f42
+Revises: a41f6c2d8e17
+Create Date: 2026-10-18 11:47:52.640315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c93e0b7d5f42'
+down_revision = 'a41f6c2d8e17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('data_block_range',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('block_from', sa.Integer(), nullable=False),
+    sa.Column('block_to', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_data_block_range_block_from'), 'data_block_range', ['block_from'], unique=False)
+    op.create_index(op.f('ix_data_block_range_block_to'), 'data_block_range', ['block_to'], unique=False)
+
+    # Ranges of already harvested blocks, ids minus their row number are equal within a contiguous range
+    op.execute("""
+        INSERT INTO data_block_range (block_from, block_to)
+        SELECT MIN(id), MAX(id)
+        FROM (
+         SELECT id, id - ROW_NUMBER() OVER (ORDER BY id) AS grp
+         FROM data_block
+        ) AS z
+        GROUP BY grp
+    """)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_data_block_range_block_to'), table_name='data_block_range')
+    op.drop_index(op.f('ix_data_block_range_block_from'), table_name='data_block_range')
+    op.drop_table('data_block_range')
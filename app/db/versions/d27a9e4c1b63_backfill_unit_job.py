@@ -0,0 +1,25 @@
+"""backfill unit job
+
+Revision ID: d27a9e4c1b63
+Revises: c93e0b7d5f42
+Create Date: 2026-10-18 15:21:48.530127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd27a9e4c1b63'
+down_revision = 'c93e0b7d5f42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('harvester_backfill_unit', sa.Column('job', sa.String(length=20), server_default='accumulate', nullable=False))
+    op.create_index(op.f('ix_harvester_backfill_unit_job'), 'harvester_backfill_unit', ['job'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_harvester_backfill_unit_job'), table_name='harvester_backfill_unit')
+    op.drop_column('harvester_backfill_unit', 'job')
@@ -0,0 +1,30 @@
+"""backfill unit retry
+
+Revision ID: f4b8c2a91d07
+Revises: d27a9e4c1b63
+Create Date: 2026-10-18 21:52:07.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f4b8c2a91d07'
+down_revision = 'd27a9e4c1b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('harvester_backfill_unit', sa.Column('failed_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('harvester_backfill_unit', sa.Column('retry_at', sa.DateTime(timezone=True), nullable=True))
+
+    # Retry units that failed before, and remove finished backfill units; harvested blocks are tracked by
+    # data_block_range
+    op.execute("UPDATE harvester_backfill_unit SET retry_at = CURRENT_TIMESTAMP WHERE status = 'failed'")
+    op.execute("DELETE FROM harvester_backfill_unit WHERE status = 'done' AND job = 'accumulate'")
+
+
+def downgrade():
+    op.drop_column('harvester_backfill_unit', 'retry_at')
+    op.drop_column('harvester_backfill_unit', 'failed_at')
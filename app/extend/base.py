@@ -1,11 +1,61 @@
+import json
 from typing import Optional
 
-from scalecodec.base import RuntimeConfigurationObject, Singleton
+from scalecodec.base import RuntimeConfigurationObject, Singleton, ScaleBytes
 from substrateinterface import SubstrateInterface
+from substrateinterface.exceptions import SubstrateRequestException
+from substrateinterface.utils.hasher import xxh128
 from scalecodec.types import Enum, H256, GenericRegistryType
 
+from app.extend.cache import DecoderClassCache
+from app.extend.rpc import create_batch_payload, get_batch_responses
+
+SYSTEM_EVENTS_STORAGE_KEY = '0x{}{}'.format(xxh128(b'System'), xxh128(b'Events'))
+
+
+def create_block_data(block_hash, block, events):
+    """
+    Creates the raw block data of a block from the batched `chain_getBlock` and events `state_getStorageAt` results.
+    When retrieving the events failed the error is kept in `events_error` and the block is stored without events, as
+    when the events are retrieved separately
+    """
+    events_error = None
+    if isinstance(events, SubstrateRequestException):
+        events_error = str(events)
+        events = None
+
+    return {
+        'hash': block_hash,
+        'block': block['block'],
+        'events': events,
+        'events_error': events_error
+    }
+
+
+def process_batch_response(payload, messages, return_errors=False):
+    """
+    Returns the results of a JSON-RPC batch response in order of the requests in the payload. An error of a single
+    request raises, unless `return_errors` is set, then a SubstrateRequestException is returned in place of its result
+    """
+    results = []
+
+    for result, error in get_batch_responses(payload, messages):
+        if error is not None:
+            if not return_errors:
+                raise SubstrateRequestException(error)
+
+            result = SubstrateRequestException(error)
+
+        results.append(result)
+
+    return results
+
 
 class AresSubstrateInterface(SubstrateInterface):
+
+    # RuntimeVersionIndex of the harvester, resolves spec versions of block numbers without requests to the node
+    runtime_index = None
+
     def implements_scaleinfo(self) -> Optional[bool]:
         if self.metadata_decoder:
             return self.metadata_decoder.portable_registry is not None
@@ -15,8 +65,159 @@ class AresSubstrateInterface(SubstrateInterface):
         super().init_runtime(block_hash=block_hash, block_id=block_id)
         self.ss58_format = None
 
+    def rpc_batch_request(self, calls, return_errors=False):
+        """
+        Sends given list of (method, params) tuples as one JSON-RPC batch and returns the list of results in the same
+        order, so multiple calls cost a single round trip to the node
+
+        :param calls:
+        :param return_errors: return the errors of single calls as SubstrateRequestException instead of raising
+        :return:
+        """
+        if not calls:
+            return []
+
+        payload = create_batch_payload(self.request_id, calls)
+        self.request_id += len(payload)
+
+        self.debug_message('RPC batch request #{}: {} calls'.format(payload[0]['id'], len(payload)))
+
+        if self.websocket:
+            self.websocket.send(json.dumps(payload))
+
+            request_ids = set([request['id'] for request in payload])
+            messages = None
+
+            while messages is None:
+                message = json.loads(self.websocket.recv())
+
+                if type(message) is list or message.get('id') in request_ids or (
+                        'error' in message and message.get('id') is None):
+                    messages = message
+                else:
+                    # Leave unrelated messages (e.g. subscription updates) to rpc_request
+                    self._SubstrateInterface__rpc_message_queue.append(message)
+        else:
+            response = self.session.request(
+                "POST", self.url, data=json.dumps(payload), headers=self.default_headers
+            )
+
+            if response.status_code != 200:
+                raise SubstrateRequestException(
+                    "RPC request failed with HTTP status code {}".format(response.status_code))
+
+            messages = response.json()
+
+        return process_batch_response(payload, messages, return_errors=return_errors)
+
+    def get_block_hashes(self, block_ids, batch_size=100):
+        """
+        Retrieves the block hashes of given block numbers, using one batch request per `batch_size` numbers
+
+        :param block_ids:
+        :param batch_size:
+        :return: dict of block number to block hash (None for unknown numbers)
+        """
+        block_ids = list(block_ids)
+        block_hashes = {}
+
+        for idx in range(0, len(block_ids), batch_size):
+            chunk = block_ids[idx:idx + batch_size]
+            results = self.rpc_batch_request([('chain_getBlockHash', [block_id]) for block_id in chunk])
+            block_hashes.update(zip(chunk, results))
+
+        return block_hashes
+
+    def get_block_spec_version(self, block_hash, block_id=None):
+        """
+        Returns the spec version of the runtime in the state of given block, from the runtime version index when the
+        block number is given, otherwise from the node
+
+        :param block_hash:
+        :param block_id:
+        :return:
+        """
+        if block_id is not None and self.runtime_index is not None:
+            return self.runtime_index.get_spec_version(block_id)
+
+        return self.get_block_runtime_version(block_hash)['specVersion']
+
+    def init_block_runtime(self, block_hash, spec_version):
+        """
+        Same as `init_runtime`, but with an already known spec version of the parent block, so no header and
+        runtime version requests are needed as long as the spec version doesn't change
+        """
+        if block_hash == self.block_hash:
+            return
+
+        if spec_version != self.runtime_version:
+            # Runtime upgrade, let init_runtime retrieve and apply the metadata
+            self.init_runtime(block_hash=block_hash)
+        else:
+            self.block_hash = block_hash
+            self.block_id = None
+
+    def decode_block(self, block_hash, block_data, spec_version):
+        """
+        Decodes the extrinsics and digest logs of a raw `chain_getBlock` result, as `get_block` does for blocks
+        retrieved by the interface itself
+        """
+        self.init_block_runtime(block_hash, spec_version)
+
+        # Decoded into copies, block_data is left as is so it can be decoded again when processing the block fails
+        header = dict(block_data['header'], hash=block_hash, number=int(block_data['header']['number'], 16))
+
+        extrinsic_cls = self.runtime_config.get_decoder_class('Extrinsic')
+        extrinsics = []
+
+        for extrinsic_data in block_data.get('extrinsics', []):
+            extrinsic_decoder = extrinsic_cls(
+                data=ScaleBytes(extrinsic_data),
+                metadata=self.metadata_decoder,
+                runtime_config=self.runtime_config
+            )
+            extrinsic_decoder.decode()
+            extrinsics.append(extrinsic_decoder)
+
+        log_digest_cls = self.runtime_config.get_decoder_class('sp_runtime::generic::digest::DigestItem')
+        logs = []
+
+        for log_data in block_data['header']['digest']['logs']:
+            log_digest = log_digest_cls(data=ScaleBytes(log_data))
+            log_digest.decode()
+            logs.append(log_digest)
+
+        header['digest'] = dict(header['digest'], logs=logs)
+
+        return dict(block_data, header=header, extrinsics=extrinsics)
+
+    def decode_events(self, block_hash, events_data, spec_version):
+        """
+        Decodes a raw System.Events storage value, as `get_events` does for storage retrieved by the interface itself
+        """
+        self.init_block_runtime(block_hash, spec_version)
+
+        storage_item = self.get_metadata_storage_function('System', 'Events', block_hash=block_hash)
+        value_scale_type = storage_item.get_value_type_string()
+
+        if events_data is None:
+            # No events stored for this block, use the default value of the storage function
+            events_data = storage_item.value_object['default'].value_object
+
+        events = self.runtime_config.create_scale_object(
+            type_string=value_scale_type,
+            data=ScaleBytes(events_data),
+            metadata=self.metadata_decoder
+        )
+        events.decode()
+
+        return events.elements
+
     def reload_type_registry(self, use_remote_preset: bool = True, auto_discover: bool = True):
         super().reload_type_registry(use_remote_preset=use_remote_preset, auto_discover=auto_discover)
+        # init_runtime adds the PortableRegistry of this runtime version next, let its decoder classes be cached
+        if isinstance(self.runtime_config, CompatibleRuntimeConfigurationObject):
+            self.runtime_config.scale_info_spec_version = self.runtime_version
         self.runtime_config.update_type_registry_types({
             "*::Event": {
                 "type": "struct",
@@ -27,8 +228,35 @@ class AresSubstrateInterface(SubstrateInterface):
 
 
 class CompatibleRuntimeConfigurationObject(RuntimeConfigurationObject):
+    # Number of spec versions of which the generated scale-info decoder classes are kept
+    decoder_class_cache_size = 5
+
+    def __init__(self, *args, **kwargs):
+        # Spec version of the metadata of which the PortableRegistry is being added, set by AresSubstrateInterface
+        self.scale_info_spec_version = None
+        self.decoder_class_cache = DecoderClassCache(self.decoder_class_cache_size)
+        super().__init__(*args, **kwargs)
+
     def get_decoder_class_for_scale_info_definition(
             self, type_string: str, scale_info_type: 'GenericRegistryType', prefix: str
+    ):
+        """
+        Returns the decoder class for given scale-info type. Classes are generated once per spec version and type, so
+        adding the PortableRegistry of a spec version again (e.g. when switching between runtimes) reuses them.
+        """
+        if self.scale_info_spec_version is None:
+            return self.create_decoder_class_for_scale_info_definition(type_string, scale_info_type, prefix)
+
+        return self.decoder_class_cache.get(
+            self.scale_info_spec_version, type_string,
+            lambda: self.create_decoder_class_for_scale_info_definition(type_string, scale_info_type, prefix)
+        )
+
+    def get_decoder_class_cache_info(self):
+        return self.decoder_class_cache.get_info()
+
+    def create_decoder_class_for_scale_info_definition(
+            self, type_string: str, scale_info_type: 'GenericRegistryType', prefix: str
     ):
         decoder_class = None
         base_decoder_class = None
@@ -139,33 +367,26 @@ class CompatibleGenericScaleInfoEvent(Enum):
     def process(self):
 
         super().process()
-        enum_index = self.value_object[1].index
+        event_variant = self.value_object[1]
+        enum_index = event_variant.index
+        event_data = event_variant[1]
         self.event_index = bytes([self.index, enum_index]).hex()
-        if self.value_object[1][1] and hasattr(self.value_object[1], 'type_name'):
-            if type(self.value_object[1][1].value) == tuple:
-                attributes = [{}] * len(self.value_object[1][1].value)
-                i = 0
-                types = self.value_object[1].type_name[enum_index]
-                for value in self.value_object[1][1].value:
-                    attributes[i] = {
-                        'type': types[i],
-                        'value': value,
-                    }
-                    i += 1
+
+        if event_data and hasattr(event_variant, 'type_name'):
+            types = event_variant.type_name[enum_index]
+            value = event_data.value
+
+            if type(value) == tuple:
+                attributes = [{'type': types[i], 'value': item} for i, item in enumerate(value)]
             else:
-                attributes = [{}] * 1
-                types = self.value_object[1].type_name[enum_index]
-                attributes[0] = {
-                    'type': types,
-                    'value': self.value_object[1][1].value,
-                }
+                attributes = [{'type': types, 'value': value}]
         else:
-            attributes = self.value_object[1][1].value if self.value_object[1][1] else None
+            attributes = event_data.value if event_data else None
 
         return {
             'event_index': self.event_index,
             'module_id': self.value_object[0],
-            'event_id': self.value_object[1][0],
+            'event_id': event_variant[0],
             'attributes': attributes,
         }
 
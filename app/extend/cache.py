@@ -0,0 +1,313 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  cache.py
+
+import os
+import tempfile
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from scalecodec.base import ScaleBytes
+
+
+class MetadataFileCache(object):
+    """
+    Stores runtime metadata per spec version on local disk, so it is shared by all worker processes of a host and
+    survives restarts. Implements the `get` and `set` methods of a dogpile cache region, as used by the
+    `cache_region` of SubstrateInterface.init_runtime.
+
+    Decoded metadata contains dynamically created classes and can't be pickled, therefore the raw SCALE bytes are
+    stored zlib compressed and decoded again on load, which avoids the `state_getMetadata` request.
+    """
+
+    def __init__(self, path, runtime_config):
+        self.path = path
+        self.runtime_config = runtime_config
+
+    def get_filename(self, key):
+        return os.path.join(self.path, '{}.scale.z'.format(key))
+
+    def get(self, key):
+        try:
+            with open(self.get_filename(key), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (IOError, zlib.error):
+            return None
+
+        metadata_decoder = self.runtime_config.create_scale_object('MetadataVersioned', data=ScaleBytes(data))
+        metadata_decoder.decode()
+
+        return metadata_decoder
+
+    def set(self, key, metadata_decoder):
+        os.makedirs(self.path, exist_ok=True)
+
+        # Write to a temporary file first, so other processes never read a partially written file
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(bytes(metadata_decoder.data.data)))
+            os.replace(tmp_filename, self.get_filename(key))
+        except OSError as e:
+            print('! Could not store {} in metadata cache: {}'.format(key, e))
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+
+class DecoderClassCache(object):
+    """
+    Decoder classes generated from scale-info type definitions, per spec version and type string, of the `size` spec
+    versions used most recently. Counts hits and misses, so it can be checked whether switching between runtimes
+    reuses the classes.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.decoder_classes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, spec_version, type_string, create_decoder_class):
+        """
+        Returns the cached decoder class, or the one created by calling `create_decoder_class` when not cached
+        :param spec_version:
+        :param type_string:
+        :param create_decoder_class:
+        :return:
+        """
+        decoder_classes = self.decoder_classes.get(spec_version)
+
+        if decoder_classes is None:
+            decoder_classes = self.decoder_classes[spec_version] = {}
+
+            while len(self.decoder_classes) > self.size:
+                self.decoder_classes.popitem(last=False)
+        else:
+            self.decoder_classes.move_to_end(spec_version)
+
+        decoder_class = decoder_classes.get(type_string)
+
+        if decoder_class is None:
+            self.misses += 1
+            decoder_class = decoder_classes[type_string] = create_decoder_class()
+        else:
+            self.hits += 1
+
+        return decoder_class
+
+    def get_info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'spec_versions': list(self.decoder_classes.keys()),
+            'classes': sum([len(decoder_classes) for decoder_classes in self.decoder_classes.values()])
+        }
+
+
+class KnownBlockHashes(object):
+    """
+    Compact in-memory membership test for the hashes in `data_block`: a bloom filter over the leading bytes of the
+    block hashes plus a sorted array of the block numbers. Both can only answer "maybe" or "certainly not", so only
+    negative answers can be trusted; a positive answer has to be confirmed by the database.
+
+    Entries are never removed. A block deleted by `remove_block` is left behind as a false positive, which is
+    resolved by the confirming query. Blocks added by other workers are only seen after a `refresh`, which adds the
+    blocks above the highest loaded block and the blocks stored in the gaps below it, or when they are added
+    explicitly; until then the unique index on `data_block.hash` rejects them when the block is stored.
+    """
+
+    # Number of bloom filter probes; each probe reads 8 hex characters of the (uniformly distributed) block hash
+    probes = 7
+
+    def __init__(self, size_bits):
+        self.size_bits = size_bits
+        self.bits = bytearray((size_bits + 7) // 8)
+        # Block numbers loaded while warming (sorted) and added since (unordered), the latter would make inserting
+        # into the sorted array a memmove of the whole array per block
+        self.block_ids = array('I')
+        self.added_block_ids = set()
+        # Gaps below the highest loaded block, as inclusive (from, to) ordered by from
+        self.missing_ranges = []
+        self.refreshed_at = None
+
+    def get_positions(self, block_hash):
+        return [
+            int(block_hash[2 + probe * 8:10 + probe * 8], 16) % self.size_bits for probe in range(self.probes)
+        ]
+
+    def add_hash(self, block_hash):
+        for position in self.get_positions(block_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def add(self, block_id, block_hash):
+        self.add_hash(block_hash)
+        self.added_block_ids.add(block_id)
+
+    def contains_block_id(self, block_id):
+        if block_id in self.added_block_ids:
+            return True
+
+        idx = bisect_left(self.block_ids, block_id)
+        return idx < len(self.block_ids) and self.block_ids[idx] == block_id
+
+    def might_contain(self, block_hash, block_id=None):
+        """
+        Returns False when given block is certainly not stored, True when it might be. When the block number is
+        known it is checked as well, which rules out most false positives of the bloom filter.
+
+        :param block_hash:
+        :param block_id:
+        :return:
+        """
+        for position in self.get_positions(block_hash):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return block_id is None or self.contains_block_id(block_id)
+
+    def refresh(self, session, model_class, block_range_class=None, chunk_size=10000):
+        """
+        Adds the blocks above the highest block loaded so far, e.g. stored by other workers at the chain head. When
+        `block_range_class` is given, the blocks stored since the last refresh in the gaps below it (e.g. by backfill
+        workers) are added as well, found by comparing the gaps with the stored block ranges.
+        :param session:
+        :param model_class:
+        :param block_range_class: model of the stored block ranges, e.g. BlockRange
+        :param chunk_size:
+        :return:
+        """
+        if block_range_class is not None and self.missing_ranges:
+            self.refresh_missing_ranges(session, model_class, block_range_class, chunk_size)
+
+        query = session.query(model_class.id, model_class.hash)
+
+        if self.block_ids:
+            previous_block_id = self.block_ids[-1]
+            query = query.filter(model_class.id > previous_block_id)
+        else:
+            previous_block_id = -1
+
+        # Rows are streamed in id order, so the array stays sorted without sorting it afterwards
+        for block_id, block_hash in query.order_by(model_class.id).yield_per(chunk_size):
+            if block_id > previous_block_id + 1:
+                self.missing_ranges.append((previous_block_id + 1, block_id - 1))
+
+            self.add_hash(block_hash)
+            self.block_ids.append(block_id)
+            previous_block_id = block_id
+
+        self.refreshed_at = time.monotonic()
+
+    def refresh_missing_ranges(self, session, model_class, block_range_class, chunk_size=10000):
+        stored_ranges = get_range_intersections(
+            self.missing_ranges,
+            session.query(block_range_class.block_from, block_range_class.block_to).order_by(
+                block_range_class.block_from
+            ).all()
+        )
+
+        for block_from, block_to in stored_ranges:
+            block_ids = array('I')
+
+            for block_id, block_hash in session.query(model_class.id, model_class.hash).filter(
+                    model_class.id.between(block_from, block_to)
+            ).order_by(model_class.id).yield_per(chunk_size):
+                self.add_hash(block_hash)
+                block_ids.append(block_id)
+
+            # The range lies within a gap, so the ids are inserted as a whole; the explicitly added ones don't
+            # have to be kept separately anymore
+            idx = bisect_left(self.block_ids, block_from)
+            self.block_ids[idx:idx] = block_ids
+            self.added_block_ids.difference_update(block_ids)
+
+        self.missing_ranges = get_range_differences(self.missing_ranges, stored_ranges)
+
+    @classmethod
+    def load(cls, session, model_class, size_bits, block_range_class=None, chunk_size=10000):
+        known_block_hashes = cls(size_bits)
+        known_block_hashes.refresh(session, model_class, block_range_class=block_range_class, chunk_size=chunk_size)
+
+        return known_block_hashes
+
+
+def get_range_intersections(ranges, other_ranges):
+    """
+    Parts of `ranges` that are covered by `other_ranges`; both are lists of inclusive (from, to) ordered by from.
+    `ranges` don't overlap each other, `other_ranges` may.
+    :param ranges:
+    :param other_ranges:
+    :return: list of non-overlapping (from, to) ordered by from
+    """
+    intersections = []
+    idx = 0
+
+    for other_from, other_to in other_ranges:
+        # Ranges ending before this one can't intersect the ones after it either, as those start later
+        while idx < len(ranges) and ranges[idx][1] < other_from:
+            idx += 1
+
+        range_idx = idx
+        while range_idx < len(ranges) and ranges[range_idx][0] <= other_to:
+            range_from, range_to = ranges[range_idx]
+            range_idx += 1
+
+            block_from, block_to = max(range_from, other_from), min(range_to, other_to)
+
+            if intersections and block_from <= intersections[-1][1] + 1:
+                # Overlapping other ranges cover the same part twice
+                intersections[-1] = (intersections[-1][0], max(intersections[-1][1], block_to))
+            else:
+                intersections.append((block_from, block_to))
+
+    return intersections
+
+
+def get_range_differences(ranges, removed_ranges):
+    """
+    Parts of `ranges` that are not covered by `removed_ranges`, given as non-overlapping inclusive (from, to)
+    ordered by from
+    :param ranges:
+    :param removed_ranges:
+    :return:
+    """
+    differences = []
+    idx = 0
+
+    for range_from, range_to in ranges:
+        while idx < len(removed_ranges) and removed_ranges[idx][1] < range_from:
+            idx += 1
+
+        block_from = range_from
+        removed_idx = idx
+        while removed_idx < len(removed_ranges) and removed_ranges[removed_idx][0] <= range_to:
+            removed_from, removed_to = removed_ranges[removed_idx]
+            removed_idx += 1
+
+            if removed_from > block_from:
+                differences.append((block_from, removed_from - 1))
+            block_from = max(block_from, removed_to + 1)
+
+        if block_from <= range_to:
+            differences.append((block_from, range_to))
+
+    return differences
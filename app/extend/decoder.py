@@ -0,0 +1,206 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  decoder.py
+
+import billiard
+from billiard.pool import Pool
+from scalecodec.base import ScaleBytes, RuntimeConfiguration
+from scalecodec.type_registry import load_type_registry_file
+from substrateinterface.exceptions import SubstrateRequestException
+
+from app import settings
+from app.extend.base import AresSubstrateInterface, CompatibleRuntimeConfiguration
+from app.extend.cache import MetadataFileCache
+from app.extend.pool import OrderedDecoderPool
+
+
+def get_event_record(event):
+    """
+    Reads the stored fields of a decoded event record with a single lookup each
+    :param event:
+    :return: tuple of module_id (lowercase), event_id, phase, extrinsic_idx, event type and attributes
+    """
+    value = event.value
+
+    return (
+        value['module_id'].lower(),
+        value['event_id'],
+        event.value_object['phase'].index,
+        value['extrinsic_idx'],
+        value.get('event_index') or value.get('type'),
+        value.get('attributes')
+    )
+
+
+def get_log_record(substrate, log_digest):
+    """
+    Reads type and data of a decoded digest log, the PreRuntime digests of aura and BABE are decoded further to get
+    the slot number and authority index
+    :param substrate:
+    :param log_digest:
+    :return: tuple of type_id, type and data
+    """
+    log_type = log_digest.value_object[0]  # ('PreRuntime', GenericPreRuntime)
+    log_inner_data = {}
+    if ('PreRuntime' == log_type or 'Seal' == log_type) and substrate.implements_scaleinfo():
+        engine_id = bytes.fromhex(log_digest.value[log_type][0][2:]).decode('utf-8')
+        if engine_id == 'aura' and 'PreRuntime' == log_type:
+            predigest_data = log_digest.value['PreRuntime'][1]
+            try:
+                if predigest_data[:2] != '0x':
+                    predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
+                else:
+                    predigest_data = ScaleBytes(predigest_data)
+            except ValueError:
+                predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
+            aura_predigest = substrate.runtime_config.create_scale_object(
+                type_string='RawAuraPreDigest',
+                # data=ScaleBytes(log_digest.value['PreRuntime'][1])
+                data=predigest_data
+            )
+            aura_predigest.decode()
+            slot_number = aura_predigest.value['slot_number']
+            log_inner_data = {"data": {"slot_number": slot_number}, "engine": "aura"}
+        elif engine_id == 'aura' and 'Seal' == log_type:
+            log_inner_data = {"data": log_digest.value['Seal'][1], "engine": "aura"}
+
+        elif engine_id == 'BABE' and 'PreRuntime' == log_type:
+            predigest_data = log_digest.value['PreRuntime'][1]
+            try:
+                if predigest_data[:2] != '0x':
+                    predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
+                else:
+                    predigest_data = ScaleBytes(predigest_data)
+            except ValueError:
+                predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
+            babe_predigest = substrate.runtime_config.create_scale_object(
+                type_string='RawBabePreDigest',
+                # data=ScaleBytes(log_digest.value['PreRuntime'][1])
+                data=predigest_data
+            )
+            babe_predigest.decode()
+            rank_validator = babe_predigest[1].value['authority_index']
+            slot_number = babe_predigest[1].value['slot_number']
+            log_inner_data = {"data": {"slot_number": slot_number, "authority_index": rank_validator},
+                              "engine": "BABE"}
+        elif engine_id == 'BABE' and 'Seal' == log_type:
+            log_inner_data = {"data": log_digest.value['Seal'][1], "engine": "BABE"}
+    else:
+        if type(log_digest.value) == str:
+            log_inner_data = log_digest.value
+        else:
+            log_inner_data = log_digest.value[log_type]
+
+    return log_digest.index, log_type, log_inner_data
+
+
+def decode_block_records(substrate, block_hash, block_data, spec_version):
+    """
+    Decodes the raw block and events of `block_data` (see `BlockPrefetcher`) against the runtime of given spec
+    version into plain records, which can be passed between processes
+    :param substrate:
+    :param block_hash:
+    :param block_data:
+    :param spec_version: spec version of the parent block
+    :return: dict with the header fields, digest logs (raw and decoded), event records and extrinsic values
+    """
+    block = substrate.decode_block(block_hash, block_data['block'], spec_version)
+    header = block['header']
+    log_digests = header.get('digest', {}).get('logs', [])
+
+    if block_data.get('events_error'):
+        # Retrieving the events failed, the block is stored without events
+        events = None
+    else:
+        try:
+            # TODO implemented solution in substrate interface for runtime transition blocks
+            # Events are decoded against runtime of parent block
+            RuntimeConfiguration().set_active_spec_version_id(spec_version)
+            events = [
+                get_event_record(event)
+                for event in substrate.decode_events(block_hash, block_data['events'], spec_version)
+            ]
+        except SubstrateRequestException:
+            events = None
+
+    return {
+        'hash': block_hash,
+        'spec_version': spec_version,
+        'number': header['number'],
+        'parent_hash': header['parentHash'],
+        'extrinsics_root': header['extrinsicsRoot'],
+        'state_root': header['stateRoot'],
+        'logs': [log_digest.data.to_hex() for log_digest in log_digests],
+        'log_records': [get_log_record(substrate, log_digest) for log_digest in log_digests],
+        'events': events,
+        'extrinsics': [(extrinsic.value, extrinsic.signed) for extrinsic in block['extrinsics']]
+    }
+
+
+# Substrate interface of a decoder process, created by init_decoder_process
+decoder_substrate = None
+
+
+def init_decoder_process(type_registry, type_registry_file):
+    global decoder_substrate
+
+    if type_registry_file:
+        custom_type_registry = load_type_registry_file(type_registry_file)
+    else:
+        custom_type_registry = None
+
+    decoder_substrate = AresSubstrateInterface(
+        url=settings.SUBSTRATE_RPC_URL,
+        type_registry=custom_type_registry,
+        type_registry_preset=type_registry,
+        runtime_config=CompatibleRuntimeConfiguration()
+    )
+    if settings.METADATA_CACHE_DIR:
+        decoder_substrate.cache_region = MetadataFileCache(
+            settings.METADATA_CACHE_DIR, decoder_substrate.runtime_config
+        )
+    if settings.SUBSTRATE_MOCK_EXTRINSICS:
+        decoder_substrate.mock_extrinsics = settings.SUBSTRATE_MOCK_EXTRINSICS
+
+
+def decode_block_data(block_hash, block_data, spec_version):
+    return decode_block_records(decoder_substrate, block_hash, block_data, spec_version)
+
+
+class BlockDecoderPool(OrderedDecoderPool):
+    """
+    Decodes raw block data in a pool of processes, so decoding uses more than the one core of the process that stores
+    the blocks. Every process keeps its own node connection and runtime configuration, which is only reloaded when
+    the spec version changes; the metadata of a spec version is read from the METADATA_CACHE_DIR when available.
+
+    The pool is a billiard pool, as Celery's prefork workers are daemonic processes that the multiprocessing module
+    doesn't allow to start children. Processes are spawned rather than forked, as the parent holds DB connections
+    and prefetch threads.
+    """
+
+    def __init__(self, max_workers, type_registry, type_registry_file):
+        super().__init__(
+            Pool(
+                processes=max_workers,
+                initializer=init_decoder_process,
+                initargs=(type_registry, type_registry_file),
+                context=billiard.get_context('spawn')
+            ),
+            decode_block_data
+        )
@@ -0,0 +1,87 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  pool.py
+
+import logging
+from collections import deque
+
+from scalecodec.exceptions import RemainingScaleBytesNotEmptyException, InvalidScaleTypeValueException
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by decoding invalid or unsupported SCALE data; the consumer falls back to decoding such a block
+# itself, any other error (e.g. a lost node connection) is raised
+DECODING_ERRORS = (
+    ValueError, NotImplementedError, IndexError, KeyError, RemainingScaleBytesNotEmptyException,
+    InvalidScaleTypeValueException
+)
+
+
+class OrderedDecoderPool(object):
+    """
+    Runs `decode_function` for blocks in a process pool ahead of the consumer, and yields the results in the order
+    the blocks were given
+    """
+
+    def __init__(self, pool, decode_function):
+        """
+        :param pool: pool with `apply_async`, like a billiard or multiprocessing pool
+        :param decode_function: called with `(block_hash, block_data, spec_version)` in a pool process
+        """
+        self.pool = pool
+        self.decode_function = decode_function
+
+    def decode_blocks(self, blocks, window):
+        """
+        Decodes given blocks ahead of the consumer, at most `window` blocks are in flight or waiting to be consumed.
+        Blocks are yielded in the given order as (block_hash, block_data, block_records); block_records is None when
+        there was no block data to decode or the data could not be decoded, leaving decoding to the consumer.
+
+        :param blocks: iterable of (block_hash, block_data, spec_version)
+        :param window:
+        :return:
+        """
+        pending = deque()
+
+        for block_hash, block_data, spec_version in blocks:
+            result = None
+            if block_data:
+                result = self.pool.apply_async(self.decode_function, (block_hash, block_data, spec_version))
+
+            pending.append((block_hash, block_data, result))
+
+            if len(pending) >= window:
+                yield self.get_result(*pending.popleft())
+
+        while pending:
+            yield self.get_result(*pending.popleft())
+
+    def get_result(self, block_hash, block_data, result):
+        if result is None:
+            return block_hash, block_data, None
+
+        try:
+            return block_hash, block_data, result.get()
+        except DECODING_ERRORS:
+            logger.exception('Decoding of block %s failed, decoding it in the worker', block_hash)
+            return block_hash, block_data, None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
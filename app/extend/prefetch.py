@@ -0,0 +1,281 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  prefetch.py
+
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from substrateinterface.exceptions import SubstrateRequestException
+from websocket import create_connection
+
+from app.extend.base import process_batch_response, create_block_data, SYSTEM_EVENTS_STORAGE_KEY
+from app.extend.rpc import create_batch_payload
+
+
+class RpcClient(object):
+    """
+    Plain JSON-RPC client without metadata or type registry state, cheap enough to open one per prefetch thread.
+    Results are returned undecoded.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.request_id = 1
+        self.websocket = None
+        self.session = None
+
+        if url[0:6] == 'wss://' or url[0:5] == 'ws://':
+            self.websocket = create_connection(url)
+        else:
+            self.session = requests.Session()
+
+    def rpc_request(self, method, params):
+        request_id = self.request_id
+        self.request_id += 1
+
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": request_id
+        }
+
+        if self.websocket:
+            self.websocket.send(json.dumps(payload))
+
+            json_body = None
+            while json_body is None:
+                message = json.loads(self.websocket.recv())
+                if message.get('id') == request_id:
+                    json_body = message
+        else:
+            response = self.session.request("POST", self.url, data=json.dumps(payload), headers={
+                'content-type': "application/json",
+                'cache-control': "no-cache"
+            })
+
+            if response.status_code != 200:
+                raise SubstrateRequestException(
+                    "RPC request failed with HTTP status code {}".format(response.status_code))
+
+            json_body = response.json()
+
+        if 'error' in json_body:
+            raise SubstrateRequestException(json_body['error'])
+
+        return json_body.get('result')
+
+    def rpc_batch_request(self, calls, return_errors=False):
+        if not calls:
+            return []
+
+        payload = create_batch_payload(self.request_id, calls)
+        self.request_id += len(payload)
+
+        if self.websocket:
+            self.websocket.send(json.dumps(payload))
+            messages = json.loads(self.websocket.recv())
+        else:
+            response = self.session.request("POST", self.url, data=json.dumps(payload), headers={
+                'content-type': "application/json",
+                'cache-control': "no-cache"
+            })
+
+            if response.status_code != 200:
+                raise SubstrateRequestException(
+                    "RPC request failed with HTTP status code {}".format(response.status_code))
+
+            messages = response.json()
+
+        return process_batch_response(payload, messages, return_errors=return_errors)
+
+    def close(self):
+        if self.websocket:
+            self.websocket.close()
+        if self.session:
+            self.session.close()
+
+
+class RpcThreadPool(object):
+    """
+    Thread pool in which every thread uses its own RpcClient
+    """
+
+    def __init__(self, url, max_workers):
+        self.url = url
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.clients = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_client(self):
+        client = getattr(self.local, 'client', None)
+
+        if client is None:
+            client = RpcClient(self.url)
+            self.local.client = client
+            with self.lock:
+                self.clients.append(client)
+
+        return client
+
+    def close(self, wait=True):
+        """
+        Shuts the pool down. Without `wait` running requests are not waited for, and the connections are left to be
+        closed by garbage collection, as closing them here would break those requests
+        """
+        self.executor.shutdown(wait=wait)
+
+        if wait:
+            for client in self.clients:
+                client.close()
+
+
+class BlockPrefetcher(RpcThreadPool):
+    """
+    Retrieves raw block data (hash, header, extrinsics and System.Events storage) for upcoming block numbers in a
+    thread pool, so network latency overlaps with decoding and storing the current block. Blocks are fetched in
+    chunks of `batch_size`, which take two JSON-RPC batch requests per chunk. At most `window` blocks are in flight
+    or waiting to be consumed.
+    """
+
+    def __init__(self, url, block_ids, window, max_workers, batch_size=10):
+        super().__init__(url, max_workers)
+        self.block_ids = iter(block_ids)
+        self.window = window
+        self.batch_size = batch_size
+        self.futures = OrderedDict()
+
+        self.fill()
+
+    def fetch_blocks_data(self, block_ids):
+        client = self.get_client()
+
+        block_hashes = dict(zip(block_ids, client.rpc_batch_request(
+            [('chain_getBlockHash', [block_id]) for block_id in block_ids]
+        )))
+
+        block_ids = [block_id for block_id in block_ids if block_hashes[block_id] is not None]
+
+        calls = []
+        for block_id in block_ids:
+            calls += [
+                ('chain_getBlock', [block_hashes[block_id]]),
+                ('state_getStorageAt', [SYSTEM_EVENTS_STORAGE_KEY, block_hashes[block_id]])
+            ]
+
+        results = client.rpc_batch_request(calls, return_errors=True)
+
+        blocks_data = {}
+        for idx, block_id in enumerate(block_ids):
+            block, events = results[idx * 2:idx * 2 + 2]
+
+            if block is None or isinstance(block, SubstrateRequestException):
+                # Left to the consumer, which retrieves the block itself
+                continue
+
+            blocks_data[block_id] = create_block_data(block_hashes[block_id], block, events)
+
+        return blocks_data
+
+    def fill(self):
+        # Only submit full chunks, unless the remaining block numbers don't fill one
+        while len(self.futures) + self.batch_size <= max(self.window, self.batch_size):
+            block_ids = []
+
+            while len(block_ids) < self.batch_size and len(self.futures) + len(block_ids) < self.window:
+                block_id = next(self.block_ids, None)
+
+                if block_id is None:
+                    break
+
+                block_ids.append(block_id)
+
+            if not block_ids:
+                break
+
+            future = self.executor.submit(self.fetch_blocks_data, block_ids)
+
+            for block_id in block_ids:
+                self.futures[block_id] = future
+
+    def get(self, block_id, block_hash=None):
+        """
+        Returns the prefetched data of given block, or None when it was not prefetched, the fetch failed or the
+        canonical hash at this block number is not the requested hash (e.g. a fork near the chain head). Without
+        `block_hash` the block on the canonical chain is returned.
+
+        :param block_id:
+        :param block_hash:
+        :return:
+        """
+        # Blocks before the requested one will not be consumed anymore
+        while self.futures and next(iter(self.futures)) != block_id and block_id in self.futures:
+            self.futures.popitem(last=False)
+
+        future = self.futures.pop(block_id, None)
+        self.fill()
+
+        if future is None:
+            return None
+
+        try:
+            block_data = future.result().get(block_id)
+        except Exception as e:
+            print('! Prefetch of block {} failed: {}'.format(block_id, e))
+            return None
+
+        if block_data and (block_hash is None or block_data['hash'] == block_hash):
+            return block_data
+
+    def close(self, wait=True):
+        for future in set(self.futures.values()):
+            future.cancel()
+        self.futures.clear()
+
+        super().close(wait=wait)
+
+
+class StorageFetcher(RpcThreadPool):
+    """
+    Retrieves raw storage values for chunks of storage keys in a thread pool, one `state_queryStorageAt` request per
+    chunk. Values are returned undecoded, decoding is left to the caller.
+    """
+
+    def fetch_storage_values(self, storage_keys, block_hash):
+        storage_values = OrderedDict((storage_key, None) for storage_key in storage_keys)
+
+        for result_group in self.get_client().rpc_request('state_queryStorageAt', [storage_keys, block_hash]):
+            for storage_key, storage_value in result_group['changes']:
+                storage_values[storage_key] = storage_value
+
+        return storage_values
+
+    def submit(self, storage_keys, block_hash):
+        """
+        Schedules the retrieval of given storage keys at given block hash
+
+        :param storage_keys:
+        :param block_hash:
+        :return: Future with an OrderedDict of storage key to raw value (None when not stored)
+        """
+        return self.executor.submit(self.fetch_storage_values, storage_keys, block_hash)
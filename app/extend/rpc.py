@@ -0,0 +1,112 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  rpc.py
+
+
+def create_batch_payload(first_request_id, calls):
+    """
+    Creates a JSON-RPC batch array for given list of (method, params) tuples, with consecutive request ids
+    """
+    return [
+        {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": first_request_id + idx
+        } for idx, (method, params) in enumerate(calls)
+    ]
+
+
+def get_batch_responses(payload, messages):
+    """
+    Matches the messages of a JSON-RPC batch response to the requests in the payload; responses within a batch may
+    arrive in any order. Returns a (result, error) tuple per request in order of the payload, error is None for
+    successful requests. When the whole batch was rejected (e.g. a parse error) every request gets its error.
+    """
+    if type(messages) is not list:
+        error = messages.get('error', messages)
+        return [(None, error) for request in payload]
+
+    messages_by_id = {message.get('id'): message for message in messages}
+    responses = []
+
+    for request in payload:
+        message = messages_by_id.get(request['id'])
+
+        if message is None:
+            responses.append((None, 'No response for batched request "{}"'.format(request['method'])))
+        elif 'error' in message:
+            responses.append((None, message['error']))
+        else:
+            responses.append((message.get('result'), None))
+
+    return responses
+
+
+def query_storage_values(query_storage_at, storage_keys, batch_size, default_value=None):
+    """
+    Retrieves the raw values of given storage keys with one `query_storage_at` call per `batch_size` keys, which is
+    passed a list of keys and returns the result of a `state_queryStorageAt` request for them. Returns the values in
+    order of `storage_keys`; keys without a stored value get `default_value`.
+    """
+    storage_values = {}
+
+    for idx in range(0, len(storage_keys), batch_size):
+        for result_group in query_storage_at(storage_keys[idx:idx + batch_size]):
+            for storage_key, storage_value in result_group['changes']:
+                storage_values[storage_key] = storage_value
+
+    return [
+        default_value if storage_values.get(storage_key) is None else storage_values[storage_key]
+        for storage_key in storage_keys
+    ]
+
+
+def query_in_batches(query_batch, items, batch_size, on_error=None):
+    """
+    Calls `query_batch` with consecutive lists of at most `batch_size` items, which returns a result per item.
+    When a batch fails, its items are queried one by one, so only the items that also fail on their own get None;
+    `on_error` is called with the items and the exception of every failed query. Returns the results in order of
+    `items`.
+    """
+    results = []
+
+    for idx in range(0, len(items), batch_size):
+        batch = items[idx:idx + batch_size]
+
+        try:
+            results.extend(query_batch(batch))
+            continue
+        except Exception as e:
+            if on_error:
+                on_error(batch, e)
+
+            if len(batch) == 1:
+                results.append(None)
+                continue
+
+        for item in batch:
+            try:
+                results.extend(query_batch([item]))
+            except Exception as e:
+                if on_error:
+                    on_error([item], e)
+                results.append(None)
+
+    return results
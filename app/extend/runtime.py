@@ -0,0 +1,128 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  runtime.py
+
+from bisect import bisect_right
+
+from sqlalchemy import func
+
+from app.models.data import Block, RuntimeVersionRange
+
+
+class RuntimeVersionIndex(object):
+    """
+    Maps block numbers to the spec version of the runtime in the state of that block.
+
+    Spec versions only increase, so each spec version covers one contiguous range of blocks. The lowest and highest
+    known block per spec version are persisted in RuntimeVersionRange. A block between two known ranges is resolved
+    with a binary search against the node, so RPC calls are only needed around runtime upgrades and beyond the
+    known chain head.
+    """
+
+    def __init__(self, db_session, substrate):
+        self.db_session = db_session
+        self.substrate = substrate
+        self.ranges = {}
+        self.sorted_ranges = []
+        self.block_froms = []
+
+    def load(self):
+        self.ranges = {
+            item.spec_version: [item.block_from, item.block_to]
+            for item in RuntimeVersionRange.query(self.db_session)
+        }
+
+        if not self.ranges:
+            self.bootstrap()
+
+        self.sort()
+
+    def bootstrap(self):
+        # Harvested blocks store the spec version of their parent block
+        for spec_version, block_from, block_to in self.db_session.query(
+                Block.spec_version_id, func.min(Block.id), func.max(Block.id)
+        ).group_by(Block.spec_version_id):
+            # Block.spec_version_id is a string column, spec versions are compared as int everywhere else
+            self.add(int(spec_version), max(block_from - 1, 0), max(block_to - 1, 0))
+
+    def sort(self):
+        self.sorted_ranges = sorted(
+            [(block_from, block_to, spec_version) for spec_version, (block_from, block_to) in self.ranges.items()]
+        )
+        self.block_froms = [item[0] for item in self.sorted_ranges]
+
+    def add(self, spec_version, block_from, block_to):
+        if spec_version in self.ranges:
+            self.ranges[spec_version][0] = min(self.ranges[spec_version][0], block_from)
+            self.ranges[spec_version][1] = max(self.ranges[spec_version][1], block_to)
+        else:
+            self.ranges[spec_version] = [block_from, block_to]
+
+        RuntimeVersionRange.extend(self.db_session, spec_version, block_from, block_to)
+
+        self.sort()
+
+    def find(self, block_id):
+        idx = bisect_right(self.block_froms, block_id) - 1
+
+        if idx >= 0 and self.sorted_ranges[idx][1] >= block_id:
+            return self.sorted_ranges[idx][2]
+
+    def get_spec_version(self, block_id):
+        """
+        Returns the spec version of the runtime in the state of given block number
+
+        :param block_id:
+        :return:
+        """
+        spec_version = self.find(block_id)
+
+        if spec_version is not None:
+            return spec_version
+
+        # Ranges could be extended by other workers in the meantime
+        self.load()
+
+        spec_version = self.find(block_id)
+
+        while spec_version is None:
+            idx = bisect_right(self.block_froms, block_id) - 1
+
+            if idx < 0:
+                # Nothing known below this block, start at genesis
+                probe_block_id = 0
+            elif idx + 1 >= len(self.sorted_ranges):
+                # Nothing known above this block, use the chain head
+                probe_block_id = max(self.get_head_block_id(), block_id)
+            else:
+                probe_block_id = (self.sorted_ranges[idx][1] + self.sorted_ranges[idx + 1][0]) // 2
+
+            probe_spec_version = self.fetch_spec_version(probe_block_id)
+            self.add(probe_spec_version, probe_block_id, probe_block_id)
+
+            spec_version = self.find(block_id)
+
+        return spec_version
+
+    def get_head_block_id(self):
+        return int(self.substrate.rpc_request('chain_getHeader', [])['result']['number'], 16)
+
+    def fetch_spec_version(self, block_id):
+        block_hash = self.substrate.get_block_hash(block_id)
+        return self.substrate.get_block_runtime_version(block_hash).get('specVersion')
@@ -0,0 +1,197 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  sequencer.py
+
+from app.models.base import buffered_writes
+from app.models.data import Block, BlockTotal, Extrinsic, Event, AccountAudit, AccountIndexAudit, IdentityAudit, \
+    IdentityJudgementAudit, AccountInfoSnapshot
+
+
+class ChainNotAtGenesis(Exception):
+    pass
+
+
+class SequencerState(object):
+    """
+    Column values of the last sequenced Block and BlockTotal, which the sequencing hooks of the next block receive as
+    `parent_block_data` and `parent_sequenced_block_data`. Carried from block to block in memory, so the DB is only
+    read when the sequencer starts.
+    """
+
+    def __init__(self, parent_block_data=None, parent_sequenced_block_data=None):
+        self.parent_block_data = parent_block_data
+        self.parent_sequenced_block_data = parent_sequenced_block_data
+
+    @classmethod
+    def load(cls, session, block_id):
+        block = Block.query(session).get(block_id)
+        sequenced_block = BlockTotal.query(session).get(block_id)
+
+        return cls(
+            parent_block_data=block.get_column_values() if block else None,
+            parent_sequenced_block_data=sequenced_block.get_column_values() if sequenced_block else None
+        )
+
+    def advance(self, block, sequenced_block):
+        # Values are taken before the window is committed, which would expire the objects
+        self.parent_block_data = block.get_column_values()
+        self.parent_sequenced_block_data = sequenced_block.get_column_values()
+
+
+class SequencerWindow(object):
+    """
+    Rows read by the sequencing hooks, loaded for a whole window of blocks with one range query per table and
+    grouped by block_id. Only blocks passed to `load` are covered; for any other block the hooks query as usual.
+    """
+
+    # Model class and column to order the rows of a block by
+    models = (
+        (Extrinsic, 'extrinsic_idx'),
+        (Event, 'event_idx'),
+        (AccountAudit, 'event_idx'),
+        (AccountIndexAudit, 'event_idx'),
+        (IdentityAudit, 'event_idx'),
+        (IdentityJudgementAudit, 'event_idx'),
+        (AccountInfoSnapshot, 'account_id'),
+    )
+
+    def __init__(self, block_ids):
+        self.block_ids = set(block_ids)
+        self.rows = {}
+
+    @classmethod
+    def load(cls, session, block_ids):
+        window = cls(block_ids)
+
+        if window.block_ids:
+            block_from = min(window.block_ids)
+            block_to = max(window.block_ids)
+
+            for model_class, order_by in cls.models:
+                rows = window.rows[model_class] = {}
+                for item in model_class.query(session).filter(
+                        model_class.block_id.between(block_from, block_to)
+                ).order_by(model_class.block_id, getattr(model_class, order_by)):
+                    rows.setdefault(item.block_id, []).append(item)
+
+        return window
+
+    def contains(self, model_class, block_id):
+        return block_id in self.block_ids and model_class in self.rows
+
+    def get(self, model_class, block_id):
+        return self.rows[model_class].get(block_id, [])
+
+
+class Sequencer(object):
+    """
+    Sequences the blocks above the sequencer head up to the integrity head in windows of `window_size` blocks.
+
+    Each window is sequenced in one transaction and its BlockTotal rows are inserted in bulk. When a block fails, the
+    failing window is rolled back so its processor changes are never committed without its BlockTotal rows; windows
+    sequenced before were committed already, and the next run resumes after the last of them.
+    """
+
+    def __init__(self, db_session, sequence_block, get_genesis_block, window_size):
+        """
+        :param db_session:
+        :param sequence_block: called with `(block, parent_block_data, parent_sequenced_block_data, window=window)`,
+        returns the BlockTotal of the block
+        :param get_genesis_block: called when block 0 is sequenced, returns the genesis Block or None
+        :param window_size:
+        """
+        self.db_session = db_session
+        self.sequence_block = sequence_block
+        self.get_genesis_block = get_genesis_block
+        self.window_size = window_size
+
+    def get_windows(self, sequencer_head, integrity_head):
+        """
+        First and last block id of each window between the sequencer head and the integrity head, both inclusive
+        :param sequencer_head: id of the last sequenced block, -1 when no block is sequenced yet
+        :param integrity_head:
+        :return:
+        """
+        for window_start in range(sequencer_head + 1, integrity_head + 1, self.window_size):
+            yield window_start, min(window_start + self.window_size, integrity_head + 1) - 1
+
+    def run(self, sequencer_head, integrity_head):
+        """
+        Sequences the blocks after `sequencer_head` up to `integrity_head`, until the first block that is missing
+        :param sequencer_head: id of the last sequenced block, -1 when no block is sequenced yet
+        :param integrity_head:
+        :return: id of the last sequenced block, or None when no block was sequenced
+        """
+        state = SequencerState.load(self.db_session, sequencer_head)
+        last_block_id = None
+
+        try:
+            for window_start, window_end in self.get_windows(sequencer_head, integrity_head):
+
+                blocks = {
+                    block.id: block for block in Block.query(self.db_session).filter(
+                        Block.id.between(window_start, window_end)
+                    )
+                }
+
+                # Rows read by the sequencing hooks are loaded for the whole window at once
+                window = SequencerWindow.load(self.db_session, blocks.keys())
+                window_head = None
+
+                # Window starts above the sequencer head, so there are no existing BlockTotal rows to remove
+                with buffered_writes(self.db_session, (BlockTotal,)):
+                    for block_nr in range(window_start, window_end + 1):
+
+                        if block_nr == 0:
+                            # No block ever sequenced, check if chain is at genesis state
+                            assert (not state.parent_sequenced_block_data)
+
+                            block = self.get_genesis_block()
+
+                            if not block or block.id != 0:
+                                raise ChainNotAtGenesis()
+                        else:
+                            assert (state.parent_sequenced_block_data['id'] + 1 == block_nr)
+
+                            block = blocks.get(block_nr)
+
+                            if not block:
+                                break
+
+                        sequenced_block = self.sequence_block(
+                            block, state.parent_block_data, state.parent_sequenced_block_data, window=window
+                        )
+
+                        state.advance(block, sequenced_block)
+                        window_head = block_nr
+
+                self.db_session.commit()
+
+                if window_head is not None:
+                    last_block_id = window_head
+
+                if window_head != window_end:
+                    # Block missing, sequencing continues when it is stored
+                    break
+
+        except Exception:
+            self.db_session.rollback()
+            raise
+
+        return last_block_id
@@ -18,17 +18,116 @@
 #
 #  base.py
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from dictalchemy import DictableModel
+from sqlalchemy import inspect
 from sqlalchemy.ext.declarative import declarative_base
 
 
+class WriteBuffer(object):
+    """
+    Collects new model objects instead of flushing them one by one, and writes them with a single multi-row
+    INSERT per table when flushed. Only transient objects of the given model classes are accepted; everything
+    else is saved as usual by `BaseModelObj.save`.
+    """
+
+    def __init__(self, model_classes):
+        self.model_classes = tuple(model_classes)
+        self.objects = OrderedDict()
+        self.object_ids = set()
+
+    def accepts(self, model):
+        return isinstance(model, self.model_classes) and inspect(model).transient
+
+    def add(self, model):
+        if id(model) not in self.object_ids:
+            self.object_ids.add(id(model))
+            self.objects.setdefault(model.__class__, []).append(model)
+
+    def get(self, model_class):
+        return self.objects.get(model_class, [])
+
+    def flush(self, session):
+        # Pending ORM changes (e.g. deletes of rows that are inserted again) have to be executed first
+        session.flush()
+
+        for model_class, models in self.objects.items():
+            # Rows are grouped by their set of columns, as each INSERT is executed as one executemany
+            statements = OrderedDict()
+            for model in models:
+                values = model.get_insert_values()
+                statements.setdefault(tuple(values.keys()), []).append(values)
+
+            for rows in statements.values():
+                session.execute(model_class.__table__.insert(), rows)
+
+        self.clear()
+
+    def clear(self):
+        self.objects.clear()
+        self.object_ids.clear()
+
+    def __len__(self):
+        return len(self.object_ids)
+
+
+@contextmanager
+def buffered_writes(session, model_classes):
+    """
+    Route `save()` calls of new objects of given model classes through a WriteBuffer, which is written with one
+    INSERT per table when the context exits without errors
+    :param session:
+    :param model_classes:
+    :return:
+    """
+    write_buffer = WriteBuffer(model_classes)
+    previous_write_buffer = session.info.get('write_buffer')
+    session.info['write_buffer'] = write_buffer
+    try:
+        yield write_buffer
+        write_buffer.flush(session)
+    finally:
+        if previous_write_buffer is None:
+            session.info.pop('write_buffer', None)
+        else:
+            session.info['write_buffer'] = previous_write_buffer
+
+
 class BaseModelObj(DictableModel):
 
     serialize_exclude = None
 
     def save(self, session):
-        session.add(self)
-        session.flush()
+        write_buffer = session.info.get('write_buffer')
+
+        if write_buffer is not None and write_buffer.accepts(self):
+            write_buffer.add(self)
+        else:
+            session.add(self)
+            session.flush()
+
+    def get_insert_values(self):
+        # Columns without a value are left out, so the database or the column default fills them in like when the
+        # object is saved through the ORM; an explicit None would store the JSON 'null' in JSON columns
+        values = {}
+        for column_property in inspect(self.__class__).column_attrs:
+            value = getattr(self, column_property.key)
+
+            if value is not None:
+                values[column_property.columns[0].key] = value
+        return values
+
+    def get_column_values(self):
+        # Lightweight alternative for asdict(), only reads the mapped columns; deferred columns that are not loaded
+        # are left out instead of being loaded
+        unloaded = inspect(self).unloaded
+        return {
+            column_property.key: getattr(self, column_property.key)
+            for column_property in inspect(self.__class__).column_attrs
+            if not (column_property.deferred and column_property.key in unloaded)
+        }
 
     @property
     def serialize_type(self):
@@ -48,6 +147,11 @@ class BaseModelObj(DictableModel):
     def query(cls, session):
         return session.query(cls)
 
+    @classmethod
+    def exists(cls, session, **kwargs):
+        # Existence check that doesn't load any columns of the matching row
+        return session.query(session.query(cls).filter_by(**kwargs).exists()).scalar()
+
 
 BaseModel = declarative_base(cls=BaseModelObj)  ## type: BaseModelObj
 
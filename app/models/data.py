@@ -20,8 +20,9 @@
 
 import sqlalchemy as sa
 from sqlalchemy import text, UniqueConstraint
+from sqlalchemy.dialects import mysql
 from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 
 from app.models.base import BaseModel
 
@@ -71,11 +72,11 @@ class Block(BaseModel):
     full_week = sa.Column(sa.Integer(), nullable=True)
     full_day = sa.Column(sa.Integer(), nullable=True)
     full_hour = sa.Column(sa.Integer(), nullable=True)
-    logs = sa.Column(sa.JSON(), default=None, server_default=None)
+    logs = deferred(sa.Column(sa.JSON(), default=None, server_default=None))
     authority_index = sa.Column(sa.Integer(), nullable=True)
     slot_number = sa.Column(sa.Numeric(precision=65, scale=0), nullable=True)
     spec_version_id = sa.Column(sa.String(64), nullable=False)
-    debug_info = sa.Column(sa.JSON(), default=None, server_default=None)
+    debug_info = deferred(sa.Column(sa.JSON(), default=None, server_default=None))
 
     def set_datetime(self, datetime):
         self.datetime = datetime
@@ -99,41 +100,118 @@ class Block(BaseModel):
 
     @classmethod
     def get_missing_block_ids(cls, session):
-        # return session.execute(text("""
-        #                                     SELECT
-        #                                       z.expected as block_from, z.got-1 as block_to
-        #                                     FROM (
-        #                                      SELECT
-        #                                       @rownum:=@rownum+1 AS expected,
-        #                                       IF(@rownum=id, 0, @rownum:=id) AS got
-        #                                      FROM
-        #                                       (SELECT @rownum:=0) AS a
-        #                                       JOIN data_block
-        #                                       ORDER BY id
-        #                                      ) AS z
-        #                                     WHERE z.got!=0
-        #                                     ORDER BY block_from DESC
-        #                                     """)
-        #                        )
+        # Gaps between the contiguous ranges of harvested blocks, see BlockRange, including the gap from block 0 to
+        # the lowest harvested block
         return session.execute(text("""
-                                                    SELECT
-                                                      z.expected as block_from, z.got-1 as block_to
+                                                    SELECT block_from, block_to
                                                     FROM (
                                                      SELECT
-                                                      @rownum:=@rownum+1 AS expected,
-                                                      IF(@rownum=id, 0, @rownum:=id) AS got
-                                                     FROM
-                                                      (SELECT @rownum:=6289000) AS a
-                                                      JOIN data_block
-                                                      WHERE data_block.id > 6289000
-                                                      ORDER BY id
+                                                      COALESCE(MAX(block_to) OVER (
+                                                       ORDER BY block_from ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                                                      ) + 1, 0) AS block_from,
+                                                      block_from - 1 AS block_to
+                                                     FROM data_block_range
                                                      ) AS z
-                                                    WHERE z.got!=0
+                                                    WHERE z.block_from <= z.block_to
                                                     ORDER BY block_from DESC
                                                     """)
                                )
 
 
+class BlockRange(BaseModel):
+    """
+    Contiguous ranges of harvested blocks, maintained when blocks are added or removed. Concurrent workers can leave
+    adjacent or overlapping ranges, which are merged by `compact`.
+    """
+    __tablename__ = 'data_block_range'
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=True)
+    block_from = sa.Column(sa.Integer(), nullable=False, index=True)
+    block_to = sa.Column(sa.Integer(), nullable=False, index=True)
+
+    @classmethod
+    def add_block_id(cls, session, block_id):
+        table = cls.__table__
+
+        # Extend the range directly above or below, the common cases when accumulating downwards or at the chain head
+        if session.execute(
+                table.update().where(table.c.block_from == block_id + 1).values(block_from=block_id)
+        ).rowcount > 0:
+            return
+
+        if session.execute(
+                table.update().where(table.c.block_to == block_id - 1).values(block_to=block_id)
+        ).rowcount > 0:
+            return
+
+        session.execute(table.insert().values(block_from=block_id, block_to=block_id))
+
+    @classmethod
+    def remove_block_id(cls, session, block_id):
+        for block_range in session.query(cls).filter(
+                cls.block_from <= block_id, cls.block_to >= block_id
+        ).with_for_update():
+            if block_range.block_from == block_range.block_to:
+                session.delete(block_range)
+            elif block_range.block_from == block_id:
+                block_range.block_from = block_id + 1
+            elif block_range.block_to == block_id:
+                block_range.block_to = block_id - 1
+            else:
+                # Split range
+                cls(block_from=block_id + 1, block_to=block_range.block_to).save(session)
+                block_range.block_to = block_id - 1
+
+        session.flush()
+
+    @classmethod
+    def get_merge_groups(cls, block_ranges):
+        """
+        Groups the ids of adjacent or overlapping ranges, given a list of (id, block_from, block_to) ordered by
+        block_from; ranges that don't have to be merged are left out
+        """
+        merge_groups = []
+        group = []
+        group_block_to = None
+
+        for block_range_id, block_from, block_to in block_ranges:
+            if group and block_from <= group_block_to + 1:
+                group.append(block_range_id)
+                group_block_to = max(group_block_to, block_to)
+            else:
+                if len(group) > 1:
+                    merge_groups.append(group)
+                group = [block_range_id]
+                group_block_to = block_to
+
+        if len(group) > 1:
+            merge_groups.append(group)
+
+        return merge_groups
+
+    @classmethod
+    def compact(cls, session):
+        # Find the ranges to merge without locking, so only those are locked and blocks can be added to other ranges
+        # meanwhile
+        merge_groups = cls.get_merge_groups(
+            session.query(cls.id, cls.block_from, cls.block_to).order_by(cls.block_from).all()
+        )
+
+        for merge_group in merge_groups:
+            # Ranges may have changed since they were read, so these are checked again once locked
+            previous_range = None
+            for block_range in session.query(cls).filter(cls.id.in_(merge_group)).order_by(
+                    cls.block_from
+            ).with_for_update():
+                if previous_range and block_range.block_from <= previous_range.block_to + 1:
+                    previous_range.block_to = max(previous_range.block_to, block_range.block_to)
+                    session.delete(block_range)
+                else:
+                    previous_range = block_range
+
+        session.flush()
+
+
 class BlockTotal(BaseModel):
     __tablename__ = 'data_block_total'
 
@@ -295,6 +373,55 @@ class Account(BaseModel):
     created_at_block = sa.Column(sa.Integer(), nullable=False)
     updated_at_block = sa.Column(sa.Integer(), nullable=False)
 
+    @classmethod
+    def update_balances(cls, session, full=False, chunk_size=1000):
+        """
+        Sets the balances of accounts according to their most recent AccountInfoSnapshot. Only accounts marked in
+        AccountBalanceChange are updated, unless `full` is set; markers are taken in chunks of `chunk_size` accounts
+        and locked until the transaction ends, so a marker written concurrently is not removed before it is applied
+        :param session:
+        :param full:
+        :param chunk_size:
+        :return:
+        """
+        if full:
+            session.query(AccountBalanceChange).delete(synchronize_session=False)
+            session.execute(cls.get_update_balances_statement())
+            return
+
+        while True:
+            account_ids = [row.account_id for row in session.query(AccountBalanceChange.account_id).order_by(
+                AccountBalanceChange.account_id
+            ).limit(chunk_size).with_for_update()]
+
+            if not account_ids:
+                return
+
+            session.execute(cls.get_update_balances_statement().where(cls.__table__.c.id.in_(account_ids)))
+            session.query(AccountBalanceChange).filter(AccountBalanceChange.account_id.in_(account_ids)).delete(
+                synchronize_session=False
+            )
+
+            if len(account_ids) < chunk_size:
+                return
+
+    @classmethod
+    def get_update_balances_statement(cls):
+        account = cls.__table__
+        snapshot = AccountInfoSnapshot.__table__
+
+        def latest_snapshot_value(column):
+            return sa.select(column).where(snapshot.c.account_id == account.c.id).order_by(
+                snapshot.c.block_id.desc()
+            ).limit(1).scalar_subquery()
+
+        return account.update().values(
+            balance_total=latest_snapshot_value(snapshot.c.balance_total),
+            balance_free=latest_snapshot_value(snapshot.c.balance_free),
+            balance_reserved=latest_snapshot_value(snapshot.c.balance_reserved),
+            nonce=latest_snapshot_value(snapshot.c.nonce)
+        ).where(sa.exists().where(snapshot.c.account_id == account.c.id))
+
 
 class AccountAudit(BaseModel):
     __tablename__ = 'data_account_audit'
@@ -320,6 +447,43 @@ class AccountInfoSnapshot(BaseModel):
     nonce = sa.Column(sa.Integer(), nullable=True)
     account_info = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
 
+    @classmethod
+    def upsert(cls, session, rows):
+        # Write snapshots in one multi-row statement, replacing snapshots of the same block and account
+        if not rows:
+            return
+
+        stmt = mysql.insert(cls.__table__).values(rows)
+        session.execute(stmt.on_duplicate_key_update(
+            balance_total=stmt.inserted.balance_total,
+            balance_free=stmt.inserted.balance_free,
+            balance_reserved=stmt.inserted.balance_reserved,
+            nonce=stmt.inserted.nonce,
+            account_info=stmt.inserted.account_info
+        ))
+
+        AccountBalanceChange.add(session, [row['account_id'] for row in rows])
+
+
+class AccountBalanceChange(BaseModel):
+    """
+    Accounts with snapshots that are not yet applied to their balances. Written in the same transaction as the
+    snapshots, so snapshots committed out of block order (e.g. by backfill workers) are picked up as well.
+    """
+    __tablename__ = 'data_account_balance_change'
+
+    account_id = sa.Column(sa.String(64), primary_key=True)
+
+    @classmethod
+    def add(cls, session, account_ids):
+        if not account_ids:
+            return
+
+        session.execute(
+            cls.__table__.insert().prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite'),
+            [{'account_id': account_id} for account_id in set(account_ids)]
+        )
+
 
 class Session(BaseModel):
     __tablename__ = 'data_session'
@@ -422,8 +586,8 @@ class Runtime(BaseModel):
     spec_name = sa.Column(sa.String(255))
     authoring_version = sa.Column(sa.Integer())
     apis = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
-    json_metadata = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
-    json_metadata_decoded = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
+    json_metadata = deferred(sa.Column(sa.JSON(), default=None, server_default=None, nullable=True))
+    json_metadata_decoded = deferred(sa.Column(sa.JSON(), default=None, server_default=None, nullable=True))
     count_modules = sa.Column(sa.Integer(), default=0, nullable=False)
     count_call_functions = sa.Column(sa.Integer(), default=0, nullable=False)
     count_storage_functions = sa.Column(sa.Integer(), default=0, nullable=False)
@@ -435,6 +599,25 @@ class Runtime(BaseModel):
         return self.spec_version
 
 
+class RuntimeVersionRange(BaseModel):
+    __tablename__ = 'runtime_version_range'
+
+    spec_version = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    block_from = sa.Column(sa.Integer(), nullable=False, index=True)
+    block_to = sa.Column(sa.Integer(), nullable=False)
+
+    @classmethod
+    def extend(cls, session, spec_version, block_from, block_to):
+        # Widen the known range of spec version in a single statement, as multiple workers can do this concurrently
+        stmt = mysql.insert(cls.__table__).values(
+            spec_version=spec_version, block_from=block_from, block_to=block_to
+        )
+        session.execute(stmt.on_duplicate_key_update(
+            block_from=sa.func.least(cls.__table__.c.block_from, stmt.inserted.block_from),
+            block_to=sa.func.greatest(cls.__table__.c.block_to, stmt.inserted.block_to)
+        ))
+
+
 class RuntimeModule(BaseModel):
     __tablename__ = 'runtime_module'
     __table_args__ = (sa.UniqueConstraint('spec_version', 'module_id'),)
@@ -651,11 +834,11 @@ class ReorgBlock(BaseModel):
     full_week = sa.Column(sa.Integer(), nullable=True)
     full_day = sa.Column(sa.Integer(), nullable=True)
     full_hour = sa.Column(sa.Integer(), nullable=True)
-    logs = sa.Column(sa.JSON(), default=None, server_default=None)
+    logs = deferred(sa.Column(sa.JSON(), default=None, server_default=None))
     authority_index = sa.Column(sa.Integer(), nullable=True)
     slot_number = sa.Column(sa.Numeric(precision=65, scale=0), nullable=True)
     spec_version_id = sa.Column(sa.String(64), nullable=False)
-    debug_info = sa.Column(sa.JSON(), default=None, server_default=None)
+    debug_info = deferred(sa.Column(sa.JSON(), default=None, server_default=None))
 
 
 class ReorgEvent(BaseModel):
@@ -19,7 +19,7 @@
 #  harvester.py
 #
 from app.models.base import BaseModel, BaseModelObj
-from datetime import datetime
+from datetime import datetime, timedelta
 import sqlalchemy as sa
 
 
@@ -42,6 +42,16 @@ class Status(BaseModel):
 
         return model
 
+    @classmethod
+    def get_locked_status(cls, session, key):
+        # Locks the status row until the transaction ends, for read-modify-write updates by concurrent tasks
+        model = session.query(cls).filter_by(key=key).with_for_update().first()
+
+        if not model:
+            return Status(key=key)
+
+        return model
+
     @classmethod
     def diff_second(cls, old_time_str):
         old_time = datetime.strptime(old_time_str, "%Y-%m-%d %H:%M:%S")
@@ -66,3 +76,153 @@ class Setting(BaseModel):
     key = sa.Column(sa.String(64), primary_key=True)
     value = sa.Column(sa.String(255))
     notes = sa.Column(sa.String(255))
+
+
+class BackfillUnit(BaseModel):
+    __tablename__ = 'harvester_backfill_unit'
+
+    STATUS_PENDING = 'pending'
+    STATUS_LEASED = 'leased'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    # Kind of work done for the blocks of a unit
+    JOB_ACCUMULATE = 'accumulate'
+    JOB_SEARCH_INDEX = 'search_index'
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=True)
+    job = sa.Column(sa.String(20), nullable=False, default=JOB_ACCUMULATE, server_default=JOB_ACCUMULATE, index=True)
+    block_from = sa.Column(sa.Integer(), nullable=False)
+    block_to = sa.Column(sa.Integer(), nullable=False, index=True)
+    status = sa.Column(sa.String(10), nullable=False, index=True)
+    attempts = sa.Column(sa.Integer(), nullable=False, default=0)
+    worker = sa.Column(sa.String(64))
+    lease_expires = sa.Column(sa.DateTime(timezone=True))
+    heartbeat = sa.Column(sa.DateTime(timezone=True))
+    error = sa.Column(sa.String(255))
+    failed_at = sa.Column(sa.DateTime(timezone=True))
+    # Failed units are leased again from this time on
+    retry_at = sa.Column(sa.DateTime(timezone=True))
+
+    @classmethod
+    def schedule(cls, session, block_from, block_to, unit_size, job=JOB_ACCUMULATE):
+        """
+        Creates pending units of at most `unit_size` blocks for the part of given range that is not already covered
+        by a pending, leased or failed unit of the same job
+
+        :return: number of created units
+        """
+        active_units = session.query(cls.block_from, cls.block_to).filter(
+            cls.job == job,
+            cls.status.in_([cls.STATUS_PENDING, cls.STATUS_LEASED, cls.STATUS_FAILED]),
+            cls.block_to >= block_from,
+            cls.block_from <= block_to
+        ).order_by(cls.block_from)
+
+        uncovered_ranges = []
+        for unit_from, unit_to in active_units:
+            if unit_from > block_from:
+                uncovered_ranges.append((block_from, unit_from - 1))
+            block_from = max(block_from, unit_to + 1)
+
+        if block_from <= block_to:
+            uncovered_ranges.append((block_from, block_to))
+
+        count = 0
+        for range_from, range_to in uncovered_ranges:
+            for unit_from in range(range_from, range_to + 1, unit_size):
+                cls(
+                    job=job,
+                    block_from=unit_from,
+                    block_to=min(unit_from + unit_size - 1, range_to),
+                    status=cls.STATUS_PENDING,
+                    attempts=0
+                ).save(session)
+                count += 1
+
+        return count
+
+    @classmethod
+    def count_leased(cls, session, job=JOB_ACCUMULATE):
+        return session.query(cls).filter(
+            cls.job == job, cls.status == cls.STATUS_LEASED, cls.lease_expires >= datetime.now()
+        ).count()
+
+    @classmethod
+    def get_progress(cls, session, job):
+        # Number of units and blocks per status
+        return {
+            status: {'units': units, 'blocks': int(blocks or 0)}
+            for status, units, blocks in session.query(
+                cls.status, sa.func.count(cls.id), sa.func.sum(cls.block_to - cls.block_from + 1)
+            ).filter(cls.job == job).group_by(cls.status)
+        }
+
+    @classmethod
+    def lease(cls, session, worker, lease_seconds, max_attempts, retry_seconds, retry_max_seconds,
+              job=JOB_ACCUMULATE):
+        """
+        Leases the highest pending unit, a leased unit of which the lease expired (e.g. the worker crashed) or a
+        failed unit of which the retry backoff passed. Locked rows are skipped, so concurrent workers never wait for or
+        lease the same unit. A unit of which `max_attempts` leases expired is failed instead, so a unit that crashes
+        its worker is retried with backoff as well.
+        """
+        now = datetime.now()
+
+        unit = session.query(cls).filter(cls.job == job, sa.or_(
+            cls.status == cls.STATUS_PENDING,
+            sa.and_(cls.status == cls.STATUS_LEASED, cls.lease_expires < now),
+            sa.and_(cls.status == cls.STATUS_FAILED, cls.retry_at <= now)
+        )).order_by(cls.block_to.desc()).with_for_update(skip_locked=True).first()
+
+        if unit and unit.status == cls.STATUS_LEASED and unit.attempts >= max_attempts:
+            unit.fail(
+                session, 'Lease expired after {} attempts'.format(unit.attempts), retry_seconds, retry_max_seconds
+            )
+            session.commit()
+
+            return cls.lease(session, worker, lease_seconds, max_attempts, retry_seconds, retry_max_seconds, job=job)
+
+        if unit:
+            unit.status = cls.STATUS_LEASED
+            unit.worker = worker
+            unit.attempts += 1
+            unit.heartbeat = now
+            unit.lease_expires = now + timedelta(seconds=lease_seconds)
+            unit.save(session)
+
+        session.commit()
+
+        return unit
+
+    def finish(self, session):
+        """
+        Removes a finished accumulate unit, as the harvested blocks are tracked by BlockRange. Units of other jobs are
+        marked done and kept for the progress report, until the job is scheduled again.
+        """
+        if self.job == self.JOB_ACCUMULATE:
+            session.delete(self)
+            session.flush()
+        else:
+            self.status = self.STATUS_DONE
+            self.lease_expires = None
+            self.save(session)
+
+    def fail(self, session, error, retry_seconds, retry_max_seconds):
+        """
+        Marks the unit failed, it is leased again after a backoff of `retry_seconds` that doubles with every attempt,
+        up to `retry_max_seconds`
+        """
+        self.status = self.STATUS_FAILED
+        self.error = error[:255]
+        self.failed_at = datetime.now()
+        self.retry_at = self.failed_at + timedelta(seconds=min(
+            retry_seconds * 2 ** max(self.attempts - 1, 0), retry_max_seconds
+        ))
+        self.lease_expires = None
+        self.save(session)
+
+    def renew(self, session, lease_seconds):
+        self.heartbeat = datetime.now()
+        self.lease_expires = self.heartbeat + timedelta(seconds=lease_seconds)
+        self.save(session)
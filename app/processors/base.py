@@ -35,8 +35,16 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+# Shared result for the common case of an event or extrinsic without processors
+NO_PROCESSORS = ()
+
+
 class ProcessorRegistry(metaclass=Singleton):
-    registry = {'event': {}, 'extrinsic': {}, 'block': []}
+    """
+    Dispatch tables of processor classes, built once per process. Keys are (module_id, event_id) and
+    (module_id, call_id) tuples with a lowercase module_id; lookups by the module_id as found on chain are memoised,
+    so the key is normalised only once per distinct event or call.
+    """
 
     @classmethod
     def all_subclasses(cls, class_):
@@ -44,33 +52,43 @@ class ProcessorRegistry(metaclass=Singleton):
             [s for c in class_.__subclasses__() for s in cls.all_subclasses(c)])
 
     def __init__(self):
+        event_processors = {}
         for cls in self.all_subclasses(EventProcessor):
-            key = '{}-{}'.format(cls.module_id.lower(), cls.event_id)
-
-            if key not in self.registry['event']:
-                self.registry['event'][key] = []
-
-            self.registry['event'][key].append(cls)
+            event_processors.setdefault((cls.module_id.lower(), cls.event_id), []).append(cls)
 
+        extrinsic_processors = {}
         for cls in self.all_subclasses(ExtrinsicProcessor):
-            key = '{}-{}'.format(cls.module_id.lower(), cls.call_id)
+            extrinsic_processors.setdefault((cls.module_id.lower(), cls.call_id), []).append(cls)
 
-            if key not in self.registry['extrinsic']:
-                self.registry['extrinsic'][key] = []
+        self.event_processors = {key: tuple(classes) for key, classes in event_processors.items()}
+        self.extrinsic_processors = {key: tuple(classes) for key, classes in extrinsic_processors.items()}
+        self.block_processors = tuple(self.all_subclasses(BlockProcessor))
 
-            self.registry['extrinsic'][key].append(cls)
-
-        for cls in self.all_subclasses(BlockProcessor):
-            self.registry['block'].append(cls)
+        self.event_lookup = {}
+        self.extrinsic_lookup = {}
 
     def get_event_processors(self, module_id, event_id):
-        return self.registry['event'].get('{}-{}'.format(module_id.lower(), event_id), [])
+        key = (module_id, event_id)
+        try:
+            return self.event_lookup[key]
+        except KeyError:
+            processors = self.event_lookup[key] = self.event_processors.get(
+                (module_id.lower(), event_id), NO_PROCESSORS
+            )
+            return processors
 
     def get_extrinsic_processors(self, module_id, call_id):
-        return self.registry['extrinsic'].get('{}-{}'.format(module_id.lower(), call_id), [])
+        key = (module_id, call_id)
+        try:
+            return self.extrinsic_lookup[key]
+        except KeyError:
+            processors = self.extrinsic_lookup[key] = self.extrinsic_processors.get(
+                (module_id.lower(), call_id), NO_PROCESSORS
+            )
+            return processors
 
     def get_block_processors(self):
-        return self.registry['block']
+        return self.block_processors
 
 
 class Processor(object):
@@ -190,8 +208,29 @@ class ExtrinsicProcessor(Processor):
 
 class BlockProcessor(Processor):
 
-    def __init__(self, block: Block, sequenced_block: BlockTotal = None, substrate=None, harvester=None):
+    def __init__(self, block: Block, sequenced_block: BlockTotal = None, substrate=None, harvester=None,
+                 window=None):
         self.block = block
         self.sequenced_block = sequenced_block
         self.substrate = substrate
         self.harvester = harvester
+        self.window = window
+
+    def get_block_rows(self, db_session, model_class, order_by=None):
+        """
+        Returns the rows of given model class that belong to the current block. During sequencing these are taken
+        from the rows the sequencer preloaded for its window; otherwise they are queried
+        :param db_session:
+        :param model_class:
+        :param order_by:
+        :return:
+        """
+        if self.window is not None and self.window.contains(model_class, self.block.id):
+            return self.window.get(model_class, self.block.id)
+
+        query = model_class.query(db_session).filter_by(block_id=self.block.id)
+
+        if order_by:
+            query = query.order_by(order_by)
+
+        return query
@@ -21,7 +21,7 @@ class AccountBlockProcessor(BlockProcessor):
 
     def sequencing_hook(self, db_session, parent_block_data, parent_sequenced_block_data):
         print('### KAMI-DEBUG:sequencing_hook....')
-        for account_audit in AccountAudit.query(db_session).filter_by(block_id=self.block.id).order_by('event_idx'):
+        for account_audit in self.get_block_rows(db_session, AccountAudit, 'event_idx'):
             try:
                 account: Account = Account.query(db_session).filter_by(id=account_audit.account_id).one()
 
@@ -103,7 +103,7 @@ class AccountBlockProcessor(BlockProcessor):
             account_info_data_storage = utils.query_storage(pallet_name='System', storage_name='Account',
                                                             substrate=self.substrate,
                                                             params=['0x{}'.format(account.id)],
-                                                            block_hash=self.block.hash)
+                                                            block_hash=self.block.hash, block_id=self.block.id)
             if account_info_data_storage:
                 account_info_data = account_info_data_storage.value
                 account.balance_free = account_info_data["data"]["free"]
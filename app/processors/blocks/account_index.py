@@ -8,9 +8,7 @@ class AccountIndexBlockProcessor(BlockProcessor):
 
     def sequencing_hook(self, db_session, parent_block_data, parent_sequenced_block_data):
 
-        for account_index_audit in AccountIndexAudit.query(db_session).filter_by(
-                block_id=self.block.id
-        ).order_by('event_idx'):
+        for account_index_audit in self.get_block_rows(db_session, AccountIndexAudit, 'event_idx'):
 
             if account_index_audit.type_id == ACCOUNT_INDEX_AUDIT_TYPE_NEW:
 
@@ -19,17 +19,18 @@ class AccountInfoBlockProcessor(BlockProcessor):
                 update_balances_in_block(self.block.id)
         else:
             # Retrieve unique accounts in all searchindex records for current block
-            for search_index in db_session.query(distinct(SearchIndex.account_id)).filter_by(block_id=self.block.id):
-                self.harvester.create_balance_snapshot(
-                    block_id=self.block.id,
-                    block_hash=self.block.hash,
-                    account_id=search_index[0]
-                )
+            self.harvester.create_balance_snapshots(
+                block_id=self.block.id,
+                block_hash=self.block.hash,
+                account_ids=[search_index[0] for search_index in db_session.query(
+                    distinct(SearchIndex.account_id)
+                ).filter_by(block_id=self.block.id)]
+            )
 
     def sequencing_hook(self, db_session, parent_block, parent_sequenced_block):
         # Update Account according to AccountInfoSnapshot
 
-        for account_info in AccountInfoSnapshot.query(db_session).filter_by(block_id=self.block.id):
+        for account_info in self.get_block_rows(db_session, AccountInfoSnapshot):
             account = Account.query(db_session).get(account_info.account_id)
             if account:
                 account.balance_total = account_info.balance_total
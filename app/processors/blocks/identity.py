@@ -7,7 +7,7 @@ class IdentityBlockProcessor(BlockProcessor):
 
     def sequencing_hook(self, db_session, parent_block_data, parent_sequenced_block_data):
 
-        for identity_audit in IdentityAudit.query(db_session).filter_by(block_id=self.block.id).order_by('event_idx'):
+        for identity_audit in self.get_block_rows(db_session, IdentityAudit, 'event_idx'):
 
             account = Account.query(db_session).get(identity_audit.account_id)
 
@@ -6,7 +6,7 @@ from app.settings import IDENTITY_JUDGEMENT_TYPE_GIVEN
 class IdentityJudgementBlockProcessor(BlockProcessor):
 
     def sequencing_hook(self, db_session, parent_block_data, parent_sequenced_block_data):
-        audits = IdentityJudgementAudit.query(db_session).filter_by(block_id=self.block.id).order_by('event_idx')
+        audits = self.get_block_rows(db_session, IdentityJudgementAudit, 'event_idx')
         for identity_audit in audits:
 
             if identity_audit.type_id == IDENTITY_JUDGEMENT_TYPE_GIVEN:
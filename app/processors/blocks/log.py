@@ -1,3 +1,4 @@
+from app.extend.decoder import get_log_record
 from app.models.data import Log
 from app.processors.base import BlockProcessor
 from scalecodec.base import ScaleBytes
@@ -6,72 +7,27 @@ from scalecodec.base import ScaleBytes
 class LogBlockProcessor(BlockProcessor):
 
     def accumulation_hook(self, db_session):
-        log_digest_cls = self.substrate.runtime_config.get_decoder_class('sp_runtime::generic::digest::DigestItem')
+        # Logs are decoded already when the block was decoded into records, see `decode_block_records`
+        log_records = getattr(self.block, '_log_records', None)
 
-        if log_digest_cls is None:
-            raise NotImplementedError("No decoding class found for 'DigestItem'")
+        if log_records is None:
+            log_digest_cls = self.substrate.runtime_config.get_decoder_class('sp_runtime::generic::digest::DigestItem')
 
-        self.block.count_log = len(self.block.logs)
-        for idx, log_data in enumerate(self.block.logs):
-            log_digest = log_digest_cls(data=ScaleBytes(log_data))
-            log_digest.decode()
-
-            log_type = log_digest.value_object[0]  # ('PreRuntime', GenericPreRuntime)
-            # print(log_digest.value[log_type])
-            log_inner_data = {}
-            if ('PreRuntime' == log_type or 'Seal' == log_type) and self.substrate.implements_scaleinfo():
-                engine_id = bytes.fromhex(log_digest.value[log_type][0][2:]).decode('utf-8')
-                if engine_id == 'aura' and 'PreRuntime' == log_type:
-                    predigest_data = log_digest.value['PreRuntime'][1]
-                    try:
-                        if predigest_data[:2] != '0x':
-                            predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
-                        else:
-                            predigest_data = ScaleBytes(predigest_data)
-                    except ValueError:
-                        predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
-                    aura_predigest = self.substrate.runtime_config.create_scale_object(
-                        type_string='RawAuraPreDigest',
-                        # data=ScaleBytes(log_digest.value['PreRuntime'][1])
-                        data=predigest_data
-                    )
-                    aura_predigest.decode()
-                    slot_number = aura_predigest.value['slot_number']
-                    log_inner_data = {"data": {"slot_number": slot_number}, "engine": "aura"}
-                elif engine_id == 'aura' and 'Seal' == log_type:
-                    log_inner_data = {"data": log_digest.value['Seal'][1], "engine": "aura"}
+            if log_digest_cls is None:
+                raise NotImplementedError("No decoding class found for 'DigestItem'")
 
-                elif engine_id == 'BABE' and 'PreRuntime' == log_type:
-                    predigest_data = log_digest.value['PreRuntime'][1]
-                    try:
-                        if predigest_data[:2] != '0x':
-                            predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
-                        else:
-                            predigest_data = ScaleBytes(predigest_data)
-                    except ValueError:
-                        predigest_data = ScaleBytes(f"0x{predigest_data.encode().hex()}")
-                    babe_predigest = self.substrate.runtime_config.create_scale_object(
-                        type_string='RawBabePreDigest',
-                        # data=ScaleBytes(log_digest.value['PreRuntime'][1])
-                        data=predigest_data
-                    )
-                    babe_predigest.decode()
-                    rank_validator = babe_predigest[1].value['authority_index']
-                    slot_number = babe_predigest[1].value['slot_number']
-                    log_inner_data = {"data": {"slot_number": slot_number, "authority_index": rank_validator},
-                                      "engine": "BABE"}
-                elif engine_id == 'BABE' and 'Seal' == log_type:
-                    log_inner_data = {"data": log_digest.value['Seal'][1], "engine": "BABE"}
-            else:
-                if type(log_digest.value) == str:
-                    log_inner_data = log_digest.value
-                else:
-                    log_inner_data = log_digest.value[log_type]
+            log_records = []
+            for log_data in self.block.logs:
+                log_digest = log_digest_cls(data=ScaleBytes(log_data))
+                log_digest.decode()
+                log_records.append(get_log_record(self.substrate, log_digest))
 
+        self.block.count_log = len(self.block.logs)
+        for idx, (type_id, log_type, log_inner_data) in enumerate(log_records):
             log = Log(
                 block_id=self.block.id,
                 log_idx=idx,
-                type_id=log_digest.index,
+                type_id=type_id,
                 type=log_type,
                 data=log_inner_data,
             )
@@ -17,27 +17,37 @@
 #  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
 #
 #  converters.py
+import functools
+import itertools
 import json
 import logging
 import math
+import time
 import traceback
 from datetime import datetime
 
-from scalecodec.base import ScaleBytes, RuntimeConfiguration
+from scalecodec.base import ScaleBytes
 from scalecodec.exceptions import RemainingScaleBytesNotEmptyException
 from scalecodec.type_registry import load_type_registry_file
-from sqlalchemy import func, distinct
+from sqlalchemy import func, distinct, select, literal
 from sqlalchemy.exc import SQLAlchemyError
 from substrateinterface import logger
 from substrateinterface.exceptions import SubstrateRequestException
 from substrateinterface.utils.hasher import xxh128
 
 from app import settings, utils
-from app.extend.base import AresSubstrateInterface, CompatibleRuntimeConfiguration
+from app.extend.base import AresSubstrateInterface, CompatibleRuntimeConfiguration, create_block_data, \
+    SYSTEM_EVENTS_STORAGE_KEY
+from app.extend.cache import MetadataFileCache, KnownBlockHashes
+from app.extend.decoder import decode_block_records
+from app.extend.prefetch import StorageFetcher
+from app.extend.runtime import RuntimeVersionIndex
+from app.extend.sequencer import Sequencer, ChainNotAtGenesis
 from app.models.data import Extrinsic, Block, Event, Runtime, RuntimeModule, RuntimeCall, RuntimeCallParam, \
     RuntimeEvent, RuntimeEventAttribute, RuntimeType, RuntimeStorage, BlockTotal, RuntimeConstant, AccountAudit, \
     AccountIndexAudit, ReorgBlock, ReorgExtrinsic, ReorgEvent, ReorgLog, RuntimeErrorMessage, Account, \
-    AccountInfoSnapshot, SearchIndex, SymbolSnapshot
+    AccountInfoSnapshot, SearchIndex, SymbolSnapshot, IdentityAudit, IdentityJudgementAudit, BlockRange
+from app.models.base import buffered_writes
 from app.models.harvester import Status
 from app.processors import NewSessionEventProcessor, Log
 from app.processors.base import BaseService, ProcessorRegistry
@@ -50,6 +60,22 @@ if settings.DEBUG:
     logger.addHandler(ch)
 
 
+# Append-only rows created while accumulating a block; these are written in bulk instead of flushed per object
+ACCUMULATION_BUFFERED_MODELS = (
+    Event, Extrinsic, Log, SearchIndex, AccountAudit, AccountIndexAudit, IdentityAudit, IdentityJudgementAudit,
+    SymbolSnapshot
+)
+
+# Rows describing a new runtime, written in bulk when its metadata is stored
+RUNTIME_BUFFERED_MODELS = (
+    RuntimeModule, RuntimeCall, RuntimeCallParam, RuntimeEvent, RuntimeEventAttribute, RuntimeStorage,
+    RuntimeConstant, RuntimeErrorMessage, RuntimeType
+)
+
+# Bloom filter of stored block hashes, warmed once per worker process on first use
+known_block_hashes = None
+
+
 class HarvesterCouldNotAddBlock(Exception):
     pass
 
@@ -79,8 +105,17 @@ class PolkascanHarvesterService(BaseService):
             type_registry_preset=type_registry,
             runtime_config=CompatibleRuntimeConfiguration()
         )
+        if settings.METADATA_CACHE_DIR:
+            self.substrate.cache_region = MetadataFileCache(settings.METADATA_CACHE_DIR, self.substrate.runtime_config)
         print('RUN KAMI-DEBUG runtime-version:{}'.format(self.substrate.runtime_version))
         self.metadata_store = {}
+        self.runtime_index = RuntimeVersionIndex(db_session, self.substrate)
+        self.substrate.runtime_index = self.runtime_index
+        self.processor_registry = ProcessorRegistry()
+
+    def set_db_session(self, db_session):
+        self.db_session = db_session
+        self.runtime_index.db_session = db_session
 
     def process_genesis(self, block):
         self.substrate.init_runtime(block_hash=block.hash)
@@ -187,7 +222,7 @@ class PolkascanHarvesterService(BaseService):
         try:
             # Update sudo key
             sudo_key = utils.query_storage(pallet_name="Sudo", storage_name="Key", substrate=self.substrate,
-                                           block_hash=block.hash).value
+                                           block_hash=block.hash, block_id=block.id).value
             account_audit = AccountAudit(
                 account_id=sudo_key.replace('0x', ''),
                 block_id=block.id,
@@ -214,7 +249,7 @@ class PolkascanHarvesterService(BaseService):
         # Retrieve technical committee members
         members = utils.query_storage(pallet_name="TechnicalCommittee", storage_name="Members",
                                       substrate=self.substrate,
-                                      block_hash=block.hash)
+                                      block_hash=block.hash, block_id=block.id)
 
         if members is not None:
             members = [v.replace('0x', '') for v in members.value]
@@ -235,9 +270,7 @@ class PolkascanHarvesterService(BaseService):
     def process_metadata(self, spec_version, block_hash):
         print('Kami Debug spec_version={}, block_hash={},'.format(spec_version, block_hash))
         # Check if metadata already stored
-        runtime = Runtime.query(self.db_session).get(spec_version)
-
-        if runtime:
+        if Runtime.exists(self.db_session, id=spec_version):
 
             if spec_version in self.substrate.metadata_cache:
                 self.metadata_store[spec_version] = self.substrate.metadata_cache[spec_version]
@@ -281,205 +314,8 @@ class PolkascanHarvesterService(BaseService):
 
                 print('store version to db', spec_version)
 
-                for module_index, module in enumerate(modules):
-
-                    if hasattr(module, 'index'):
-                        module_index = module.index
-
-                    # Check if module exists
-                    if RuntimeModule.query(self.db_session).filter_by(
-                            spec_version=spec_version,
-                            module_id=module.get_identifier()
-                    ).count() == 0:
-                        module_id = module.get_identifier()
-                    else:
-                        module_id = '{}_1'.format(module.get_identifier())
-
-                    # Storage backwards compt check
-                    if module.storage and isinstance(module.storage, list):
-                        storage_functions = module.storage
-                    elif module.storage and isinstance(getattr(module.storage, 'value'), dict):
-                        storage_functions = module.storage.items
-                    else:
-                        storage_functions = []
-
-                    if len(storage_functions) > 0:
-                        prefix = module.value.get('storage').get('prefix')
-                    else:
-                        prefix = None
-
-                    runtime_module = RuntimeModule(
-                        spec_version=spec_version,
-                        module_id=module_id,
-                        prefix=prefix,
-                        name=module.name,
-                        count_call_functions=len(module.calls or []),
-                        count_storage_functions=len(storage_functions),
-                        count_events=len(module.events or []),
-                        count_constants=len(module.constants or []),
-                        count_errors=len(module.errors or []),
-                    )
-                    runtime_module.save(self.db_session)
-
-                    # Update totals in runtime
-                    runtime.count_call_functions += runtime_module.count_call_functions
-                    runtime.count_events += runtime_module.count_events
-                    runtime.count_storage_functions += runtime_module.count_storage_functions
-                    runtime.count_constants += runtime_module.count_constants
-                    runtime.count_errors += runtime_module.count_errors
-
-                    if len(module.calls or []) > 0:
-                        for idx, call in enumerate(module.calls):
-                            call.lookup = "{:02x}{:02x}".format(module_index, idx)
-                            runtime_call = RuntimeCall(
-                                spec_version=spec_version,
-                                module_id=module_id,
-                                # call_id=call.get_identifier(),
-                                call_id=call.name,
-                                index=idx,
-                                name=call.name,
-                                lookup=call.lookup,
-                                documentation='\n'.join(call.docs),
-                                count_params=len(call.args)
-                            )
-                            runtime_call.save(self.db_session)
-
-                            for arg in call.args:
-                                runtime_call_param = RuntimeCallParam(
-                                    runtime_call_id=runtime_call.id,
-                                    name=arg.name,
-                                    type=arg.type
-                                )
-                                runtime_call_param.save(self.db_session)
-
-                    if len(module.events or []) > 0:
-
-                        for event_index, event in enumerate(module.events):
-
-                            event.lookup = "{:02x}{:02x}".format(module_index, event_index)
-                            runtime_event = RuntimeEvent(
-                                spec_version=spec_version,
-                                module_id=module_id,
-                                event_id=event.name,
-                                index=event_index,
-                                name=event.name,
-                                lookup=event.lookup,
-                                documentation='\n'.join(event.docs),
-                                count_attributes=len(event.args)
-                            )
-                            runtime_event.save(self.db_session)
-
-                            for arg_index, arg in enumerate(event.args):
-                                runtime_event_attr = RuntimeEventAttribute(
-                                    runtime_event_id=runtime_event.id,
-                                    index=arg_index,
-                                    type=arg.value
-                                )
-                                runtime_event_attr.save(self.db_session)
-
-                    if len(storage_functions) > 0:
-                        for idx, storage in enumerate(storage_functions):
-                            types = storage.get_params_type_string()
-                            value_type = storage.get_value_type_string()
-                            hashers = storage.get_param_hashers()
-
-                            hasher_type1 = None
-                            hasher_type2 = None
-                            key_type1 = None
-                            key_type2 = None
-                            type_is_linked = None
-
-                            if len(hashers) == 1:
-                                hasher_type1 = hashers[0]
-                            elif len(hashers) == 2:
-                                hasher_type1 = hashers[0]
-                                hasher_type2 = hashers[1]
-
-                            if len(types) == 1:
-                                key_type1 = types[0]
-                            elif len(types) == 2:
-                                key_type1 = types[0]
-                                key_type2 = types[1]
-
-                            _prefix = module.value_object['storage'].value_object['prefix']
-                            runtime_storage = RuntimeStorage(
-                                spec_version=spec_version,
-                                module_id=module_id,
-                                index=idx,
-                                name=storage.name,
-                                lookup=None,
-                                default=storage.value.get('default'),
-                                modifier=storage.modifier,
-                                type_hasher=hasher_type1,
-                                storage_key=xxh128(_prefix.data.data) + xxh128(storage.name.encode()),
-                                type_key1=key_type1,
-                                type_key2=key_type2,
-                                type_value=value_type,
-                                type_is_linked=type_is_linked,
-                                type_key2hasher=hasher_type2
-                            )
-                            runtime_storage.save(self.db_session)
-
-                    if len(module.constants or []) > 0:
-                        for idx, constant in enumerate(module.constants):
-                            # Decode value
-                            try:
-                                constant_value = constant.value_object['value'].value_object
-                                decode_constant_type = constant.type if self.substrate.implements_scaleinfo() else constant.value.get(
-                                    "type")
-                                value_obj = self.substrate.runtime_config.create_scale_object(
-                                    decode_constant_type, data=ScaleBytes(constant_value)
-                                )
-                                value_obj.decode()
-                                constant_type = value_obj.type_name if self.substrate.implements_scaleinfo() and hasattr(
-                                    value_obj, "type_name") else constant.type
-                                value = value_obj.serialize()
-                            except ValueError:
-                                print("constant error:1, type:{}, name:{}", constant.type, constant.name)
-                                value = constant.value_object['value'].serialize()
-                            except RemainingScaleBytesNotEmptyException:
-                                print("constant error:2, type:{}, name:{}", constant.type, constant.name)
-                                value = constant.value_object['value'].serialize()
-                            except NotImplementedError:
-                                print("constant error:3, type:{}, name:{}", constant.type, constant.name)
-                                value = constant.value_object['value'].serialize()
-
-                            if type(value) is list or type(value) is dict:
-                                value = json.dumps(value)
-
-                            runtime_constant = RuntimeConstant(
-                                spec_version=spec_version,
-                                module_id=module_id,
-                                index=idx,
-                                name=constant.name,
-                                type=constant_type,
-                                value=value
-                            )
-                            runtime_constant.save(self.db_session)
-
-                    if len(module.errors or []) > 0:
-                        for idx, error in enumerate(module.errors):
-                            runtime_error = RuntimeErrorMessage(
-                                spec_version=spec_version,
-                                module_id=module_id,
-                                module_index=module_index,
-                                index=idx,
-                                name=error.name
-                            )
-                            runtime_error.save(self.db_session)
-
-                    runtime.save(self.db_session)
-
-                # Process types
-                for runtime_type_data in list(self.substrate.get_type_registry(block_hash=block_hash).values()):
-                    runtime_type = RuntimeType(
-                        spec_version=runtime_type_data["spec_version"],
-                        type_string=runtime_type_data["type_string"],
-                        decoder_class=runtime_type_data["decoder_class"],
-                        is_primitive_core=runtime_type_data["is_primitive_core"],
-                        is_primitive_runtime=runtime_type_data["is_primitive_runtime"]
-                    )
-                    runtime_type.save(self.db_session)
+                with self.buffered_writes(RUNTIME_BUFFERED_MODELS):
+                    self.store_runtime_metadata(runtime, modules, block_hash)
 
                 savepoint.commit()
                 self.db_session.commit()
@@ -489,14 +325,279 @@ class PolkascanHarvesterService(BaseService):
                 print(e)
                 savepoint.rollback()
 
-    def add_block(self, block_hash):
+    def reserve_ids(self, model_class):
+        """
+        Returns the first free id of given model class. The end of the id range stays locked until the transaction
+        ends, so runtimes stored concurrently by other workers don't get the same ids
+        :param model_class:
+        :return:
+        """
+        return (self.db_session.query(func.max(model_class.id)).with_for_update().scalar() or 0) + 1
+
+    def store_runtime_metadata(self, runtime, modules, block_hash):
+        """
+        Creates the module, call, event, storage, constant, error and type rows of given runtime. Rows are meant to
+        be collected by a WriteBuffer, so ids that are referred to by other rows are assigned upfront instead of
+        flushing every row to get its id
+        :param runtime:
+        :param modules:
+        :param block_hash:
+        :return:
+        """
+        spec_version = runtime.id
+
+        runtime_call_ids = itertools.count(self.reserve_ids(RuntimeCall))
+        runtime_event_ids = itertools.count(self.reserve_ids(RuntimeEvent))
+        module_ids = set()
+
+        for module_index, module in enumerate(modules):
+
+            if hasattr(module, 'index'):
+                module_index = module.index
+
+            # Check if module exists
+            if module.get_identifier() not in module_ids:
+                module_id = module.get_identifier()
+            else:
+                module_id = '{}_1'.format(module.get_identifier())
+
+            module_ids.add(module_id)
+
+            # Storage backwards compt check
+            if module.storage and isinstance(module.storage, list):
+                storage_functions = module.storage
+            elif module.storage and isinstance(getattr(module.storage, 'value'), dict):
+                storage_functions = module.storage.items
+            else:
+                storage_functions = []
+
+            if len(storage_functions) > 0:
+                prefix = module.value.get('storage').get('prefix')
+            else:
+                prefix = None
+
+            runtime_module = RuntimeModule(
+                spec_version=spec_version,
+                module_id=module_id,
+                prefix=prefix,
+                name=module.name,
+                count_call_functions=len(module.calls or []),
+                count_storage_functions=len(storage_functions),
+                count_events=len(module.events or []),
+                count_constants=len(module.constants or []),
+                count_errors=len(module.errors or []),
+            )
+            runtime_module.save(self.db_session)
+
+            # Update totals in runtime
+            runtime.count_call_functions += runtime_module.count_call_functions
+            runtime.count_events += runtime_module.count_events
+            runtime.count_storage_functions += runtime_module.count_storage_functions
+            runtime.count_constants += runtime_module.count_constants
+            runtime.count_errors += runtime_module.count_errors
+
+            if len(module.calls or []) > 0:
+                for idx, call in enumerate(module.calls):
+                    call.lookup = "{:02x}{:02x}".format(module_index, idx)
+                    runtime_call = RuntimeCall(
+                        id=next(runtime_call_ids),
+                        spec_version=spec_version,
+                        module_id=module_id,
+                        # call_id=call.get_identifier(),
+                        call_id=call.name,
+                        index=idx,
+                        name=call.name,
+                        lookup=call.lookup,
+                        documentation='\n'.join(call.docs),
+                        count_params=len(call.args)
+                    )
+                    runtime_call.save(self.db_session)
+
+                    for arg in call.args:
+                        runtime_call_param = RuntimeCallParam(
+                            runtime_call_id=runtime_call.id,
+                            name=arg.name,
+                            type=arg.type
+                        )
+                        runtime_call_param.save(self.db_session)
+
+            if len(module.events or []) > 0:
 
+                for event_index, event in enumerate(module.events):
 
+                    event.lookup = "{:02x}{:02x}".format(module_index, event_index)
+                    runtime_event = RuntimeEvent(
+                        id=next(runtime_event_ids),
+                        spec_version=spec_version,
+                        module_id=module_id,
+                        event_id=event.name,
+                        index=event_index,
+                        name=event.name,
+                        lookup=event.lookup,
+                        documentation='\n'.join(event.docs),
+                        count_attributes=len(event.args)
+                    )
+                    runtime_event.save(self.db_session)
+
+                    for arg_index, arg in enumerate(event.args):
+                        runtime_event_attr = RuntimeEventAttribute(
+                            runtime_event_id=runtime_event.id,
+                            index=arg_index,
+                            type=arg.value
+                        )
+                        runtime_event_attr.save(self.db_session)
+
+            if len(storage_functions) > 0:
+                for idx, storage in enumerate(storage_functions):
+                    types = storage.get_params_type_string()
+                    value_type = storage.get_value_type_string()
+                    hashers = storage.get_param_hashers()
+
+                    hasher_type1 = None
+                    hasher_type2 = None
+                    key_type1 = None
+                    key_type2 = None
+                    type_is_linked = None
+
+                    if len(hashers) == 1:
+                        hasher_type1 = hashers[0]
+                    elif len(hashers) == 2:
+                        hasher_type1 = hashers[0]
+                        hasher_type2 = hashers[1]
+
+                    if len(types) == 1:
+                        key_type1 = types[0]
+                    elif len(types) == 2:
+                        key_type1 = types[0]
+                        key_type2 = types[1]
+
+                    _prefix = module.value_object['storage'].value_object['prefix']
+                    runtime_storage = RuntimeStorage(
+                        spec_version=spec_version,
+                        module_id=module_id,
+                        index=idx,
+                        name=storage.name,
+                        lookup=None,
+                        default=storage.value.get('default'),
+                        modifier=storage.modifier,
+                        type_hasher=hasher_type1,
+                        storage_key=xxh128(_prefix.data.data) + xxh128(storage.name.encode()),
+                        type_key1=key_type1,
+                        type_key2=key_type2,
+                        type_value=value_type,
+                        type_is_linked=type_is_linked,
+                        type_key2hasher=hasher_type2
+                    )
+                    runtime_storage.save(self.db_session)
 
+            if len(module.constants or []) > 0:
+                for idx, constant in enumerate(module.constants):
+                    # Decode value
+                    try:
+                        constant_value = constant.value_object['value'].value_object
+                        decode_constant_type = constant.type if self.substrate.implements_scaleinfo() else constant.value.get(
+                            "type")
+                        value_obj = self.substrate.runtime_config.create_scale_object(
+                            decode_constant_type, data=ScaleBytes(constant_value)
+                        )
+                        value_obj.decode()
+                        constant_type = value_obj.type_name if self.substrate.implements_scaleinfo() and hasattr(
+                            value_obj, "type_name") else constant.type
+                        value = value_obj.serialize()
+                    except ValueError:
+                        print("constant error:1, type:{}, name:{}", constant.type, constant.name)
+                        value = constant.value_object['value'].serialize()
+                    except RemainingScaleBytesNotEmptyException:
+                        print("constant error:2, type:{}, name:{}", constant.type, constant.name)
+                        value = constant.value_object['value'].serialize()
+                    except NotImplementedError:
+                        print("constant error:3, type:{}, name:{}", constant.type, constant.name)
+                        value = constant.value_object['value'].serialize()
+
+                    if type(value) is list or type(value) is dict:
+                        value = json.dumps(value)
+
+                    runtime_constant = RuntimeConstant(
+                        spec_version=spec_version,
+                        module_id=module_id,
+                        index=idx,
+                        name=constant.name,
+                        type=constant_type,
+                        value=value
+                    )
+                    runtime_constant.save(self.db_session)
 
+            if len(module.errors or []) > 0:
+                for idx, error in enumerate(module.errors):
+                    runtime_error = RuntimeErrorMessage(
+                        spec_version=spec_version,
+                        module_id=module_id,
+                        module_index=module_index,
+                        index=idx,
+                        name=error.name
+                    )
+                    runtime_error.save(self.db_session)
+
+        runtime.save(self.db_session)
+
+        # Process types
+        for runtime_type_data in list(self.substrate.get_type_registry(block_hash=block_hash).values()):
+            runtime_type = RuntimeType(
+                spec_version=runtime_type_data["spec_version"],
+                type_string=runtime_type_data["type_string"],
+                decoder_class=runtime_type_data["decoder_class"],
+                is_primitive_core=runtime_type_data["is_primitive_core"],
+                is_primitive_runtime=runtime_type_data["is_primitive_runtime"]
+            )
+            runtime_type.save(self.db_session)
+
+    def buffered_writes(self, model_classes):
+        """
+        Route `save()` calls of new objects of given model classes through a WriteBuffer, see `buffered_writes`
+        """
+        return buffered_writes(self.db_session, model_classes)
+
+    def add_block(self, block_hash, block_data=None, block_records=None):
+        if settings.PROFILE_DB_BYTES:
+            bytes_sent = self.get_db_bytes_sent()
+
+        with self.buffered_writes(ACCUMULATION_BUFFERED_MODELS) as write_buffer:
+            block = self.accumulate_block(
+                block_hash, write_buffer, block_data=block_data, block_records=block_records
+            )
+
+        if settings.PROFILE_DB_BYTES:
+            print('Block #{}: {} bytes received from database'.format(block.id, self.get_db_bytes_sent() - bytes_sent))
+
+        return block
+
+    def get_db_bytes_sent(self):
+        # Number of bytes MySQL sent over the connection of the current session
+        return int(self.db_session.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'").fetchone()[1])
+
+    def fetch_block_data(self, block_hash):
+        block, events = self.substrate.rpc_batch_request([
+            ('chain_getBlock', [block_hash]),
+            ('state_getStorageAt', [SYSTEM_EVENTS_STORAGE_KEY, block_hash])
+        ], return_errors=True)
+
+        if isinstance(block, SubstrateRequestException):
+            raise block
+
+        if block is None:
+            raise HarvesterCouldNotAddBlock(block_hash)
+
+        return create_block_data(block_hash, block, events)
+
+    def accumulate_block(self, block_hash, write_buffer, block_data=None, block_records=None):
+        """
+        Decode and store given block. When `block_data` is provided (see `BlockPrefetcher`) the raw block and events
+        in it are decoded instead of retrieving them from the node. When `block_records` is provided (see
+        `BlockDecoderPool`) the block was decoded already and only needs to be processed and stored
+        """
         # Check if block is already process
         print('Add block hash = ', block_hash)
-        if Block.query(self.db_session).filter_by(hash=block_hash).count() > 0:
+        if self.is_known_block_hash(block_hash, block_data=block_data):
             # self.remove_block(block_hash=block_hash)
             raise BlockAlreadyAdded(block_hash)
             # remove old data
@@ -505,15 +606,25 @@ class PolkascanHarvesterService(BaseService):
         if settings.SUBSTRATE_MOCK_EXTRINSICS:
             self.substrate.mock_extrinsics = settings.SUBSTRATE_MOCK_EXTRINSICS
 
-        json_block = self.substrate.get_block(block_hash, include_author=False)
-        header = json_block['header']
-        parent_hash = header['parentHash']
-        block_id = header['number']
-        extrinsics_root = header['extrinsicsRoot']
-        state_root = header['stateRoot']
-        digest_logs = []
-        for idx, log_data in enumerate(header.get('digest', {}).get('logs', [])):
-            digest_logs.append(log_data.data.to_hex())
+        if block_records:
+            # Decoded by another process, bring the runtime of the node connection up to date for the processors
+            parent_spec_version = block_records['spec_version']
+            self.substrate.init_block_runtime(block_hash, parent_spec_version)
+        else:
+            if not block_data:
+                block_data = self.fetch_block_data(block_hash)
+
+            # Extrinsics and events are decoded against the runtime of the parent block
+            block_number = int(block_data['block']['header']['number'], 16)
+            parent_spec_version = self.runtime_index.get_spec_version(max(block_number - 1, 0))
+
+            block_records = decode_block_records(self.substrate, block_hash, block_data, parent_spec_version)
+
+        parent_hash = block_records['parent_hash']
+        block_id = block_records['number']
+        extrinsics_root = block_records['extrinsics_root']
+        state_root = block_records['state_root']
+        digest_logs = block_records['logs']
 
         # ==== Get block runtime from Substrate ==================
 
@@ -522,13 +633,7 @@ class PolkascanHarvesterService(BaseService):
         # ==== Get parent block runtime ===================
 
         if block_id > 0:
-            json_parent_runtime_version = self.substrate.get_block_runtime_version(parent_hash)
-
-            parent_spec_version = json_parent_runtime_version.get('specVersion', 0)
-
             self.process_metadata(parent_spec_version, parent_hash)
-        else:
-            parent_spec_version = self.substrate.runtime_version
 
         # ==== Set initial block properties =====================
 
@@ -561,72 +666,60 @@ class PolkascanHarvesterService(BaseService):
             range10000=math.floor(block_id / 10000),
             range100000=math.floor(block_id / 100000),
             range1000000=math.floor(block_id / 1000000),
-            spec_version_id=self.substrate.runtime_version,
+            spec_version_id=parent_spec_version,
             logs=digest_logs
         )
 
         # Set temp helper variables
         block._accounts_new = []
         block._accounts_reaped = []
+        block._log_records = block_records['log_records']
 
         # ==== Get block events from Substrate ==================
         extrinsic_success_idx = {}
         events = []
 
-        try:
-            # TODO implemented solution in substrate interface for runtime transition blocks
-            # Events are decoded against runtime of parent block
-            RuntimeConfiguration().set_active_spec_version_id(parent_spec_version)
-            # print('blck_hash', block_hash)
-            # print('parent_spec_version', parent_spec_version)
-            # events_decoder = self.substrate.get_block_events(block_hash, self.metadata_store[parent_spec_version])
-            events_decoder = self.substrate.get_events(block_hash)
-            # print('events_decoder', events_decoder)
-            # Revert back to current runtime
-            RuntimeConfiguration().set_active_spec_version_id(block.spec_version_id)
-
-            event_idx = 0
-
-            for event in events_decoder:
-                event.value['module_id'] = event.value['module_id'].lower()
-                # print('module_id', event.value['module_id'])
-                # print('event.value', event.value)
+        if block_records['events'] is None:
+            block.count_events = 0
+        else:
+            for event_idx, (module_id, event_id, phase, extrinsic_idx, event_index, attributes) in enumerate(
+                    block_records['events']):
+
                 model = Event(
                     block_id=block_id,
                     event_idx=event_idx,
-                    phase=event.value_object['phase'].index,
-                    extrinsic_idx=event.value['extrinsic_idx'],
-                    type=event.value.get('event_index') or event.value.get('type'),
+                    phase=phase,
+                    extrinsic_idx=extrinsic_idx,
+                    type=event_index,
                     spec_version_id=parent_spec_version,
-                    module_id=event.value['module_id'],
-                    event_id=event.value['event_id'],
-                    system=int(event.value['module_id'] == 'system'),
-                    module=int(event.value['module_id'] != 'system'),
-                    # attributes=event.value['params'],
-                    attributes=event.params,
+                    module_id=module_id,
+                    event_id=event_id,
+                    system=int(module_id == 'system'),
+                    module=int(module_id != 'system'),
+                    attributes=attributes,
                     codec_error=False
                 )
 
                 # Process event
-                if model.module_id == 'balances' and model.event_id == 'Transfer':
+                if module_id == 'balances' and event_id == 'Transfer':
                     block.count_events_transfer += 1
 
-                if event.value_object['phase'].index == 0:
+                if phase == 0:
                     block.count_events_extrinsic += 1
-                elif event.value_object['phase'].index == 1:
+                elif phase == 1:
                     block.count_events_finalization += 1
 
-                if event.value['module_id'] == 'system':
+                if module_id == 'system':
 
                     block.count_events_system += 1
 
                     # Store result of extrinsic
-                    if event.value['event_id'] == 'ExtrinsicSuccess':
-                        extrinsic_success_idx[event.value['extrinsic_idx']] = True
+                    if event_id == 'ExtrinsicSuccess':
+                        extrinsic_success_idx[extrinsic_idx] = True
                         block.count_extrinsics_success += 1
 
-                    if event.value['event_id'] == 'ExtrinsicFailed':
-                        extrinsic_success_idx[event.value['extrinsic_idx']] = False
+                    if event_id == 'ExtrinsicFailed':
+                        extrinsic_success_idx[extrinsic_idx] = False
                         block.count_extrinsics_error += 1
                 else:
 
@@ -636,16 +729,11 @@ class PolkascanHarvesterService(BaseService):
 
                 events.append(model)
 
-                event_idx += 1
-
-            block.count_events = len(events_decoder)
-
-        except SubstrateRequestException:
-            block.count_events = 0
+            block.count_events = len(block_records['events'])
 
         # === Extract extrinsics from block ====
 
-        extrinsics_data = json_block['extrinsics']
+        extrinsics_data = block_records['extrinsics']
 
         block.count_extrinsics = len(extrinsics_data)
 
@@ -653,7 +741,7 @@ class PolkascanHarvesterService(BaseService):
 
         extrinsics = []
 
-        for extrinsic in extrinsics_data:
+        for value, signed in extrinsics_data:
 
             extrinsic_success = extrinsic_success_idx.get(extrinsic_idx, False)
 
@@ -662,10 +750,6 @@ class PolkascanHarvesterService(BaseService):
             # if extrinsics_decoder.era:
             #     era = extrinsics_decoder.era.raw_value
             # else:
-            value = extrinsic.value
-            print(value)
-            print("=====extrinsic.value=====")
-            print(extrinsic.value_object)
             era = None
             if 'era' in value:
                 era = ','.join(map(str, value.get('era')))
@@ -690,10 +774,10 @@ class PolkascanHarvesterService(BaseService):
                 extrinsic_hash=extrinsic_hash,
                 extrinsic_length=value.get('extrinsic_length'),
                 extrinsic_version=version_info,
-                signed=extrinsic.signed,
-                unsigned=not extrinsic.signed,
-                signedby_address=bool(extrinsic.signed and 'address' in value),
-                signedby_index=bool(extrinsic.signed and 'account_index' in value),
+                signed=signed,
+                unsigned=not signed,
+                signedby_address=bool(signed and 'address' in value),
+                signedby_index=bool(signed and 'account_index' in value),
                 address_length=value.get('account_length', None),
                 address=address,
                 account_index=value.get('account_index', None),
@@ -717,7 +801,7 @@ class PolkascanHarvesterService(BaseService):
             extrinsic_idx += 1
 
             # Process extrinsic
-            if extrinsic.signed:
+            if signed:
                 block.count_extrinsics_signed += 1
 
                 if model.signedby_address:
@@ -738,7 +822,7 @@ class PolkascanHarvesterService(BaseService):
                 block.count_extrinsics_unsigned += 1
 
             # Process extrinsic processors
-            for processor_class in ProcessorRegistry().get_extrinsic_processors(model.module_id, model.call_id):
+            for processor_class in self.processor_registry.get_extrinsic_processors(model.module_id, model.call_id):
                 print("RUN get_extrinsic_processors . ", model.module_id, model.call_id)
                 extrinsic_processor = processor_class(block, model, substrate=self.substrate)
                 extrinsic_processor.accumulation_hook(self.db_session)
@@ -753,29 +837,84 @@ class PolkascanHarvesterService(BaseService):
                 except IndexError:
                     extrinsic = None
 
-            for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
+            for processor_class in self.processor_registry.get_event_processors(event.module_id, event.event_id):
                 event_processor = processor_class(block, event, extrinsic,
                                                   metadata=self.metadata_store.get(block.spec_version_id),
                                                   substrate=self.substrate)
                 event_processor.accumulation_hook(self.db_session)
                 event_processor.process_search_index(self.db_session)
 
+        # Write events, extrinsics and search indices so block processors can query them
+        write_buffer.flush(self.db_session)
+
         # Process block processors
-        for processor_class in ProcessorRegistry().get_block_processors():
+        for processor_class in self.processor_registry.get_block_processors():
             block_processor = processor_class(block, substrate=self.substrate, harvester=self)
             block_processor.accumulation_hook(self.db_session)
 
         # Debug info
         if settings.DEBUG:
-            block.debug_info = json_block
+            block.debug_info = block_records
 
         # ==== Save data block ==================================
 
         block.save(self.db_session)
+        BlockRange.add_block_id(self.db_session, block.id)
+
+        if known_block_hashes is not None:
+            known_block_hashes.add(block.id, block_hash)
 
         return block
 
+    def is_known_block_hash(self, block_hash, block_data=None):
+        """
+        Checks if a block with given hash is stored. The database is only queried when the in-memory bloom filter
+        can't rule it out
+        :param block_hash:
+        :param block_data: raw block data, when available its block number is checked as well
+        :return:
+        """
+        global known_block_hashes
+
+        if settings.KNOWN_BLOCK_HASHES_BITS and known_block_hashes is None:
+            print('Loading known block hashes')
+            known_block_hashes = KnownBlockHashes.load(
+                self.db_session, Block, settings.KNOWN_BLOCK_HASHES_BITS, block_range_class=BlockRange
+            )
+        elif known_block_hashes is not None and \
+                time.monotonic() - known_block_hashes.refreshed_at > settings.KNOWN_BLOCK_HASHES_REFRESH_SECONDS:
+            # Pick up blocks stored by other workers, at the chain head and by backfilling gaps
+            known_block_hashes.refresh(self.db_session, Block, block_range_class=BlockRange)
+
+        if known_block_hashes is not None:
+            block_id = int(block_data['block']['header']['number'], 16) if block_data else None
+
+            if not known_block_hashes.might_contain(block_hash, block_id):
+                return False
+
+        return Block.exists(self.db_session, hash=block_hash)
+
+    def add_known_block_hash(self, block_hash):
+        """
+        Adds given block to the known block hashes if it's stored, to be called when storing it failed on the
+        unique index because another worker stored it in the meantime
+        :param block_hash:
+        :return:
+        """
+        if known_block_hashes is not None:
+            block = Block.query(self.db_session).filter_by(hash=block_hash).first()
+
+            if block:
+                known_block_hashes.add(block.id, block.hash)
+
     def remove_block(self, block_hash):
+        """
+        Reverts the processors of given block and deletes the block with its extrinsics, events and logs. The
+        changes are not committed, so archiving the block with `process_reorg_block` and removing it can be done in
+        one transaction
+        :param block_hash:
+        :return:
+        """
         # Retrieve block
         block = Block.query(self.db_session).filter_by(hash=block_hash).first()
 
@@ -783,34 +922,35 @@ class PolkascanHarvesterService(BaseService):
 
         # Revert event processors
         for event in Event.query(self.db_session).filter_by(block_id=block.id):
-            for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
+            for processor_class in self.processor_registry.get_event_processors(event.module_id, event.event_id):
                 event_processor = processor_class(block, event, None)
                 event_processor.accumulation_revert(self.db_session)
 
         # Revert extrinsic processors
         for extrinsic in Extrinsic.query(self.db_session).filter_by(block_id=block.id):
-            for processor_class in ProcessorRegistry().get_extrinsic_processors(extrinsic.module_id, extrinsic.call_id):
+            for processor_class in self.processor_registry.get_extrinsic_processors(extrinsic.module_id,
+                                                                                    extrinsic.call_id):
                 extrinsic_processor = processor_class(block, extrinsic)
                 extrinsic_processor.accumulation_revert(self.db_session)
 
         # Revert block processors
-        for processor_class in ProcessorRegistry().get_block_processors():
+        for processor_class in self.processor_registry.get_block_processors():
             block_processor = processor_class(block)
             block_processor.accumulation_revert(self.db_session)
 
-        # Delete events
-        for item in Event.query(self.db_session).filter_by(block_id=block.id):
-            print('remove-event: ', item)
-            self.db_session.delete(item)
-        # Delete extrinsics
-        for item in Extrinsic.query(self.db_session).filter_by(block_id=block.id):
-            print('remove-extrinsics: ', item)
-            self.db_session.delete(item)
+        # Delete events, extrinsics and logs
+        for model_class in (Event, Extrinsic, Log):
+            count = model_class.query(self.db_session).filter_by(block_id=block.id).delete(
+                synchronize_session=False
+            )
+            print('remove-{}: {}'.format(model_class.__tablename__, count))
 
-        # Delete block
+        # Delete block; its hash stays in known_block_hashes as a false positive, which is_known_block_hash
+        # resolves with a query
         print('delete-block', block.id, block.hash)
+        BlockRange.remove_block_id(self.db_session, block.id)
         self.db_session.delete(block)
-        self.db_session.commit()
+        self.db_session.flush()
 
     def debug_task(self):
         sequencer_task = Status.get_status(self.db_session, 'SEQUENCER_TASK_ID')
@@ -823,7 +963,8 @@ class PolkascanHarvesterService(BaseService):
         sequencer_task.last_modified = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         sequencer_task.save(self.db_session)
 
-    def sequence_block(self, block: Block, parent_block_data=None, parent_sequenced_block_data=None):
+    def sequence_block(self, block: Block, parent_block_data=None, parent_sequenced_block_data=None,
+                       remove_existing=True, window=None):
         print('RUN 0 Check BlockTotal')
 
         spec_version = block.spec_version_id
@@ -838,9 +979,10 @@ class PolkascanHarvesterService(BaseService):
         print('RUN 3 Check BlockTotal')
 
         # Remove old data before insert.
-        for item in BlockTotal.query(self.db_session).filter_by(
-                id=block.id):
-            self.db_session.delete(item)
+        if remove_existing:
+            for item in BlockTotal.query(self.db_session).filter_by(
+                    id=block.id):
+                self.db_session.delete(item)
 
         sequenced_block = BlockTotal(
             id=block.id,
@@ -848,8 +990,8 @@ class PolkascanHarvesterService(BaseService):
         )
 
         # Process block processors
-        for processor_class in ProcessorRegistry().get_block_processors():
-            block_processor = processor_class(block, sequenced_block, substrate=self.substrate)
+        for processor_class in self.processor_registry.get_block_processors():
+            block_processor = processor_class(block, sequenced_block, substrate=self.substrate, window=window)
             # Goto block sequencing_hook
             block_processor.sequencing_hook(
                 self.db_session,
@@ -857,11 +999,17 @@ class PolkascanHarvesterService(BaseService):
                 parent_sequenced_block_data
             )
 
-        extrinsics = Extrinsic.query(self.db_session).filter_by(block_id=block.id).order_by('extrinsic_idx')
+        if window is not None and window.contains(Extrinsic, block.id):
+            extrinsics = window.get(Extrinsic, block.id)
+            events = window.get(Event, block.id)
+        else:
+            extrinsics = Extrinsic.query(self.db_session).filter_by(block_id=block.id).order_by('extrinsic_idx')
+            events = Event.query(self.db_session).filter_by(block_id=block.id).order_by('event_idx')
 
         for extrinsic in extrinsics:
             # Process extrinsic processors
-            for processor_class in ProcessorRegistry().get_extrinsic_processors(extrinsic.module_id, extrinsic.call_id):
+            for processor_class in self.processor_registry.get_extrinsic_processors(extrinsic.module_id,
+                                                                                    extrinsic.call_id):
                 extrinsic_processor = processor_class(block, extrinsic, substrate=self.substrate)
                 extrinsic_processor.sequencing_hook(
                     self.db_session,
@@ -869,8 +1017,6 @@ class PolkascanHarvesterService(BaseService):
                     parent_sequenced_block_data
                 )
 
-        events = Event.query(self.db_session).filter_by(block_id=block.id).order_by('event_idx')
-
         # Process event processors
         for event in events:
             extrinsic = None
@@ -880,7 +1026,7 @@ class PolkascanHarvesterService(BaseService):
                 except IndexError:
                     extrinsic = None
 
-            for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
+            for processor_class in self.processor_registry.get_event_processors(event.module_id, event.event_id):
                 event_processor = processor_class(block=block, event=event, extrinsic=extrinsic,
                                                   substrate=self.substrate, sequenced_block=sequenced_block)
                 event_processor.sequencing_hook(
@@ -929,10 +1075,15 @@ class PolkascanHarvesterService(BaseService):
 
             print('== Start integrity checks from {} to {} =='.format(start_block_id, end_block_id))
 
-            for block_nr in range(start_block_id, end_block_id, chunk_size):
-                # TODO replace limit with filter_by block range
-                # block_range = Block.query(self.db_session).order_by('id')[block_nr:block_nr + chunk_size]
-                block_range = Block.query(self.db_session).order_by('id').offset(block_nr).limit(chunk_size)
+            for block_nr in range(start_block_id, end_block_id + 1, chunk_size):
+                # Walk by id range and only load the columns needed to verify the linkage
+                block_range = self.db_session.query(Block.id, Block.hash, Block.parent_hash).filter(
+                    Block.id.between(block_nr, min(block_nr + chunk_size - 1, end_block_id))
+                ).order_by(Block.id).all()
+
+                # Hashes of the finalized blocks in the node to verify the stored hashes against
+                node_block_hashes = self.substrate.get_block_hashes([block.id for block in block_range])
+
                 for block in block_range:
                     if parent_block:
                         print('Kami-DEBUG block.id={}, parent_block.id={}'.format(block.id, parent_block.id))
@@ -951,7 +1102,6 @@ class PolkascanHarvesterService(BaseService):
                                 print('Kami Try Add={} AND hash={}'.format(parent_block.id + 1, re_add_hash))
                                 for item in SymbolSnapshot.query(self.db_session).filter_by(
                                         block_id=parent_block.id + 1):
-                                    print('Kami Delete SymbolSnapshot. ')
                                     self.db_session.delete(item)
                                 self.add_block(re_add_hash)
                                 self.db_session.commit()
@@ -970,10 +1120,10 @@ class PolkascanHarvesterService(BaseService):
                             #     'Kami Block #{} is missing.. stopping check '.format(parent_block.id + 1)
                             # )
 
-                        elif block.parent_hash != parent_block.hash:
+                        elif block.parent_hash != parent_block.hash or block.hash != node_block_hashes[block.id]:
 
-                            self.process_reorg_block(parent_block)
-                            self.process_reorg_block(block)
+                            self.process_reorg_block(Block.query(self.db_session).get(parent_block.id))
+                            self.process_reorg_block(Block.query(self.db_session).get(block.id))
 
                             self.remove_block(block.hash)
                             self.remove_block(parent_block.hash)
@@ -1015,14 +1165,30 @@ class PolkascanHarvesterService(BaseService):
 
         return {'integrity_head': integrity_head.value}
 
+    def get_genesis_block(self):
+        """
+        Processes the genesis block when block 0 is sequenced
+        :return: the genesis Block, or None when the first stored block isn't at the start of the chain
+        """
+        block = Block.query(self.db_session).order_by('id').first()
+
+        if block and block.id == 1:
+            # Add genesis block
+            block = self.add_block(block.parent_hash)
+
+        if not block or block.id != 0:
+            return None
+
+        self.process_genesis(block)
+
+        return block
+
     def start_sequencer(self):
         print("RUN X start_sequencer start")
         try:
             self.integrity_checks()
             self.db_session.commit()
 
-            block_nr = None
-
             integrity_head = Status.get_status(self.db_session, 'INTEGRITY_HEAD')
 
             if not integrity_head.value:
@@ -1035,128 +1201,141 @@ class PolkascanHarvesterService(BaseService):
                 sequencer_head = -1
 
             # Start sequencing process
-
-            sequencer_parent_block = BlockTotal.query(self.db_session).filter_by(id=sequencer_head).first()
-            parent_block = Block.query(self.db_session).filter_by(id=sequencer_head).first()
-
             print(f"Kami: sequencer range:{sequencer_head + 1} to {int(integrity_head.value) + 1}")
-            for block_nr in range(sequencer_head + 1, int(integrity_head.value) + 1):
-
-                if block_nr == 0:
-                    # No block ever sequenced, check if chain is at genesis state
-                    assert (not sequencer_parent_block)
-
-                    block = Block.query(self.db_session).order_by('id').first()
-
-                    if not block:
-                        self.db_session.commit()
-                        return {'error': 'Chain not at genesis'}
-
-                    if block.id == 1:
-                        # Add genesis block
-                        block = self.add_block(block.parent_hash)
-
-                    if block.id != 0:
-                        self.db_session.commit()
-                        return {'error': 'Chain not at genesis'}
 
-                    self.process_genesis(block)
-
-                    sequencer_parent_block_data = None
-                    parent_block_data = None
-                else:
-                    block_id = sequencer_parent_block.id + 1
-
-                    assert (block_id == block_nr)
-
-                    block = Block.query(self.db_session).get(block_nr)
-
-                    if not block:
-                        self.db_session.commit()
-                        return {'result': 'Finished at #{}'.format(sequencer_parent_block.id)}
-
-                    sequencer_parent_block_data = sequencer_parent_block.asdict()
-                    parent_block_data = parent_block.asdict()
-
-                print(f"sequence_block {block.id} For data_block_total.")
-                sequenced_block = self.sequence_block(block, parent_block_data, sequencer_parent_block_data)
-                self.db_session.commit()
+            sequencer = Sequencer(
+                self.db_session,
+                sequence_block=functools.partial(self.sequence_block, remove_existing=False),
+                get_genesis_block=self.get_genesis_block,
+                window_size=settings.SEQUENCER_WINDOW
+            )
 
-                parent_block = block
-                sequencer_parent_block = sequenced_block
+            try:
+                last_block_id = sequencer.run(sequencer_head, int(integrity_head.value))
+            except ChainNotAtGenesis:
+                return {'error': 'Chain not at genesis'}
 
-            if block_nr is None:
-                return {'result': 'Finished at #{}'.format(block_nr)}
-            else:
+            if last_block_id is None:
                 return {'result': 'Nothing to sequence'}
+            else:
+                return {'result': 'Finished at #{}'.format(last_block_id)}
         except Exception as e:
+            # The sequencer rolled back the window that failed, windows sequenced before were committed already
+            self.db_session.rollback()
             return {'result': 'start_sequencer had an error {}'.format(
                 traceback.format_exception(type(e), e, e.__traceback__))}
 
     def process_reorg_block(self, block):
-
+        """
+        Archives given block with its extrinsics, events and logs in the reorg tables, copied with an
+        INSERT ... SELECT per table
+        :param block:
+        :return:
+        """
         # Check if reorg already exists
-        if ReorgBlock.query(self.db_session).filter_by(hash=block.hash).count() == 0:
-
-            model = ReorgBlock(**block.asdict())
-            model.save(self.db_session)
-
-            for extrinsic in Extrinsic.query(self.db_session).filter_by(block_id=block.id):
-                model = ReorgExtrinsic(block_hash=block.hash, **extrinsic.asdict())
-                model.save(self.db_session)
-
-            for event in Event.query(self.db_session).filter_by(block_id=block.id):
-                model = ReorgEvent(block_hash=block.hash, **event.asdict())
-                model.save(self.db_session)
-
-            for log in Log.query(self.db_session).filter_by(block_id=block.id):
-                model = ReorgLog(block_hash=block.hash, **log.asdict())
-                model.save(self.db_session)
-
-    def rebuild_search_index(self):
-
-        self.db_session.execute('truncate table {}'.format(SearchIndex.__tablename__))
-
-        for block in Block.query(self.db_session).order_by('id').yield_per(1000):
-
-            extrinsic_lookup = {}
-            block._accounts_new = []
-            block._accounts_reaped = []
+        if not ReorgBlock.exists(self.db_session, hash=block.hash):
+
+            # Pending changes of the block must be in the database before it's copied
+            self.db_session.flush()
+
+            self.archive_rows(Block, ReorgBlock, Block.id == block.id)
+            self.archive_rows(Extrinsic, ReorgExtrinsic, Extrinsic.block_id == block.id, block_hash=block.hash)
+            self.archive_rows(Event, ReorgEvent, Event.block_id == block.id, block_hash=block.hash)
+            self.archive_rows(Log, ReorgLog, Log.block_id == block.id, block_hash=block.hash)
+
+    def archive_rows(self, model_class, reorg_model_class, condition, block_hash=None):
+        """
+        Copies the rows of `model_class` matching `condition` to `reorg_model_class` in the database, only the
+        columns that both tables have are copied
+        :param model_class:
+        :param reorg_model_class:
+        :param condition:
+        :param block_hash: value of the `block_hash` column of the copied rows, if the reorg table has one
+        :return:
+        """
+        reorg_table = reorg_model_class.__table__
+        columns = [column for column in model_class.__table__.columns if column.key in reorg_table.columns]
+        column_names = [column.key for column in columns]
+
+        if block_hash is not None:
+            columns.insert(0, literal(block_hash).label('block_hash'))
+            column_names.insert(0, 'block_hash')
+
+        self.db_session.execute(
+            reorg_table.insert().from_select(column_names, select(*columns).where(condition))
+        )
 
-            for extrinsic in Extrinsic.query(self.db_session).filter_by(block_id=block.id).order_by('extrinsic_idx'):
-                extrinsic_lookup[extrinsic.extrinsic_idx] = extrinsic
+    def rebuild_search_index(self, block_from, block_to):
+        """
+        Rebuilds the search index of given block range. Existing index rows of the range are removed first, so a
+        range can be rebuilt again after an interruption. Blocks, extrinsics and events are read with one range
+        query each and the index rows are inserted in bulk, so callers pass ranges of SEARCH_INDEX_CHUNK_SIZE blocks.
+        :param block_from:
+        :param block_to:
+        :return: number of processed blocks
+        """
+        SearchIndex.query(self.db_session).filter(
+            SearchIndex.block_id.between(block_from, block_to)
+        ).delete(synchronize_session=False)
+
+        block_count = 0
+
+        extrinsics = {}
+        for extrinsic in Extrinsic.query(self.db_session).filter(
+                Extrinsic.block_id.between(block_from, block_to)
+        ).order_by(Extrinsic.block_id, Extrinsic.extrinsic_idx):
+            extrinsics.setdefault(extrinsic.block_id, []).append(extrinsic)
+
+        events = {}
+        for event in Event.query(self.db_session).filter(
+                Event.block_id.between(block_from, block_to)
+        ).order_by(Event.block_id, Event.event_idx):
+            events.setdefault(event.block_id, []).append(event)
+
+        with self.buffered_writes((SearchIndex,)):
+            for block in Block.query(self.db_session).filter(
+                    Block.id.between(block_from, block_to)
+            ).order_by(Block.id):
+
+                extrinsic_lookup = {}
+                block._accounts_new = []
+                block._accounts_reaped = []
+
+                for extrinsic in extrinsics.get(block.id, []):
+                    extrinsic_lookup[extrinsic.extrinsic_idx] = extrinsic
+
+                    # Add search index for signed extrinsics
+                    if extrinsic.address:
+                        search_index = SearchIndex(
+                            index_type_id=settings.SEARCH_INDEX_SIGNED_EXTRINSIC,
+                            block_id=block.id,
+                            extrinsic_idx=extrinsic.extrinsic_idx,
+                            account_id=extrinsic.address
+                        )
+                        search_index.save(self.db_session)
 
-                # Add search index for signed extrinsics
-                if extrinsic.address:
-                    search_index = SearchIndex(
-                        index_type_id=settings.SEARCH_INDEX_SIGNED_EXTRINSIC,
-                        block_id=block.id,
-                        extrinsic_idx=extrinsic.extrinsic_idx,
-                        account_id=extrinsic.address
-                    )
-                    search_index.save(self.db_session)
+                    # Process extrinsic processors
+                    for processor_class in self.processor_registry.get_extrinsic_processors(extrinsic.module_id,
+                                                                                        extrinsic.call_id):
+                        extrinsic_processor = processor_class(block=block, extrinsic=extrinsic,
+                                                              substrate=self.substrate)
+                        extrinsic_processor.process_search_index(self.db_session)
 
-                # Process extrinsic processors
-                for processor_class in ProcessorRegistry().get_extrinsic_processors(extrinsic.module_id,
-                                                                                    extrinsic.call_id):
-                    extrinsic_processor = processor_class(block=block, extrinsic=extrinsic, substrate=self.substrate)
-                    extrinsic_processor.process_search_index(self.db_session)
+                for event in events.get(block.id, []):
+                    extrinsic = None
+                    if event.extrinsic_idx is not None:
+                        extrinsic = extrinsic_lookup.get(event.extrinsic_idx)
 
-            for event in Event.query(self.db_session).filter_by(block_id=block.id).order_by('event_idx'):
-                extrinsic = None
-                if event.extrinsic_idx is not None:
-                    try:
-                        extrinsic = extrinsic_lookup[event.extrinsic_idx]
-                    except (IndexError, KeyError):
-                        extrinsic = None
+                    for processor_class in self.processor_registry.get_event_processors(event.module_id,
+                                                                                    event.event_id):
+                        event_processor = processor_class(block, event, extrinsic,
+                                                          metadata=self.metadata_store.get(block.spec_version_id),
+                                                          substrate=self.substrate)
+                        event_processor.process_search_index(self.db_session)
 
-                for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
-                    event_processor = processor_class(block, event, extrinsic,
-                                                      metadata=self.metadata_store.get(block.spec_version_id),
-                                                      substrate=self.substrate)
-                    event_processor.process_search_index(self.db_session)
+                block_count += 1
 
-            self.db_session.commit()
+        return block_count
 
     def create_full_balance_snaphot(self, block_id):
 
@@ -1178,87 +1357,129 @@ class PolkascanHarvesterService(BaseService):
                     storage_function='Account'
                 )
 
-                rpc_result = self.substrate.rpc_request(
-                    'state_getKeys',
-                    [storage_key_prefix, block_hash]
-                ).get('result')
-                # Extract accounts from storage key
-                accounts = [storage_key[-64:] for storage_key in rpc_result if len(storage_key) == 162]
+                value_type = storage_method.get_value_type_string()
+
+                # Keys are walked page by page, while the values of each page are retrieved in the storage fetcher
+                # threads; decoding and writing the snapshots stays in this thread
+                storage_fetcher = StorageFetcher(settings.SUBSTRATE_RPC_URL, max_workers=settings.SNAPSHOT_THREADS)
+                futures = []
+                try:
+                    for storage_keys in utils.get_storage_keys_paged(
+                            self.substrate, storage_key_prefix, block_hash, page_size=settings.STORAGE_QUERY_BATCH_SIZE
+                    ):
+                        futures.append(storage_fetcher.submit(storage_keys, block_hash))
+
+                        while len(futures) > settings.SNAPSHOT_THREADS:
+                            self.store_balance_snapshot_values(block_id, value_type, futures.pop(0).result())
+
+                    for future in futures:
+                        self.store_balance_snapshot_values(block_id, value_type, future.result())
+                finally:
+                    storage_fetcher.close()
             else:
                 # Retrieve accounts from database for legacy blocks
                 accounts = [account[0] for account in self.db_session.query(distinct(Account.id))]
 
-            for account_id in accounts:
-                self.create_balance_snapshot(block_id=block_id, account_id=account_id, block_hash=block_hash)
+                self.create_balance_snapshots(block_id=block_id, account_ids=accounts, block_hash=block_hash)
+
+    def store_balance_snapshot_values(self, block_id, value_type, storage_values):
+        rows = []
+        for storage_key, storage_value in storage_values.items():
+            # Extract account from storage key
+            if len(storage_key) != 162:
+                continue
+
+            account_info_data = None
+            if storage_value is not None:
+                account_info = self.substrate.runtime_config.create_scale_object(
+                    type_string=value_type, data=ScaleBytes(storage_value), metadata=self.substrate.metadata_decoder
+                )
+                account_info_data = account_info.decode()
+
+            rows.append(self.get_balance_snapshot_values(block_id, storage_key[-64:], account_info_data))
+
+        AccountInfoSnapshot.upsert(self.db_session, rows)
+
+    def get_balance_snapshot_values(self, block_id, account_id, account_info_data):
+        if account_info_data:
+            return {
+                'block_id': block_id,
+                'account_id': account_id,
+                'account_info': account_info_data,
+                'balance_free': account_info_data["data"]["free"],
+                'balance_reserved': account_info_data["data"]["reserved"],
+                'balance_total': account_info_data["data"]["free"] + account_info_data["data"]["reserved"],
+                'nonce': account_info_data["nonce"]
+            }
+        else:
+            return {
+                'block_id': block_id,
+                'account_id': account_id,
+                'account_info': None,
+                'balance_free': None,
+                'balance_reserved': None,
+                'balance_total': None,
+                'nonce': None
+            }
 
     def create_balance_snapshot(self, block_id, account_id, block_hash=None):
+        self.create_balance_snapshots(block_id, [account_id], block_hash=block_hash)
+
+    def create_balance_snapshots(self, block_id, account_ids, block_hash=None):
+        """
+        Stores an AccountInfoSnapshot for each of given accounts at given block. All System.Account values are
+        retrieved with batched `state_queryStorageAt` calls and written with a single upsert
+        """
+        # Accounts that can't be encoded as storage key are skipped, instead of failing the whole batch
+        account_ids = [
+            account_id for account_id in dict.fromkeys(account_ids) if self.is_valid_account_id(account_id)
+        ]
+
+        if not account_ids:
+            return
 
         if not block_hash:
             block_hash = self.substrate.get_block_hash(block_id)
 
-        # Get balance for account
-        try:
-            account_info_data = self.substrate.get_runtime_state(
-                module='System',
-                storage_function='Account',
-                params=['0x{}'.format(account_id)],
-                block_hash=block_hash
-            ).get('result')
+        # Get balances for accounts
+        account_infos = utils.query_multi_storage(
+            pallet_name='System',
+            storage_name='Account',
+            substrate=self.substrate,
+            block_hash=block_hash,
+            params_list=[['0x{}'.format(account_id)] for account_id in account_ids],
+            batch_size=settings.STORAGE_QUERY_BATCH_SIZE
+        )
 
-            # Make sure no rows inserted before processing this record
-            AccountInfoSnapshot.query(self.db_session).filter_by(block_id=block_id, account_id=account_id).delete()
+        rows = [
+            self.get_balance_snapshot_values(block_id, account_id, account_info.value if account_info else None)
+            for account_id, account_info in zip(account_ids, account_infos)
+        ]
 
-            if account_info_data:
-                account_info_obj = AccountInfoSnapshot(
-                    block_id=block_id,
-                    account_id=account_id,
-                    account_info=account_info_data,
-                    balance_free=account_info_data["data"]["free"],
-                    balance_reserved=account_info_data["data"]["reserved"],
-                    balance_total=account_info_data["data"]["free"] + account_info_data["data"]["reserved"],
-                    nonce=account_info_data["nonce"]
-                )
-            else:
-                account_info_obj = AccountInfoSnapshot(
-                    block_id=block_id,
-                    account_id=account_id,
-                    account_info=None,
-                    balance_free=None,
-                    balance_reserved=None,
-                    balance_total=None,
-                    nonce=None
-                )
+        AccountInfoSnapshot.upsert(self.db_session, rows)
 
-            account_info_obj.save(self.db_session)
-        except ValueError:
-            pass
+    @staticmethod
+    def is_valid_account_id(account_id):
+        """
+        Checks if given value is a hex encoded (without 0x prefix) 32 byte AccountId
+        :param account_id:
+        :return:
+        """
+        if not account_id or len(account_id) != 64:
+            return False
 
-    def update_account_balances(self):
-        # set balances according to most recent snapshot
-        account_info = self.db_session.execute("""
-                        select
-                           a.account_id, 
-                           a.balance_total,
-                           a.balance_free,
-                           a.balance_reserved,
-                           a.nonce
-                    from
-                         data_account_info_snapshot as a
-                    inner join (
-                        select 
-                            account_id, max(block_id) as max_block_id 
-                        from data_account_info_snapshot 
-                        group by account_id
-                    ) as b
-                    on a.account_id = b.account_id and a.block_id = b.max_block_id
-                    """)
-
-        for account_id, balance_total, balance_free, balance_reserved, nonce in account_info:
-            Account.query(self.db_session).filter_by(id=account_id).update(
-                {
-                    Account.balance_total: balance_total,
-                    Account.balance_free: balance_free,
-                    Account.balance_reserved: balance_reserved,
-                    Account.nonce: nonce,
-                }, synchronize_session='fetch'
-            )
+        try:
+            bytes.fromhex(account_id)
+        except (ValueError, TypeError):
+            return False
+
+        return True
+
+    def update_account_balances(self, full=False):
+        """
+        Set balances of accounts according to their most recent AccountInfoSnapshot. Only accounts with snapshots
+        stored since the previous run are updated, unless `full` is set
+        :param full:
+        :return:
+        """
+        Account.update_balances(self.db_session, full=full)
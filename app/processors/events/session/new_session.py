@@ -3,8 +3,10 @@ from scalecodec.exceptions import RemainingScaleBytesNotEmptyException
 from substrateinterface import SubstrateInterface
 
 from app import settings, utils
+from app.extend.rpc import query_in_batches
 from app.models.data import Session, SessionValidator, SessionTotal, Account, SessionNominator, RuntimeStorage, \
     ValidatorAuditFromChain
+from app.models.base import WriteBuffer
 from app.processors.base import EventProcessor
 from app.settings import LEGACY_SESSION_VALIDATOR_LOOKUP, SUBSTRATE_METADATA_VERSION, SUBSTRATE_ADDRESS_TYPE
 from app.utils.ss58 import ss58_encode
@@ -24,7 +26,7 @@ class NewSessionEventProcessor(EventProcessor):
         # Retrieve current era
         try:
             current_era = utils.query_storage(pallet_name="Staking", storage_name="CurrentEra", substrate=substrate,
-                                              block_hash=self.block.hash).value
+                                              block_hash=self.block.hash, block_id=self.block.id).value
         except Exception as e:
             print("query current_era storage error:{}".format(e))
             current_era = None
@@ -32,11 +34,25 @@ class NewSessionEventProcessor(EventProcessor):
         # Retrieve validators for new session from storage
         try:
             validators = utils.query_storage(pallet_name="Session", storage_name="Validators", substrate=substrate,
-                                             block_hash=self.block.hash).value or []
+                                             block_hash=self.block.hash, block_id=self.block.id).value or []
         except Exception as e:
             print("query validators storage error:{}".format(e))
             validators = []
 
+        # Retrieve controller accounts, validator preferences and exposures of all validators at once
+        validators_controller = self.query_validators_storage(
+            "Bonded", [[validator_account] for validator_account in validators]
+        )
+        validators_prefs = self.query_validators_storage(
+            "ErasValidatorPrefs", [[current_era, validator_account] for validator_account in validators]
+        )
+        validators_exposure = self.query_validators_storage(
+            "ErasStakers", [[current_era, validator_account] for validator_account in validators]
+        )
+
+        # Nominators are inserted together after all validators are processed
+        write_buffer = WriteBuffer((SessionNominator,))
+
         for rank_nr, validator_account in enumerate(validators):
             validator_ledger = {}
             validator_session = None
@@ -44,42 +60,15 @@ class NewSessionEventProcessor(EventProcessor):
             # GenericAccountId
             validator_stash = validator_account.replace('0x', '')
 
-            # Retrieve controller account
-            try:
-                validator_controller = utils.query_storage(pallet_name="Staking", storage_name="Bonded",
-                                                           substrate=substrate,
-                                                           block_hash=self.block.hash, params=[validator_account]).value
-                if validator_controller:
-                    validator_controller = validator_controller.replace('0x', '')
-            except Exception as e:
-                print("query validator_controller storage error:{}".format(e))
-                validator_controller = None
-
-            # Retrieve validator preferences for stash account
-            try:
-                staking_eras_validator_prefs = utils.query_storage(pallet_name="Staking", storage_name="ErasValidatorPrefs",
-                                                      substrate=substrate,
-                                                      block_hash=self.block.hash,
-                                                      params=[current_era, validator_account])
-                # print("%%%%%%%%% staking_eras_validator_prefs = ", staking_eras_validator_prefs, [current_era, validator_account])
-                validator_prefs = staking_eras_validator_prefs.value
-            except Exception as e:
-                print("query validator_prefs storage error:{}, but not very important".format(e))
-                validator_prefs = None
+            validator_controller = validators_controller[rank_nr]
+            if validator_controller:
+                validator_controller = validator_controller.replace('0x', '')
 
+            validator_prefs = validators_prefs[rank_nr]
             if not validator_prefs:
                 validator_prefs = {'commission': None}
 
-            # Retrieve bonded
-            try:
-                exposure = utils.query_storage(pallet_name="Staking", storage_name="ErasStakers",
-                                               substrate=substrate,
-                                               block_hash=self.block.hash,
-                                               params=[current_era, validator_account]).value
-            except Exception as e:
-                print("query exposure storage error:{}".format(e))
-                exposure = None
-
+            exposure = validators_exposure[rank_nr]
             if not exposure:
                 exposure = {}
 
@@ -116,16 +105,15 @@ class NewSessionEventProcessor(EventProcessor):
                 nominator_stash = nominator_info.get('who').replace('0x', '')
                 nominators.append(nominator_stash)
 
-                session_nominator = SessionNominator(
+                write_buffer.add(SessionNominator(
                     session_id=session_id,
                     rank_validator=rank_nr,
                     rank_nominator=rank_nominator,
                     nominator_stash=nominator_stash,
                     bonded=nominator_info.get('value'),
-                )
-
-                session_nominator.save(db_session)
+                ))
 
+        write_buffer.flush(db_session)
 
         # Store session
         session = Session(
@@ -194,6 +182,32 @@ class NewSessionEventProcessor(EventProcessor):
             Account.id.in_(nominators), Account.is_nominator == False
         ).update({Account.is_nominator: True}, synchronize_session='fetch')
 
+    def query_validators_storage(self, storage_name, params_list):
+        """
+        Retrieves a Staking storage function for all validators with batched `state_queryStorageAt` calls. A batch
+        that fails is queried again per validator, so one failing validator doesn't drop the values of the others
+        :param storage_name:
+        :param params_list:
+        :return: list of values in order of `params_list`, None for validators without a stored value or for which
+        the query failed
+        """
+        def query_batch(batch_params_list):
+            values = utils.query_multi_storage(
+                pallet_name="Staking",
+                storage_name=storage_name,
+                substrate=self.substrate,
+                block_hash=self.block.hash,
+                params_list=batch_params_list,
+                batch_size=len(batch_params_list),
+                use_default=False
+            )
+            return [value.value if value else None for value in values]
+
+        def print_error(batch_params_list, e):
+            print("query {} storage of {} validators error:{}".format(storage_name, len(batch_params_list), e))
+
+        return query_in_batches(query_batch, params_list, settings.STORAGE_QUERY_BATCH_SIZE, on_error=print_error)
+
     # for old version
     def add_session_old(self, db_session, session_id):
         """
@@ -565,7 +579,7 @@ class NewSessionEventProcessor(EventProcessor):
     def process_search_index(self, db_session):
         try:
             validators = utils.query_storage(pallet_name="Session", storage_name="Validators", substrate=self.substrate,
-                                             block_hash=self.block.hash).value
+                                             block_hash=self.block.hash, block_id=self.block.id).value
             # Add search indices for validators sessions
             for account_id in validators:
                 search_index = self.add_search_index(
@@ -30,7 +30,7 @@ from sqlalchemy import text, func
 
 from app import settings
 from app.models.data import Block, BlockTotal
-from app.models.harvester import Setting, Status
+from app.models.harvester import Setting, Status, BackfillUnit
 from app.resources.base import BaseResource
 from app.schemas import load_schema
 from app.processors.converters import PolkascanHarvesterService, BlockAlreadyAdded, BlockIntegrityError
@@ -337,14 +337,24 @@ class StartIntegrityResource(BaseResource):
 
 class RebuildSearchIndexResource(BaseResource):
 
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+
+        resp.media = {
+            'status': 'success',
+            'data': BackfillUnit.get_progress(self.session, BackfillUnit.JOB_SEARCH_INDEX)
+        }
+
     def on_post(self, req, resp):
+        resume = bool(req.get_param_as_bool('resume'))
+
         if settings.CELERY_RUNNING:
-            task = rebuild_search_index.delay()
+            task = rebuild_search_index.delay(resume=resume)
             data = {
                 'task_id': task.id
             }
         else:
-            data = rebuild_search_index()
+            data = rebuild_search_index(resume=resume)
 
         resp.status = falcon.HTTP_201
 
@@ -51,9 +51,55 @@ FINALIZATION_BY_BLOCK_CONFIRMATIONS = int(os.environ.get("FINALIZATION_BY_BLOCK_
 FINALIZATION_ONLY = int(os.environ.get("FINALIZATION_ONLY", 0))
 MAXIMUM_THREAD = int(os.environ.get("MAXIMUM_THREAD", 3))
 
+# Gaps are backfilled in units of BACKFILL_UNIT_SIZE blocks, leased by at most BACKFILL_WORKERS tasks at a time
+BACKFILL_UNIT_SIZE = int(os.environ.get("BACKFILL_UNIT_SIZE", 500))
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", MAXIMUM_THREAD))
+BACKFILL_UNITS_PER_TASK = int(os.environ.get("BACKFILL_UNITS_PER_TASK", 10))
+BACKFILL_LEASE_SECONDS = int(os.environ.get("BACKFILL_LEASE_SECONDS", 300))
+BACKFILL_MAX_ATTEMPTS = int(os.environ.get("BACKFILL_MAX_ATTEMPTS", 3))
+# Failed units are retried after BACKFILL_RETRY_SECONDS, doubled for every attempt up to BACKFILL_RETRY_MAX_SECONDS
+BACKFILL_RETRY_SECONDS = int(os.environ.get("BACKFILL_RETRY_SECONDS", 60))
+BACKFILL_RETRY_MAX_SECONDS = int(os.environ.get("BACKFILL_RETRY_MAX_SECONDS", 3600))
+
+# The search index is rebuilt in units of SEARCH_INDEX_UNIT_SIZE blocks by at most SEARCH_INDEX_WORKERS tasks, which
+# read and write SEARCH_INDEX_CHUNK_SIZE blocks at a time
+SEARCH_INDEX_UNIT_SIZE = int(os.environ.get("SEARCH_INDEX_UNIT_SIZE", 10000))
+SEARCH_INDEX_WORKERS = int(os.environ.get("SEARCH_INDEX_WORKERS", MAXIMUM_THREAD))
+SEARCH_INDEX_CHUNK_SIZE = int(os.environ.get("SEARCH_INDEX_CHUNK_SIZE", 500))
+
+# Number of upcoming blocks retrieved ahead of the accumulator and the number of threads fetching them
+PREFETCH_WINDOW = int(os.environ.get("PREFETCH_WINDOW", 30))
+PREFETCH_THREADS = int(os.environ.get("PREFETCH_THREADS", 4))
+# Number of processes decoding blocks for a backfill worker, which then only processes and stores them; 0 decodes in
+# the worker itself. Decoding runs at most PREFETCH_WINDOW blocks ahead
+DECODER_PROCESSES = int(os.environ.get("DECODER_PROCESSES", 0))
+# Number of blocks retrieved per JSON-RPC batch request
+RPC_BATCH_SIZE = int(os.environ.get("RPC_BATCH_SIZE", 10))
+# Number of storage keys retrieved per state_queryStorageAt request
+STORAGE_QUERY_BATCH_SIZE = int(os.environ.get("STORAGE_QUERY_BATCH_SIZE", 500))
+# Number of threads retrieving storage values for a full balance snapshot
+SNAPSHOT_THREADS = int(os.environ.get("SNAPSHOT_THREADS", 4))
+# Size in bits of the bloom filter of stored block hashes each worker process keeps to skip the "block already added"
+# query (2^27 bits is 16 MB, enough for tens of millions of blocks). Disabled by default: every worker process holds
+# its own filter, and blocks stored by other workers (at the chain head, or in gaps by backfill workers) are only seen
+# after a refresh, every KNOWN_BLOCK_HASHES_REFRESH_SECONDS; meant for setups with one or a few accumulating workers
+KNOWN_BLOCK_HASHES_BITS = int(os.environ.get("KNOWN_BLOCK_HASHES_BITS", 0))
+KNOWN_BLOCK_HASHES_REFRESH_SECONDS = int(os.environ.get("KNOWN_BLOCK_HASHES_REFRESH_SECONDS", 10))
+
+# Directory where runtime metadata is cached per spec version, shared by all workers on the host. Use a separate
+# directory per chain; set to an empty value to disable
+METADATA_CACHE_DIR = os.environ.get("METADATA_CACHE_DIR", "/tmp/polkascan-metadata")
+# Number of spec versions of which resolved storage functions are kept in memory
+STORAGE_DESCRIPTOR_CACHE_SIZE = int(os.environ.get("STORAGE_DESCRIPTOR_CACHE_SIZE", 5))
+
 DEBUG = bool(os.environ.get("DEBUG", False))
+# Print the number of bytes received from the database per accumulated block; costs two extra queries per block
+PROFILE_DB_BYTES = bool(os.environ.get("PROFILE_DB_BYTES", False))
 
 BALANCE_FULL_SNAPSHOT_INTERVAL = 10000
+
+# Number of blocks sequenced per transaction
+SEQUENCER_WINDOW = int(os.environ.get("SEQUENCER_WINDOW", 100))
 CELERY_RUNNING = True
 
 
@@ -19,23 +19,25 @@
 #  tasks.py
 
 import os
+import socket
 import traceback
 
 import celery
 from celery.result import AsyncResult
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from app import settings
+from app.extend.decoder import BlockDecoderPool
+from app.extend.prefetch import BlockPrefetcher
 from app.models.data import Block, Account, AccountInfoSnapshot, SearchIndex, SymbolSnapshot, Extrinsic, \
-    BlockTotal, Event
-from app.models.harvester import Status
+    BlockTotal, Event, BlockRange
+from app.models.harvester import Status, BackfillUnit
 from app.processors.converters import PolkascanHarvesterService, HarvesterCouldNotAddBlock, BlockAlreadyAdded
 from app.processors.events.treasury.burnt import TreasuryBurnt
-from app.settings import DB_CONNECTION, DEBUG, TYPE_REGISTRY, FINALIZATION_ONLY, TYPE_REGISTRY_FILE, \
-    MAXIMUM_THREAD
+from app.settings import DB_CONNECTION, DEBUG, FINALIZATION_ONLY
 
 CELERY_BROKER = os.environ.get('CELERY_BROKER')
 CELERY_BACKEND = os.environ.get('CELERY_BACKEND')
@@ -55,33 +57,103 @@ app.conf.beat_schedule = {
 app.conf.timezone = 'UTC'
 
 
+class WorkerResources(object):
+    """
+    DB engine, session registry and harvester service (with its node connection) shared by all task invocations of a
+    worker process. They are created on first use, so after the worker process is forked.
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.scoped_session = None
+        self.harvester = None
+        self.decoder_pool = None
+        self.reconnects = 0
+
+    def get_scoped_session(self):
+        if self.scoped_session is None:
+            # Stale DB connections are detected and replaced by the pool with pool_pre_ping
+            self.engine = create_engine(
+                DB_CONNECTION, echo=DEBUG, isolation_level="READ_UNCOMMITTED", pool_pre_ping=True
+            )
+            session_factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
+            self.scoped_session = scoped_session(session_factory)
+
+        return self.scoped_session
+
+    def get_decoder_pool(self):
+        if self.decoder_pool is None and settings.DECODER_PROCESSES:
+            self.decoder_pool = BlockDecoderPool(
+                max_workers=settings.DECODER_PROCESSES,
+                type_registry=settings.TYPE_REGISTRY,
+                type_registry_file=settings.TYPE_REGISTRY_FILE
+            )
+
+        return self.decoder_pool
+
+    def get_harvester(self, session):
+        if self.harvester is None:
+            self.harvester = self.create_harvester(session)
+        elif not self.check_node_connection():
+            self.reconnect(session)
+        else:
+            self.harvester.set_db_session(session)
+
+        return self.harvester
+
+    def create_harvester(self, session):
+        return PolkascanHarvesterService(
+            db_session=session,
+            type_registry=settings.TYPE_REGISTRY,
+            type_registry_file=settings.TYPE_REGISTRY_FILE
+        )
+
+    def check_node_connection(self):
+        try:
+            self.harvester.substrate.rpc_request('system_health', [])
+            return True
+        except Exception as e:
+            print('! Node connection check failed: {}'.format(e))
+            return False
+
+    def reconnect(self, session):
+        self.reconnects += 1
+        print('! Reconnecting to node, {} reconnects by worker {}'.format(self.reconnects, os.getpid()))
+
+        try:
+            self.harvester.substrate.close()
+        except Exception:
+            pass
+
+        self.harvester = self.create_harvester(session)
+
+        # Keep track of reconnects of all workers
+        status = Status.get_status(session, 'NODE_RECONNECTS')
+        status.value = str(int(status.value or 0) + 1)
+        status.last_modified = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        status.save(session)
+        session.commit()
+
+
+worker_resources = WorkerResources()
+
+
 class BaseTask(celery.Task):
 
     def __init__(self):
         self.metadata_store = {}
 
     def __call__(self, *args, **kwargs):
-        self.engine = create_engine(DB_CONNECTION, echo=DEBUG, isolation_level="READ_UNCOMMITTED", pool_pre_ping=True)
-        session_factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
-        self.scoped_session = scoped_session(session_factory)
+        self.scoped_session = worker_resources.get_scoped_session()
         self.session = self.scoped_session()
-        self.harvester = PolkascanHarvesterService(
-            db_session=self.session,
-            type_registry=settings.TYPE_REGISTRY,
-            type_registry_file=settings.TYPE_REGISTRY_FILE
-        )
+        self.harvester = worker_resources.get_harvester(self.session)
 
         return super().__call__(*args, **kwargs)
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
-
+        # Engine and node connection are kept for the next task, only the session is released
         if hasattr(self, 'scoped_session'):
             self.scoped_session.remove()
-            self.session.close()
-        if hasattr(self, 'engine'):
-            self.engine.engine.dispose()
-        if hasattr(self, 'harvester'):
-            self.harvester.substrate.close()
 
 
 @app.task(base=BaseTask, bind=True)
@@ -114,6 +186,8 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
     max_sequenced_block_id = False
 
     add_count = 0
+    prefetcher = None
+    prefetch_from_block_id = None
 
     try:
         for nr in range(0, BLOCKS_LIMIT): # LIMIT = 100
@@ -124,8 +198,12 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
                 else:
                     print('Kami-Debug 0504-1306', block.id, block_hash)
 
+                block_data = None
+                if prefetcher:
+                    block_data = prefetcher.get(block.id - 1, block_hash)
+
                 # Process block
-                block = harvester.add_block(block_hash)
+                block = harvester.add_block(block_hash, block_data=block_data)
 
                 print('+ Block Added {} number {}'.format(block_hash, block.id))
 
@@ -140,6 +218,24 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
                 # Continue with parent block hash
                 block_hash = block.parent_hash
 
+                if not prefetcher and prefetch_from_block_id is None:
+                    # Numbers of the remaining blocks are known now; the walk stops at the first stored block, so
+                    # only retrieve them ahead when that is further away than the prefetch window
+                    prefetch_from_block_id = (self.session.query(func.max(Block.id)).filter(
+                        Block.id < block.id
+                    ).scalar() or -1) + 1
+
+                    if block.id - prefetch_from_block_id > settings.PREFETCH_WINDOW:
+                        prefetcher = BlockPrefetcher(
+                            url=settings.SUBSTRATE_RPC_URL,
+                            block_ids=range(
+                                block.id - 1, max(block.id - BLOCKS_LIMIT, prefetch_from_block_id - 1), -1
+                            ),
+                            window=settings.PREFETCH_WINDOW,
+                            max_workers=settings.PREFETCH_THREADS,
+                            batch_size=settings.RPC_BATCH_SIZE
+                        )
+
         # Update persistent metadata store in Celery task
         self.metadata_store = harvester.metadata_store
 
@@ -152,15 +248,163 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
     except IntegrityError as e:
         # attrs = vars(e.__traceback__)
         print('. KAMI DEBUG - Skipped duplicate {} '.format(block_hash))
+        # Stored by another worker since the known block hashes were refreshed
+        self.session.rollback()
+        harvester.add_known_block_hash(block_hash)
         # print(', '.join("%s: %s" % item for item in attrs.items()))
     except Exception as exc:
         print('! ERROR adding {}, {}'.format(block_hash, exc.__traceback__))
         raise HarvesterCouldNotAddBlock(block_hash) from exc
+    finally:
+        if prefetcher:
+            # Don't hold up the task for blocks that were fetched ahead but are not needed anymore
+            prefetcher.close(wait=False)
 
     return {
         'result': '{} blocks added'.format(add_count),
         'lastAddedBlockHash': block_hash,
-        'sequencerStartedFrom': max_sequenced_block_id
+        'sequencerStartedFrom': max_sequenced_block_id,
+        'decoderClassCache': self.harvester.substrate.runtime_config.get_decoder_class_cache_info()
+    }
+
+
+def accumulate_backfill_unit(task, unit):
+    harvester = task.harvester
+
+    block_ids = range(unit.block_to, unit.block_from - 1, -1)
+
+    prefetcher = BlockPrefetcher(
+        url=settings.SUBSTRATE_RPC_URL,
+        block_ids=block_ids,
+        window=settings.PREFETCH_WINDOW,
+        max_workers=settings.PREFETCH_THREADS,
+        batch_size=settings.RPC_BATCH_SIZE
+    )
+
+    def get_blocks():
+        for block_id in block_ids:
+            block_data = prefetcher.get(block_id)
+
+            if block_data:
+                block_hash = block_data['hash']
+            else:
+                block_hash = harvester.substrate.get_block_hash(block_id)
+
+            yield block_id, block_hash, block_data
+
+    blocks = ((block_hash, block_data, None) for block_id, block_hash, block_data in get_blocks())
+
+    decoder_pool = worker_resources.get_decoder_pool()
+
+    if decoder_pool:
+        # Blocks are decoded by the pool ahead of this process, which only processes and stores them
+        blocks = decoder_pool.decode_blocks(
+            (
+                (block_hash, block_data, harvester.runtime_index.get_spec_version(max(block_id - 1, 0)))
+                for block_id, block_hash, block_data in get_blocks()
+            ),
+            window=settings.PREFETCH_WINDOW
+        )
+
+    add_count = 0
+
+    try:
+        for idx, (block_hash, block_data, block_records) in enumerate(blocks):
+            try:
+                harvester.add_block(block_hash, block_data=block_data, block_records=block_records)
+                add_count += 1
+            except BlockAlreadyAdded:
+                pass
+            except IntegrityError:
+                # Block added concurrently by another task
+                task.session.rollback()
+                harvester.add_known_block_hash(block_hash)
+
+            if idx % 10 == 9:
+                unit.renew(task.session, settings.BACKFILL_LEASE_SECONDS)
+
+            task.session.commit()
+    finally:
+        prefetcher.close()
+
+    return add_count
+
+
+def start_backfill_tasks(session):
+    """
+    Queues backfill tasks up to BACKFILL_WORKERS, counting the tasks that lease a unit as well as the tasks that are
+    queued but not started yet. The latter are counted in the BACKFILL_TASKS_QUEUED status, which is reset when none
+    of the queued tasks started within BACKFILL_LEASE_SECONDS, in case they got lost
+    """
+    queued_tasks = Status.get_locked_status(session, 'BACKFILL_TASKS_QUEUED')
+    queued_count = int(queued_tasks.value or 0)
+
+    if queued_count and queued_tasks.last_modified < datetime.now() - timedelta(
+            seconds=settings.BACKFILL_LEASE_SECONDS):
+        print('! {} queued backfill tasks did not start, counting them as lost'.format(queued_count))
+        queued_count = 0
+
+    task_count = max(settings.BACKFILL_WORKERS - BackfillUnit.count_leased(session) - queued_count, 0)
+
+    if task_count or queued_count != int(queued_tasks.value or 0):
+        queued_tasks.value = queued_count + task_count
+        queued_tasks.last_modified = datetime.now()
+        queued_tasks.save(session)
+
+    # The count is committed before queueing, so starting tasks find their place in it
+    session.commit()
+
+    for i in range(task_count):
+        process_backfill_units.delay()
+
+
+@app.task(base=BaseTask, bind=True)
+def process_backfill_units(self, max_units=None):
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    units_processed = 0
+    add_count = 0
+
+    queued_tasks = Status.get_locked_status(self.session, 'BACKFILL_TASKS_QUEUED')
+    if int(queued_tasks.value or 0) > 0:
+        queued_tasks.value = int(queued_tasks.value) - 1
+        queued_tasks.last_modified = datetime.now()
+        queued_tasks.save(self.session)
+    self.session.commit()
+
+    while units_processed < (max_units or settings.BACKFILL_UNITS_PER_TASK):
+        unit = BackfillUnit.lease(
+            self.session, worker, settings.BACKFILL_LEASE_SECONDS, settings.BACKFILL_MAX_ATTEMPTS,
+            settings.BACKFILL_RETRY_SECONDS, settings.BACKFILL_RETRY_MAX_SECONDS
+        )
+
+        if not unit:
+            break
+
+        print('+ Backfill unit {}: blocks {}-{}'.format(unit.id, unit.block_from, unit.block_to))
+
+        try:
+            add_count += accumulate_backfill_unit(self, unit)
+            unit.finish(self.session)
+        except Exception as exc:
+            print('! ERROR in backfill unit {}: {}'.format(unit.id, exc))
+            self.session.rollback()
+            unit.fail(self.session, str(exc), settings.BACKFILL_RETRY_SECONDS, settings.BACKFILL_RETRY_MAX_SECONDS)
+
+        self.session.commit()
+
+        # At most max_units per task, so the worker slot is released in between; start_harvester queues new tasks
+        units_processed += 1
+
+    decoder_class_cache_info = self.harvester.substrate.runtime_config.get_decoder_class_cache_info()
+
+    if units_processed:
+        print('. Decoder class cache: {hits} hits, {misses} misses, {classes} classes of spec versions '
+              '{spec_versions}'.format(**decoder_class_cache_info))
+
+    return {
+        'result': '{} blocks added'.format(add_count),
+        'units': units_processed,
+        'decoderClassCache': decoder_class_cache_info
     }
 
 
@@ -222,15 +466,15 @@ def start_sequencer(self):
 
 @app.task(base=BaseTask, bind=True)
 def rebuilding_search_index(self, search_index_id=None, truncate=False):
+    if is_search_index_rebuild_running(self):
+        return get_search_index_rebuild_running_result(self)
+
     if truncate:
         # Clear search index table
         self.session.execute('delete from analytics_search_index where index_type_id={}'.format(search_index_id))
         self.session.commit()
 
-    harvester = self.harvester
-    harvester.rebuild_search_index()
-
-    return {'result': 'index rebuilt'}
+    return schedule_search_index_rebuild(self)
 
 
 @app.task(base=BaseTask, bind=True)
@@ -241,34 +485,26 @@ def start_harvester(self, check_gaps=True):
     block_sets = []
     if check_gaps:
         # Check for gaps between already harvested blocks and try to fill them first
+        BlockRange.compact(self.session)
+        self.session.commit()
+
         remaining_sets_result = Block.get_missing_block_ids(self.session)
         remaining_sets_result = remaining_sets_result.mappings().all()
         print("query remaining sets:{}".format(remaining_sets_result))
         for block_set in remaining_sets_result:
-            end = int(block_set['block_from'])
-            start = int(block_set['block_to'])
-            parallel = 1
-            if len(remaining_sets_result) == 1 and start - end > BLOCKS_LIMIT * 10:
-                parallel = MAXIMUM_THREAD
-            for i in range(parallel):
-                end = start - BLOCKS_LIMIT
-                end = 0 if end < 0 else end
-                # Get start and end block hash
-
-                print("Get hash from blocknum: start, end", start, end)
-
-                end_block_hash = substrate.get_block_hash(end)
-                start_block_hash = substrate.get_block_hash(start)
-                # Start processing task
-                print('KAMI-DEBUG: 0504-1048: ', start_block_hash, end_block_hash)
-                accumulate_block_recursive.delay(start_block_hash, end_block_hash)
-                block_sets.append({
-                    'start': start,
-                    'end': end,
-                    'start_block_hash': start_block_hash,
-                    'end_block_hash': end_block_hash
-                })
-                start = end + 1
+            block_from = int(block_set['block_from'])
+            block_to = int(block_set['block_to'])
+
+            block_sets.append({
+                'start': block_to,
+                'end': block_from,
+                'units': BackfillUnit.schedule(self.session, block_from, block_to, settings.BACKFILL_UNIT_SIZE)
+            })
+
+        self.session.commit()
+
+        # Start backfill tasks up to the maximum number of concurrently leased units
+        start_backfill_tasks(self.session)
 
     # Start sequencer
     sequencer_task = start_sequencer.delay()
@@ -303,16 +539,105 @@ def start_generate_analytics(self):
     return {'status': 'OK'}
 
 
+def is_search_index_rebuild_running(task):
+    # Units are only replaced while no worker holds a lease, a worker would keep writing index rows of its unit
+    return BackfillUnit.count_leased(task.session, job=BackfillUnit.JOB_SEARCH_INDEX) > 0
+
+
+def get_search_index_rebuild_running_result(task):
+    return {
+        'result': 'Search index rebuild is running, resume it or wait until it finished',
+        'progress': BackfillUnit.get_progress(task.session, BackfillUnit.JOB_SEARCH_INDEX)
+    }
+
+
+def schedule_search_index_rebuild(task):
+    # Lock the units of a previous rebuild, workers skip locked units so none can be leased while checking
+    BackfillUnit.query(task.session).filter_by(job=BackfillUnit.JOB_SEARCH_INDEX).with_for_update().all()
+
+    if is_search_index_rebuild_running(task):
+        task.session.rollback()
+        return get_search_index_rebuild_running_result(task)
+
+    # Replace any previous rebuild by units covering all harvested blocks; the units are removed before truncating,
+    # which commits implicitly
+    BackfillUnit.query(task.session).filter_by(job=BackfillUnit.JOB_SEARCH_INDEX).delete()
+    task.session.commit()
+    task.session.execute('truncate table {}'.format(SearchIndex.__tablename__))
+
+    block_to = task.session.query(func.max(Block.id)).scalar()
+
+    units = 0
+    if block_to is not None:
+        units = BackfillUnit.schedule(
+            task.session, 0, block_to, settings.SEARCH_INDEX_UNIT_SIZE, job=BackfillUnit.JOB_SEARCH_INDEX
+        )
+
+    task.session.commit()
+
+    return start_search_index_workers(task, units)
+
+
+def start_search_index_workers(task, units=0):
+    if settings.CELERY_RUNNING:
+        for i in range(settings.SEARCH_INDEX_WORKERS - BackfillUnit.count_leased(
+                task.session, job=BackfillUnit.JOB_SEARCH_INDEX)):
+            process_search_index_units.delay()
+    else:
+        process_search_index_units()
+
+    return {
+        'result': 'Search index rebuild started',
+        'units': units,
+        'progress': BackfillUnit.get_progress(task.session, BackfillUnit.JOB_SEARCH_INDEX)
+    }
+
+
 @app.task(base=BaseTask, bind=True)
-def rebuild_search_index(self):
-    harvester = PolkascanHarvesterService(
-        db_session=self.session,
-        type_registry=TYPE_REGISTRY,
-        type_registry_file=TYPE_REGISTRY_FILE
-    )
-    harvester.rebuild_search_index()
+def rebuild_search_index(self, resume=False):
+    if resume:
+        # Continue with the pending units and the units of which the lease expired
+        return start_search_index_workers(self)
+
+    return schedule_search_index_rebuild(self)
+
+
+@app.task(base=BaseTask, bind=True)
+def process_search_index_units(self):
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    block_count = 0
+
+    while True:
+        unit = BackfillUnit.lease(
+            self.session, worker, settings.BACKFILL_LEASE_SECONDS, settings.BACKFILL_MAX_ATTEMPTS,
+            settings.BACKFILL_RETRY_SECONDS, settings.BACKFILL_RETRY_MAX_SECONDS, job=BackfillUnit.JOB_SEARCH_INDEX
+        )
+
+        if not unit:
+            break
+
+        print('+ Search index unit {}: blocks {}-{}'.format(unit.id, unit.block_from, unit.block_to))
+
+        try:
+            for chunk_from in range(unit.block_from, unit.block_to + 1, settings.SEARCH_INDEX_CHUNK_SIZE):
+                chunk_to = min(chunk_from + settings.SEARCH_INDEX_CHUNK_SIZE - 1, unit.block_to)
+                block_count += self.harvester.rebuild_search_index(chunk_from, chunk_to)
+
+                unit.renew(self.session, settings.BACKFILL_LEASE_SECONDS)
+                self.session.commit()
+
+            unit.finish(self.session)
+        except Exception as exc:
+            print('! ERROR in search index unit {}: {}'.format(unit.id, exc))
+            self.session.rollback()
+            unit.fail(self.session, str(exc), settings.BACKFILL_RETRY_SECONDS, settings.BACKFILL_RETRY_MAX_SECONDS)
+
+        self.session.commit()
 
-    return {'result': 'search index rebuilt'}
+    return {
+        'result': 'Search index rebuilt for {} blocks'.format(block_count),
+        'progress': BackfillUnit.get_progress(self.session, BackfillUnit.JOB_SEARCH_INDEX)
+    }
 
 
 @app.task(base=BaseTask, bind=True)
@@ -337,33 +662,7 @@ def rebuild_account_info_snapshot(self):
             self.session.commit()
 
     # set balances according to most recent snapshot
-    account_info = self.session.execute("""
-            select
-               a.account_id, 
-               a.balance_total,
-               a.balance_free,
-               a.balance_reserved,
-               a.nonce
-        from
-             data_account_info_snapshot as a
-        inner join (
-            select 
-                account_id, max(block_id) as max_block_id 
-            from data_account_info_snapshot 
-            group by account_id
-        ) as b
-        on a.account_id = b.account_id and a.block_id = b.max_block_id
-        """)
-
-    for account_id, balance_total, balance_free, balance_reserved, nonce in account_info:
-        Account.query(self.session).filter_by(id=account_id).update(
-            {
-                Account.balance_total: balance_total,
-                Account.balance_free: balance_free,
-                Account.balance_reserved: balance_reserved,
-                Account.nonce: nonce,
-            }, synchronize_session='fetch'
-        )
+    harvester.update_account_balances(full=True)
     self.session.commit()
 
     return {'result': 'account info snapshots rebuilt'}
@@ -390,9 +689,8 @@ def balance_snapshot(self, account_id=None, block_start=1, block_end=None, block
         block_range = range(block_start, block_end + 1)
 
     for block_id in block_range:
-        for account in accounts:
-            harvester.create_balance_snapshot(block_id, account)
-            self.session.commit()
+        harvester.create_balance_snapshots(block_id, accounts)
+        self.session.commit()
 
     return {
         'message': 'Snapshop created',
@@ -17,4 +17,5 @@
 #  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
 #
 #  __init__.py
-from .storage import query_storage, query_storage_by_db, query_all_storage
+from .storage import query_storage, query_storage_by_db, query_all_storage, query_multi_storage, \
+    get_storage_keys_paged
@@ -1,13 +1,119 @@
+from collections import OrderedDict
+
 from scalecodec.types import GenericMetadataVersioned, GenericPalletMetadata, GenericStorageEntryMetadata
 from scalecodec.base import ScaleBytes, RuntimeConfiguration
 from substrateinterface import SubstrateInterface
 from substrateinterface.exceptions import SubstrateRequestException
+from substrateinterface.utils.hasher import blake2_256, blake2_128, blake2_128_concat, xxh128, two_x64_concat, \
+    identity
 
+from app import settings
+from app.extend.rpc import query_storage_values
 from app.models.data import RuntimeStorage
 
+STORAGE_HASHERS = {
+    'Blake2_256': blake2_256,
+    'Blake2_128': blake2_128,
+    'Blake2_128Concat': blake2_128_concat,
+    'Twox128': xxh128,
+    'Twox64Concat': two_x64_concat,
+    'Identity': identity,
+}
 
-def query(substrate: SubstrateInterface, pallet_name: str, storage_name: str, param_types: list, param_hashers: list,
-          params: list, value_type: str, block_hash):
+
+class StorageDescriptor(object):
+    """
+    Storage function metadata resolved for one spec version: parameter types and hashers, the storage key prefix
+    and the decoder class of the value, so queries only have to encode and hash their parameters
+    """
+
+    def __init__(self, substrate: SubstrateInterface, module: GenericPalletMetadata,
+                 storage_func: GenericStorageEntryMetadata):
+        self.pallet_prefix = module.value['storage']['prefix']
+        self.storage_name = storage_func.value['name']
+        self.param_types = storage_func.get_params_type_string()
+        self.param_hashers = storage_func.get_param_hashers()
+        self.value_type = storage_func.get_value_type_string()
+        self.storage_key_prefix = '0x{}{}'.format(
+            xxh128(self.pallet_prefix.encode()), xxh128(self.storage_name.encode())
+        )
+        self.value_decoder_class = substrate.runtime_config.get_decoder_class(self.value_type)
+
+        if self.value_decoder_class is None:
+            raise NotImplementedError('Decoder class for "{}" not found'.format(self.value_type))
+
+        self.default_value = None
+        if storage_func.value['modifier'] == 'Default':
+            self.default_value = storage_func.value_object['default'].value_object
+
+    def create_storage_key(self, substrate: SubstrateInterface, params: list):
+        storage_key = self.storage_key_prefix
+
+        for idx, param in enumerate(params):
+            if type(param) is bytes:
+                param = f'0x{param.hex()}'
+            param_obj = substrate.runtime_config.create_scale_object(type_string=self.param_types[idx])
+            param_data = param_obj.encode(param).data
+
+            try:
+                param_hasher = self.param_hashers[idx] or 'Twox128'
+            except IndexError:
+                raise ValueError(f'No hasher found for param #{idx + 1}')
+
+            if param_hasher not in STORAGE_HASHERS:
+                raise ValueError('Unknown storage hasher "{}"'.format(param_hasher))
+
+            storage_key += STORAGE_HASHERS[param_hasher](bytes(param_data))
+
+        return storage_key
+
+    def decode_value(self, storage_value, **kwargs):
+        scale_obj = self.value_decoder_class(data=ScaleBytes(storage_value), **kwargs)
+        scale_obj.decode()
+        return scale_obj
+
+
+# Resolved storage functions per spec version, of the spec versions used most recently
+storage_descriptors = OrderedDict()
+
+
+def get_storage_descriptor(substrate: SubstrateInterface, pallet_name: str, storage_name: str,
+                           block_hash=None, block_id=None) -> StorageDescriptor:
+    """
+    Returns the StorageDescriptor of a storage function in the current runtime of `substrate`, or in the runtime of
+    given block when no runtime is initialized. Descriptors are cached by the spec version of the resolved metadata,
+    so the metadata of a block is only retrieved when its spec version wasn't seen before. When the block number is
+    given its spec version is looked up in the runtime version index, without a request to the node.
+    """
+    if substrate.metadata_decoder is None:
+        spec_version = substrate.get_block_spec_version(block_hash, block_id=block_id)
+    else:
+        spec_version = substrate.runtime_version
+
+    spec_version_descriptors = storage_descriptors.get(spec_version)
+
+    if spec_version_descriptors is None:
+        spec_version_descriptors = storage_descriptors[spec_version] = {}
+
+        while len(storage_descriptors) > settings.STORAGE_DESCRIPTOR_CACHE_SIZE:
+            storage_descriptors.popitem(last=False)
+    else:
+        storage_descriptors.move_to_end(spec_version)
+
+    storage_descriptor = spec_version_descriptors.get((pallet_name, storage_name))
+
+    if storage_descriptor is None:
+        metadata: GenericMetadataVersioned = substrate.metadata_decoder or substrate.get_block_metadata(block_hash)
+        module: GenericPalletMetadata = metadata.get_metadata_pallet(pallet_name)
+        storage_descriptor = spec_version_descriptors[(pallet_name, storage_name)] = StorageDescriptor(
+            substrate, module, module.get_storage_function(storage_name)
+        )
+
+    return storage_descriptor
+
+
+def create_storage_key(substrate: SubstrateInterface, pallet_name: str, storage_name: str, param_types: list,
+                       param_hashers: list, params: list):
     # Encode parameters
     for idx, param in enumerate(params):
         # param = substrate.convert_storage_parameter(param_types[idx], param)
@@ -16,12 +122,17 @@ def query(substrate: SubstrateInterface, pallet_name: str, storage_name: str, pa
         param_obj = substrate.runtime_config.create_scale_object(type_string=param_types[idx])
         params[idx] = param_obj.encode(param)
 
-    storage_hash = substrate.generate_storage_hash(
+    return substrate.generate_storage_hash(
         storage_module=pallet_name,
         storage_function=storage_name,
         params=params,
         hashers=param_hashers
     )
+
+
+def query(substrate: SubstrateInterface, pallet_name: str, storage_name: str, param_types: list, param_hashers: list,
+          params: list, value_type: str, block_hash):
+    storage_hash = create_storage_key(substrate, pallet_name, storage_name, param_types, param_hashers, params)
     query_value = substrate.get_storage_by_key(block_hash, storage_hash)
     if query_value is None:
         return None
@@ -32,23 +143,75 @@ def query(substrate: SubstrateInterface, pallet_name: str, storage_name: str, pa
 
 
 def query_storage(pallet_name: str, storage_name: str, substrate: SubstrateInterface, block_hash,
-                  params: list = None):
+                  params: list = None, block_id=None):
     if params is None:
         params = []
 
-    if substrate.metadata_decoder is None:
-        metadata: GenericMetadataVersioned = substrate.get_block_metadata(block_hash)
-    else:
-        metadata: GenericMetadataVersioned = substrate.metadata_decoder
+    storage_descriptor = get_storage_descriptor(
+        substrate, pallet_name, storage_name, block_hash=block_hash, block_id=block_id
+    )
 
-    module: GenericPalletMetadata = metadata.get_metadata_pallet(pallet_name)
-    storage_func: GenericStorageEntryMetadata = module.get_storage_function(storage_name)
-    param_types = storage_func.get_params_type_string()
-    value_type = storage_func.get_value_type_string()
+    query_value = substrate.get_storage_by_key(block_hash, storage_descriptor.create_storage_key(substrate, params))
+    if query_value is None:
+        return None
+    return storage_descriptor.decode_value(query_value)
 
-    return query(substrate=substrate, pallet_name=module.value['storage']['prefix'], storage_name=storage_name, param_types=param_types,
-                 param_hashers=storage_func.get_param_hashers(), params=params, value_type=value_type,
-                 block_hash=block_hash)
+
+def query_multi_storage(pallet_name: str, storage_name: str, substrate: SubstrateInterface, block_hash,
+                        params_list: list, batch_size: int = 500, use_default: bool = True) -> list:
+    """
+    Retrieves the values of one storage function for a list of parameter lists, with one `state_queryStorageAt` call
+    per `batch_size` storage keys instead of one request per key. Returns the decoded values in order of
+    `params_list`; keys without a stored value get the default value of the storage function, or None when it has
+    no default or `use_default` is disabled (as `query_storage` does).
+    """
+    substrate.init_runtime(block_hash=block_hash)
+
+    storage_descriptor = get_storage_descriptor(substrate, pallet_name, storage_name)
+
+    storage_keys = [storage_descriptor.create_storage_key(substrate, params) for params in params_list]
+
+    def query_storage_at(batch_storage_keys):
+        response = substrate.rpc_request(method="state_queryStorageAt", params=[batch_storage_keys, block_hash])
+        if 'error' in response:
+            raise SubstrateRequestException(response['error']['message'])
+        return response['result']
+
+    storage_values = query_storage_values(
+        query_storage_at, storage_keys, batch_size,
+        default_value=storage_descriptor.default_value if use_default else None
+    )
+
+    return [
+        None if storage_value is None else storage_descriptor.decode_value(
+            storage_value, metadata=substrate.metadata_decoder
+        ) for storage_value in storage_values
+    ]
+
+
+def get_storage_keys_paged(substrate: SubstrateInterface, storage_key_prefix: str, block_hash, page_size: int = 1000):
+    """
+    Walks all storage keys with given prefix using `state_getKeysPaged`, so the node never has to return the whole
+    key set at once. Yields the keys one page at a time.
+    """
+    start_key = None
+
+    while True:
+        response = substrate.rpc_request(
+            method="state_getKeysPaged", params=[storage_key_prefix, page_size, start_key, block_hash]
+        )
+        if 'error' in response:
+            raise SubstrateRequestException(response['error']['message'])
+
+        storage_keys = response['result']
+
+        if storage_keys:
+            yield storage_keys
+
+        if len(storage_keys) < page_size:
+            break
+
+        start_key = storage_keys[-1]
 
 
 def query_storage_by_db(storage_obj: RuntimeStorage, substrate: SubstrateInterface, block_hash, params: list = None):
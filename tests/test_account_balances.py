@@ -0,0 +1,104 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_account_balances.py
+
+import pytest
+
+from app.models.data import Account, AccountInfoSnapshot, AccountBalanceChange
+
+
+@pytest.fixture
+def session(db_session):
+    for model_class in (Account, AccountInfoSnapshot, AccountBalanceChange):
+        model_class.__table__.create(db_session.get_bind())
+
+    for account_id in ('a' * 64, 'b' * 64):
+        Account(id=account_id, created_at_block=1, updated_at_block=1).save(db_session)
+
+    return db_session
+
+
+def add_snapshot(session, block_id, account_id, balance):
+    # AccountInfoSnapshot.upsert is a MySQL upsert, snapshots are inserted and marked as it does
+    session.execute(AccountInfoSnapshot.__table__.insert().values(
+        block_id=block_id, account_id=account_id, balance_total=balance, balance_free=balance, balance_reserved=0,
+        nonce=block_id
+    ))
+    AccountBalanceChange.add(session, [account_id])
+
+
+def get_balances(session):
+    return {
+        account.id[0]: (int(account.balance_total), account.nonce)
+        for account in session.query(Account) if account.balance_total is not None
+    }
+
+
+def test_update_balances_from_latest_snapshot(session):
+    add_snapshot(session, 10, 'a' * 64, 100)
+    add_snapshot(session, 20, 'a' * 64, 200)
+    add_snapshot(session, 15, 'b' * 64, 150)
+
+    Account.update_balances(session)
+
+    assert get_balances(session) == {'a': (200, 20), 'b': (150, 15)}
+    assert session.query(AccountBalanceChange).count() == 0
+
+
+def test_update_balances_applies_snapshot_stored_out_of_order(session):
+    add_snapshot(session, 20, 'a' * 64, 200)
+    Account.update_balances(session)
+
+    # A backfill worker stores a snapshot below the highest snapshot after the previous run
+    add_snapshot(session, 10, 'b' * 64, 100)
+    Account.update_balances(session)
+
+    assert get_balances(session) == {'a': (200, 20), 'b': (100, 10)}
+
+
+def test_update_balances_keeps_latest_snapshot_of_account(session):
+    add_snapshot(session, 20, 'a' * 64, 200)
+    Account.update_balances(session)
+
+    add_snapshot(session, 10, 'a' * 64, 100)
+    Account.update_balances(session)
+
+    assert get_balances(session) == {'a': (200, 20)}
+
+
+def test_update_balances_in_chunks(session):
+    add_snapshot(session, 10, 'a' * 64, 100)
+    add_snapshot(session, 10, 'b' * 64, 150)
+
+    Account.update_balances(session, chunk_size=1)
+
+    assert get_balances(session) == {'a': (100, 10), 'b': (150, 10)}
+    assert session.query(AccountBalanceChange).count() == 0
+
+
+def test_full_update_balances(session):
+    session.execute(AccountInfoSnapshot.__table__.insert().values(
+        block_id=10, account_id='a' * 64, balance_total=100, nonce=10
+    ))
+
+    Account.update_balances(session)
+    assert get_balances(session) == {}
+
+    Account.update_balances(session, full=True)
+    assert get_balances(session) == {'a': (100, 10)}
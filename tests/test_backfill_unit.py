@@ -0,0 +1,154 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_backfill_unit.py
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models.harvester import BackfillUnit
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+RETRY_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+
+
+@pytest.fixture
+def session(db_session):
+    BackfillUnit.__table__.create(db_session.get_bind())
+    return db_session
+
+
+def lease(session, job=BackfillUnit.JOB_ACCUMULATE):
+    return BackfillUnit.lease(
+        session, 'worker', LEASE_SECONDS, MAX_ATTEMPTS, RETRY_SECONDS, RETRY_MAX_SECONDS, job=job
+    )
+
+
+def get_units(session):
+    return session.query(BackfillUnit.block_from, BackfillUnit.block_to, BackfillUnit.status).order_by(
+        BackfillUnit.block_from
+    ).all()
+
+
+def test_schedule_skips_covered_ranges(session):
+    assert BackfillUnit.schedule(session, 0, 9, 5) == 2
+    assert BackfillUnit.schedule(session, 5, 14, 5) == 1
+
+    assert get_units(session) == [(0, 4, 'pending'), (5, 9, 'pending'), (10, 14, 'pending')]
+
+
+def test_lease_highest_unit_first(session):
+    BackfillUnit.schedule(session, 0, 9, 5)
+
+    unit = lease(session)
+
+    assert (unit.block_from, unit.status, unit.attempts, unit.worker) == (5, 'leased', 1, 'worker')
+    assert unit.lease_expires > datetime.now()
+    assert lease(session).block_from == 0
+    assert lease(session) is None
+
+
+def test_lease_of_other_job_is_separate(session):
+    BackfillUnit.schedule(session, 0, 9, 10, job=BackfillUnit.JOB_SEARCH_INDEX)
+
+    assert lease(session) is None
+    assert lease(session, job=BackfillUnit.JOB_SEARCH_INDEX).block_from == 0
+
+
+def test_expired_lease_is_leased_again(session):
+    BackfillUnit.schedule(session, 0, 9, 10)
+    unit = lease(session)
+
+    assert lease(session) is None
+
+    unit.lease_expires = datetime.now() - timedelta(seconds=1)
+    unit.save(session)
+
+    assert lease(session).attempts == 2
+
+
+def test_renew_extends_lease(session):
+    BackfillUnit.schedule(session, 0, 9, 10)
+    unit = lease(session)
+    unit.lease_expires = datetime.now() + timedelta(seconds=1)
+
+    unit.renew(session, LEASE_SECONDS)
+
+    assert unit.lease_expires > datetime.now() + timedelta(seconds=LEASE_SECONDS - 10)
+    assert unit.heartbeat <= datetime.now()
+
+
+def test_fail_sets_retry_with_backoff(session):
+    BackfillUnit.schedule(session, 0, 9, 10)
+    unit = lease(session)
+
+    unit.fail(session, 'Connection lost', RETRY_SECONDS, RETRY_MAX_SECONDS)
+
+    assert (unit.status, unit.error, unit.lease_expires) == ('failed', 'Connection lost', None)
+    assert unit.retry_at - unit.failed_at == timedelta(seconds=RETRY_SECONDS)
+    assert lease(session) is None
+
+    # Leased again once the backoff passed, the backoff doubles with every attempt up to the maximum
+    unit.retry_at = datetime.now() - timedelta(seconds=1)
+    unit.save(session)
+    unit = lease(session)
+    assert (unit.status, unit.attempts) == ('leased', 2)
+
+    unit.fail(session, 'Connection lost', RETRY_SECONDS, RETRY_MAX_SECONDS)
+    assert unit.retry_at - unit.failed_at == timedelta(seconds=2 * RETRY_SECONDS)
+
+    unit.attempts = 10
+    unit.fail(session, 'Connection lost', RETRY_SECONDS, RETRY_MAX_SECONDS)
+    assert unit.retry_at - unit.failed_at == timedelta(seconds=RETRY_MAX_SECONDS)
+
+
+def test_unit_fails_after_max_expired_leases(session):
+    BackfillUnit.schedule(session, 0, 9, 10)
+    unit = lease(session)
+
+    unit.attempts = MAX_ATTEMPTS
+    unit.lease_expires = datetime.now() - timedelta(seconds=1)
+    unit.save(session)
+
+    assert lease(session) is None
+
+    session.refresh(unit)
+    assert unit.status == 'failed'
+    assert unit.error == 'Lease expired after {} attempts'.format(MAX_ATTEMPTS)
+    assert unit.failed_at is not None
+    assert unit.retry_at > unit.failed_at
+
+
+def test_finished_accumulate_unit_is_deleted(session):
+    BackfillUnit.schedule(session, 0, 9, 5)
+
+    lease(session).finish(session)
+
+    assert get_units(session) == [(0, 4, 'pending')]
+
+
+def test_finished_search_index_unit_is_kept(session):
+    BackfillUnit.schedule(session, 0, 9, 10, job=BackfillUnit.JOB_SEARCH_INDEX)
+
+    lease(session, job=BackfillUnit.JOB_SEARCH_INDEX).finish(session)
+
+    assert get_units(session) == [(0, 9, 'done')]
+    assert BackfillUnit.get_progress(session, BackfillUnit.JOB_SEARCH_INDEX) == {'done': {'units': 1, 'blocks': 10}}
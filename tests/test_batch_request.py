@@ -0,0 +1,69 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_batch_request.py
+
+from app.extend.rpc import create_batch_payload, get_batch_responses
+
+
+def test_create_batch_payload():
+    assert create_batch_payload(5, [('chain_getBlockHash', [1]), ('chain_getBlock', ['0x01'])]) == [
+        {"jsonrpc": "2.0", "method": "chain_getBlockHash", "params": [1], "id": 5},
+        {"jsonrpc": "2.0", "method": "chain_getBlock", "params": ['0x01'], "id": 6}
+    ]
+
+
+def test_create_batch_payload_without_calls():
+    assert create_batch_payload(1, []) == []
+
+
+def test_batch_responses_in_order_of_requests():
+    payload = create_batch_payload(1, [('chain_getBlockHash', [1]), ('chain_getBlockHash', [2])])
+    messages = [{'jsonrpc': '2.0', 'id': 2, 'result': '0x02'}, {'jsonrpc': '2.0', 'id': 1, 'result': '0x01'}]
+
+    assert get_batch_responses(payload, messages) == [('0x01', None), ('0x02', None)]
+
+
+def test_batch_responses_keep_errors_per_request():
+    payload = create_batch_payload(1, [('chain_getBlock', ['0x01']), ('state_getStorageAt', ['0x26aa', '0x01'])])
+    error = {'code': -32000, 'message': 'State discarded'}
+    messages = [
+        {'jsonrpc': '2.0', 'id': 1, 'result': {'block': {}}},
+        {'jsonrpc': '2.0', 'id': 2, 'error': error}
+    ]
+
+    assert get_batch_responses(payload, messages) == [({'block': {}}, None), (None, error)]
+
+
+def test_batch_responses_missing_response():
+    payload = create_batch_payload(1, [('chain_getBlockHash', [1]), ('chain_getBlockHash', [2])])
+
+    responses = get_batch_responses(payload, [{'jsonrpc': '2.0', 'id': 1, 'result': '0x01'}])
+
+    assert responses[0] == ('0x01', None)
+    assert responses[1][0] is None
+    assert 'chain_getBlockHash' in responses[1][1]
+
+
+def test_batch_responses_rejected_batch():
+    payload = create_batch_payload(1, [('chain_getBlockHash', [1]), ('chain_getBlockHash', [2])])
+    error = {'code': -32700, 'message': 'Parse error'}
+
+    assert get_batch_responses(payload, {'jsonrpc': '2.0', 'id': None, 'error': error}) == [
+        (None, error), (None, error)
+    ]
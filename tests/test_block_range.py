@@ -0,0 +1,83 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_block_range.py
+
+import pytest
+
+from app.models.data import Block, BlockRange
+
+
+@pytest.fixture
+def session(db_session):
+    BlockRange.__table__.create(db_session.get_bind())
+    return db_session
+
+
+def get_block_ranges(session):
+    return session.query(BlockRange.block_from, BlockRange.block_to).order_by(BlockRange.block_from).all()
+
+
+def get_missing_block_ids(session):
+    return [
+        (block_set['block_from'], block_set['block_to'])
+        for block_set in Block.get_missing_block_ids(session).mappings()
+    ]
+
+
+def test_add_block_id_extends_adjacent_ranges(session):
+    for block_id in [10, 9, 8, 11, 20]:
+        BlockRange.add_block_id(session, block_id)
+
+    assert get_block_ranges(session) == [(8, 11), (20, 20)]
+
+
+def test_remove_block_id_splits_range(session):
+    BlockRange(block_from=0, block_to=10).save(session)
+
+    BlockRange.remove_block_id(session, 5)
+    BlockRange.remove_block_id(session, 0)
+
+    assert get_block_ranges(session) == [(1, 4), (6, 10)]
+
+
+def test_compact_merges_adjacent_and_overlapping_ranges(session):
+    for block_from, block_to in [(5, 9), (10, 12), (11, 20), (15, 16), (30, 40), (42, 50), (51, 51)]:
+        BlockRange(block_from=block_from, block_to=block_to).save(session)
+
+    BlockRange.compact(session)
+
+    assert get_block_ranges(session) == [(5, 20), (30, 40), (42, 51)]
+
+
+def test_get_merge_groups():
+    assert BlockRange.get_merge_groups([(1, 0, 4), (2, 6, 8), (3, 9, 9), (4, 20, 30), (5, 25, 26)]) == [[2, 3], [4, 5]]
+    assert BlockRange.get_merge_groups([(1, 0, 4), (2, 6, 8)]) == []
+
+
+def test_missing_block_ids_include_gap_below_lowest_block(session):
+    for block_from, block_to in [(5, 20), (30, 40), (42, 51)]:
+        BlockRange(block_from=block_from, block_to=block_to).save(session)
+
+    assert get_missing_block_ids(session) == [(41, 41), (21, 29), (0, 4)]
+
+
+def test_no_missing_block_ids_from_genesis(session):
+    BlockRange(block_from=0, block_to=20).save(session)
+
+    assert get_missing_block_ids(session) == []
@@ -0,0 +1,78 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_decoder_class_cache.py
+
+from app.extend.cache import DecoderClassCache
+
+
+class DecoderClassFactory(object):
+    """
+    Creates a new class per call, like generating a decoder class from a scale-info type definition
+    """
+
+    def __init__(self):
+        self.created = []
+
+    def create(self, spec_version, type_string):
+        def create_decoder_class():
+            self.created.append((spec_version, type_string))
+            return type('{}_{}'.format(type_string, spec_version), (object,), {})
+        return create_decoder_class
+
+
+def get_decoder_classes(cache, factory, spec_version, type_strings):
+    return [
+        cache.get(spec_version, type_string, factory.create(spec_version, type_string)) for type_string in type_strings
+    ]
+
+
+def test_switching_spec_versions_reuses_classes():
+    cache = DecoderClassCache(5)
+    factory = DecoderClassFactory()
+    type_strings = ['scale_info::1', 'scale_info::2', 'scale_info::3']
+
+    classes_100 = get_decoder_classes(cache, factory, 100, type_strings)
+    classes_101 = get_decoder_classes(cache, factory, 101, type_strings)
+
+    # Switching back and forth between runtimes, e.g. when blocks around an upgrade are harvested
+    assert get_decoder_classes(cache, factory, 100, type_strings) == classes_100
+    assert get_decoder_classes(cache, factory, 101, type_strings) == classes_101
+
+    assert len(factory.created) == 6
+    assert classes_100[0] is not classes_101[0]
+    assert cache.get_info() == {'hits': 6, 'misses': 6, 'spec_versions': [100, 101], 'classes': 6}
+
+
+def test_least_recently_used_spec_version_is_evicted():
+    cache = DecoderClassCache(2)
+    factory = DecoderClassFactory()
+
+    get_decoder_classes(cache, factory, 100, ['scale_info::1'])
+    get_decoder_classes(cache, factory, 101, ['scale_info::1'])
+    # Using 100 again makes 101 the least recently used one
+    get_decoder_classes(cache, factory, 100, ['scale_info::1'])
+    get_decoder_classes(cache, factory, 102, ['scale_info::1'])
+
+    assert cache.get_info()['spec_versions'] == [100, 102]
+
+    get_decoder_classes(cache, factory, 101, ['scale_info::1'])
+
+    assert factory.created == [
+        (100, 'scale_info::1'), (101, 'scale_info::1'), (102, 'scale_info::1'), (101, 'scale_info::1')
+    ]
@@ -0,0 +1,101 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_decoder_pool.py
+
+import pytest
+from scalecodec.exceptions import RemainingScaleBytesNotEmptyException
+
+from app.extend.pool import OrderedDecoderPool
+
+
+class FakeResult(object):
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def get(self):
+        return self.function(*self.args)
+
+
+class FakePool(object):
+    """
+    Runs the function when its result is read, so errors are raised by `get` like for a pool result
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def apply_async(self, function, args):
+        self.submitted.append(args[0])
+        return FakeResult(function, args)
+
+
+def decode_block_data(block_hash, block_data, spec_version):
+    if block_data == 'invalid':
+        raise RemainingScaleBytesNotEmptyException()
+    if block_data == 'unsupported':
+        raise NotImplementedError()
+    if block_data == 'disconnected':
+        raise ConnectionError()
+    return {'hash': block_hash, 'spec_version': spec_version}
+
+
+def test_blocks_are_yielded_in_order():
+    pool = OrderedDecoderPool(FakePool(), decode_block_data)
+    blocks = [('0x{}'.format(block_id), 'data', 1) for block_id in range(5)]
+
+    assert [
+        (block_hash, block_records) for block_hash, block_data, block_records in pool.decode_blocks(blocks, window=2)
+    ] == [('0x{}'.format(block_id), {'hash': '0x{}'.format(block_id), 'spec_version': 1}) for block_id in range(5)]
+
+
+def test_blocks_are_submitted_within_window():
+    fake_pool = FakePool()
+    pool = OrderedDecoderPool(fake_pool, decode_block_data)
+    blocks = [('0x{}'.format(block_id), 'data', 1) for block_id in range(5)]
+
+    for block_hash, block_data, block_records in pool.decode_blocks(blocks, window=2):
+        # The yielded block and the next one are submitted, the rest is not read from blocks yet
+        assert len(fake_pool.submitted) <= fake_pool.submitted.index(block_hash) + 2
+
+
+def test_decoding_errors_leave_decoding_to_consumer():
+    pool = OrderedDecoderPool(FakePool(), decode_block_data)
+    blocks = [('0x0', 'data', 1), ('0x1', 'invalid', 1), ('0x2', 'unsupported', 1), ('0x3', None, 1)]
+
+    results = list(pool.decode_blocks(blocks, window=2))
+
+    assert [block_hash for block_hash, block_data, block_records in results] == ['0x0', '0x1', '0x2', '0x3']
+    assert results[0][2] == {'hash': '0x0', 'spec_version': 1}
+    # Raw block data is passed on for the consumer to decode
+    assert results[1] == ('0x1', 'invalid', None)
+    assert results[2] == ('0x2', 'unsupported', None)
+    assert results[3] == ('0x3', None, None)
+
+
+def test_other_errors_are_raised():
+    pool = OrderedDecoderPool(FakePool(), decode_block_data)
+    blocks = [('0x0', 'data', 1), ('0x1', 'disconnected', 1)]
+
+    results = pool.decode_blocks(blocks, window=2)
+
+    assert next(results)[2] == {'hash': '0x0', 'spec_version': 1}
+    with pytest.raises(ConnectionError):
+        next(results)
@@ -0,0 +1,157 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_known_block_hashes.py
+
+import hashlib
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from app.extend.cache import KnownBlockHashes, get_range_intersections, get_range_differences
+
+BlockBase = declarative_base()
+
+
+class FakeBlock(BlockBase):
+    __tablename__ = 'fake_block'
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    hash = sa.Column(sa.String(66), unique=True, nullable=False)
+
+
+class FakeBlockRange(BlockBase):
+    __tablename__ = 'fake_block_range'
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=True)
+    block_from = sa.Column(sa.Integer(), nullable=False)
+    block_to = sa.Column(sa.Integer(), nullable=False)
+
+
+def get_block_hash(block_id):
+    return '0x{}'.format(hashlib.blake2b(str(block_id).encode(), digest_size=32).hexdigest())
+
+
+@pytest.fixture
+def session(db_session):
+    BlockBase.metadata.create_all(db_session.get_bind())
+    return db_session
+
+
+def add_blocks(session, block_ids):
+    block_ids = list(block_ids)
+    for block_id in block_ids:
+        session.add(FakeBlock(id=block_id, hash=get_block_hash(block_id)))
+    if block_ids:
+        # Ranges aren't compacted, like when several workers store blocks
+        session.add(FakeBlockRange(block_from=min(block_ids), block_to=max(block_ids)))
+    session.commit()
+
+
+def test_added_blocks_are_contained():
+    known_block_hashes = KnownBlockHashes(2 ** 16)
+
+    for block_id in range(100):
+        known_block_hashes.add(block_id, get_block_hash(block_id))
+
+    for block_id in range(100):
+        assert known_block_hashes.might_contain(get_block_hash(block_id))
+        assert known_block_hashes.might_contain(get_block_hash(block_id), block_id)
+
+
+def test_unknown_blocks_are_mostly_ruled_out():
+    known_block_hashes = KnownBlockHashes(2 ** 16)
+
+    for block_id in range(100):
+        known_block_hashes.add(block_id, get_block_hash(block_id))
+
+    false_positives = sum(
+        known_block_hashes.might_contain(get_block_hash(block_id)) for block_id in range(1000, 2000)
+    )
+    assert false_positives < 10
+
+    # Checking the block number rules out the hash of an unknown block
+    assert not known_block_hashes.might_contain(get_block_hash(0), 1000)
+
+
+def test_load_and_refresh(session):
+    add_blocks(session, range(0, 50))
+
+    known_block_hashes = KnownBlockHashes.load(session, FakeBlock, 2 ** 16, chunk_size=7)
+
+    assert list(known_block_hashes.block_ids) == list(range(0, 50))
+    assert known_block_hashes.refreshed_at is not None
+    assert not known_block_hashes.might_contain(get_block_hash(60), 60)
+
+    # Blocks stored by another worker are only seen after a refresh
+    add_blocks(session, range(50, 70))
+    known_block_hashes.refresh(session, FakeBlock)
+
+    assert list(known_block_hashes.block_ids) == list(range(0, 70))
+    assert known_block_hashes.might_contain(get_block_hash(60), 60)
+
+
+def test_refresh_adds_blocks_stored_in_gaps(session):
+    add_blocks(session, range(10, 20))
+    add_blocks(session, range(40, 50))
+
+    known_block_hashes = KnownBlockHashes.load(session, FakeBlock, 2 ** 16, block_range_class=FakeBlockRange)
+
+    assert known_block_hashes.missing_ranges == [(0, 9), (20, 39)]
+
+    # Backfilled below the highest loaded block, and a new gap at the head
+    add_blocks(session, range(25, 30))
+    add_blocks(session, range(0, 5))
+    add_blocks(session, range(55, 60))
+    known_block_hashes.add(26, get_block_hash(26))
+    known_block_hashes.refresh(session, FakeBlock, block_range_class=FakeBlockRange)
+
+    stored_block_ids = list(range(0, 5)) + list(range(10, 20)) + list(range(25, 30)) + list(range(40, 50)) + \
+        list(range(55, 60))
+    assert list(known_block_hashes.block_ids) == stored_block_ids
+    assert known_block_hashes.added_block_ids == set()
+    assert known_block_hashes.missing_ranges == [(5, 9), (20, 24), (30, 39), (50, 54)]
+
+    for block_id in stored_block_ids:
+        assert known_block_hashes.might_contain(get_block_hash(block_id), block_id)
+    assert not known_block_hashes.might_contain(get_block_hash(35), 35)
+
+    # Without the ranges only the chain head is refreshed
+    add_blocks(session, range(30, 35))
+    known_block_hashes.refresh(session, FakeBlock)
+
+    assert not known_block_hashes.might_contain(get_block_hash(30), 30)
+
+
+def test_range_intersections():
+    ranges = [(0, 9), (20, 39), (50, 54)]
+
+    assert get_range_intersections(ranges, []) == []
+    assert get_range_intersections(ranges, [(0, 100)]) == ranges
+    assert get_range_intersections(ranges, [(5, 25), (22, 30), (45, 60)]) == [(5, 9), (20, 30), (50, 54)]
+    assert get_range_intersections(ranges, [(10, 19), (40, 49)]) == []
+
+
+def test_range_differences():
+    ranges = [(0, 9), (20, 39), (50, 54)]
+
+    assert get_range_differences(ranges, []) == ranges
+    assert get_range_differences(ranges, ranges) == []
+    assert get_range_differences(ranges, [(5, 9), (25, 29), (33, 33), (50, 54)]) == \
+        [(0, 4), (20, 24), (30, 32), (34, 39)]
@@ -0,0 +1,83 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_runtime_version_index.py
+
+import pytest
+import sqlalchemy as sa
+
+from app.extend.runtime import RuntimeVersionIndex
+from app.models.data import Block, RuntimeVersionRange
+
+
+@pytest.fixture
+def session(db_session, monkeypatch):
+    Block.__table__.create(db_session.get_bind())
+    RuntimeVersionRange.__table__.create(db_session.get_bind())
+
+    # RuntimeVersionRange.extend is a MySQL upsert, the persisted ranges are kept in a list instead
+    db_session.info['extended_ranges'] = []
+    monkeypatch.setattr(
+        RuntimeVersionRange, 'extend',
+        classmethod(lambda cls, session, *args: session.info['extended_ranges'].append(args))
+    )
+
+    return db_session
+
+
+def add_blocks(session, block_ids, spec_version):
+    required_columns = [
+        column.name for column in Block.__table__.columns
+        if not column.nullable and column.default is None and column.server_default is None
+    ]
+
+    for block_id in block_ids:
+        values = {column: 0 for column in required_columns}
+        values.update(
+            id=block_id, parent_id=max(block_id - 1, 0), hash='0x{:064x}'.format(block_id),
+            parent_hash='0x{:064x}'.format(max(block_id - 1, 0)), state_root='0x', extrinsics_root='0x',
+            spec_version_id=spec_version
+        )
+        session.execute(sa.insert(Block.__table__).values(**values))
+
+
+def test_bootstrap_from_string_spec_versions(session):
+    # Block.spec_version_id is a string column
+    add_blocks(session, range(1, 11), '100')
+    add_blocks(session, range(11, 21), '101')
+
+    runtime_index = RuntimeVersionIndex(session, substrate=None)
+    runtime_index.load()
+
+    assert runtime_index.ranges == {100: [0, 9], 101: [10, 19]}
+    assert runtime_index.find(5) == 100
+    assert type(runtime_index.find(5)) is int
+    assert runtime_index.find(15) == 101
+    assert runtime_index.find(25) is None
+
+
+def test_add_extends_bootstrapped_range(session):
+    add_blocks(session, range(1, 11), '100')
+
+    runtime_index = RuntimeVersionIndex(session, substrate=None)
+    runtime_index.load()
+    runtime_index.add(100, 10, 12)
+
+    assert runtime_index.ranges == {100: [0, 12]}
+    assert runtime_index.sorted_ranges == [(0, 12, 100)]
+    assert session.info['extended_ranges'][-1] == (100, 10, 12)
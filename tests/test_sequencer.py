@@ -0,0 +1,209 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_sequencer.py
+
+import pytest
+
+from app.extend.sequencer import Sequencer, SequencerWindow, ChainNotAtGenesis
+from app.models.data import Block, BlockTotal, Event
+from app.models.harvester import Status
+
+
+class ProcessorError(Exception):
+    pass
+
+
+def create_model(model_class, **values):
+    # Required columns that don't matter to the sequencer are filled with zeros
+    for column in model_class.__table__.columns:
+        if not column.nullable and column.key not in values:
+            values[column.key] = 0
+    return model_class(**values)
+
+
+def add_blocks(session, block_ids):
+    for block_id in block_ids:
+        session.add(create_model(
+            Block, id=block_id, parent_id=max(block_id - 1, 0), hash='0x{:064x}'.format(block_id),
+            parent_hash='0x{:064x}'.format(max(block_id - 1, 0))
+        ))
+    session.commit()
+
+
+def add_block_totals(session, block_ids):
+    for block_id in block_ids:
+        session.add(create_model(BlockTotal, id=block_id, total_events=sum(range(block_id + 1))))
+    session.commit()
+
+
+class FakeHarvester(object):
+    """
+    Sequencing hooks that record their calls; each block also stores a Status row like processors store their rows
+    """
+
+    def __init__(self, session, fail_at=None):
+        self.session = session
+        self.fail_at = fail_at
+        self.calls = []
+
+    def sequence_block(self, block, parent_block_data, parent_sequenced_block_data, window=None):
+        self.calls.append({
+            'block_id': block.id,
+            'parent_block_id': parent_block_data['id'] if parent_block_data else None,
+            'parent_sequenced_block_id': parent_sequenced_block_data['id'] if parent_sequenced_block_data else None,
+            'window': sorted(window.block_ids),
+        })
+
+        Status(key='processed-{}'.format(block.id)).save(self.session)
+
+        if block.id == self.fail_at:
+            raise ProcessorError()
+
+        total_events = block.id + (parent_sequenced_block_data['total_events'] if parent_sequenced_block_data else 0)
+        sequenced_block = create_model(BlockTotal, id=block.id, total_events=total_events)
+        sequenced_block.save(self.session)
+        return sequenced_block
+
+    def get_genesis_block(self):
+        return Block.query(self.session).order_by('id').first()
+
+    def get_sequencer(self, window_size):
+        return Sequencer(self.session, self.sequence_block, self.get_genesis_block, window_size)
+
+
+@pytest.fixture
+def session(db_session):
+    for model_class in (Block, BlockTotal, Status) + tuple(model_class for model_class, _ in SequencerWindow.models):
+        model_class.__table__.create(db_session.get_bind())
+    return db_session
+
+
+def get_sequenced_block_ids(session):
+    return [block_id for block_id, in session.query(BlockTotal.id).order_by(BlockTotal.id)]
+
+
+def get_processed_block_ids(session):
+    return sorted(int(key.split('-')[1]) for key, in session.query(Status.key))
+
+
+def test_windows_end_at_integrity_head():
+    sequencer = Sequencer(None, None, None, window_size=4)
+
+    assert list(sequencer.get_windows(-1, 9)) == [(0, 3), (4, 7), (8, 9)]
+    assert list(sequencer.get_windows(-1, 7)) == [(0, 3), (4, 7)]
+    assert list(sequencer.get_windows(5, 6)) == [(6, 6)]
+    assert list(sequencer.get_windows(9, 9)) == []
+
+
+def test_blocks_are_sequenced_per_window(session):
+    add_blocks(session, range(10))
+    harvester = FakeHarvester(session)
+
+    assert harvester.get_sequencer(window_size=4).run(-1, 9) == 9
+
+    assert [call['window'] for call in harvester.calls] == [[0, 1, 2, 3]] * 4 + [[4, 5, 6, 7]] * 4 + [[8, 9]] * 2
+    assert [call['parent_sequenced_block_id'] for call in harvester.calls] == [None] + list(range(9))
+    assert get_sequenced_block_ids(session) == list(range(10))
+    # Totals are carried from block to block across windows
+    assert BlockTotal.query(session).get(9).total_events == sum(range(10))
+    assert 'write_buffer' not in session.info
+
+
+def test_sequencing_resumes_from_partially_sequenced_window(session):
+    add_blocks(session, range(10))
+    add_block_totals(session, range(6))
+    harvester = FakeHarvester(session)
+
+    # Head at block 5 is halfway a window of 4 blocks, the first window covers the blocks after it
+    assert harvester.get_sequencer(window_size=4).run(5, 9) == 9
+
+    assert [call['block_id'] for call in harvester.calls] == [6, 7, 8, 9]
+    assert [call['window'] for call in harvester.calls] == [[6, 7, 8, 9]] * 4
+    assert harvester.calls[0]['parent_block_id'] == 5
+    assert harvester.calls[0]['parent_sequenced_block_id'] == 5
+    assert BlockTotal.query(session).get(9).total_events == sum(range(10))
+
+
+def test_sequencing_stops_at_missing_block(session):
+    add_blocks(session, [0, 1, 2, 3, 4, 5, 7, 8])
+    harvester = FakeHarvester(session)
+
+    assert harvester.get_sequencer(window_size=4).run(-1, 8) == 5
+
+    assert get_sequenced_block_ids(session) == [0, 1, 2, 3, 4, 5]
+    # Blocks of the window before the missing block are committed
+    session.rollback()
+    assert get_sequenced_block_ids(session) == [0, 1, 2, 3, 4, 5]
+
+
+def test_nothing_to_sequence(session):
+    add_blocks(session, range(4))
+    add_block_totals(session, range(4))
+    harvester = FakeHarvester(session)
+
+    assert harvester.get_sequencer(window_size=4).run(3, 3) is None
+    assert harvester.calls == []
+
+
+def test_processor_error_rolls_back_window(session):
+    add_blocks(session, range(10))
+    harvester = FakeHarvester(session, fail_at=6)
+
+    with pytest.raises(ProcessorError):
+        harvester.get_sequencer(window_size=4).run(-1, 9)
+
+    # Only the window before the failing one is committed, including the rows stored by its processors
+    assert get_sequenced_block_ids(session) == [0, 1, 2, 3]
+    assert get_processed_block_ids(session) == [0, 1, 2, 3]
+    assert 'write_buffer' not in session.info
+
+    # Next run sequences the failed window again from the start
+    harvester = FakeHarvester(session)
+    assert harvester.get_sequencer(window_size=4).run(3, 9) == 9
+
+    assert harvester.calls[0]['block_id'] == 4
+    assert get_sequenced_block_ids(session) == list(range(10))
+    assert get_processed_block_ids(session) == list(range(10))
+
+
+def test_chain_not_at_genesis(session):
+    add_blocks(session, range(5, 10))
+    harvester = FakeHarvester(session)
+
+    with pytest.raises(ChainNotAtGenesis):
+        harvester.get_sequencer(window_size=4).run(-1, 9)
+
+    assert harvester.calls == []
+    assert get_sequenced_block_ids(session) == []
+
+
+def test_window_groups_rows_by_block(session):
+    for block_id, event_idx in ((2, 1), (2, 0), (3, 0), (6, 0)):
+        session.add(create_model(Event, block_id=block_id, event_idx=event_idx))
+    session.commit()
+
+    window = SequencerWindow.load(session, [2, 3, 4])
+
+    assert [event.event_idx for event in window.get(Event, 2)] == [0, 1]
+    assert [event.block_id for event in window.get(Event, 3)] == [3]
+    assert window.get(Event, 4) == []
+    assert window.contains(Event, 4)
+    # Rows of blocks outside the window are queried as usual
+    assert not window.contains(Event, 6)
+    assert not window.contains(Block, 2)
@@ -0,0 +1,101 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_storage.py
+
+from app.extend.rpc import query_storage_values, query_in_batches
+
+
+class FakeNode(object):
+    """
+    Answers `state_queryStorageAt` requests from a dict of stored values
+    """
+
+    def __init__(self, storage_values):
+        self.storage_values = storage_values
+        self.requests = []
+
+    def query_storage_at(self, storage_keys):
+        self.requests.append(storage_keys)
+        return [{'block': '0x01', 'changes': [
+            [storage_key, self.storage_values.get(storage_key)] for storage_key in storage_keys
+        ]}]
+
+
+def test_keys_are_queried_in_batches():
+    node = FakeNode({'0x01': '0xaa', '0x03': '0xcc'})
+
+    assert query_storage_values(node.query_storage_at, ['0x01', '0x02', '0x03'], 2) == ['0xaa', None, '0xcc']
+    assert node.requests == [['0x01', '0x02'], ['0x03']]
+
+
+def test_keys_without_value_get_default():
+    node = FakeNode({'0x01': '0xaa'})
+
+    assert query_storage_values(node.query_storage_at, ['0x01', '0x02'], 500, default_value='0x00') == [
+        '0xaa', '0x00'
+    ]
+
+
+def test_keys_missing_from_response_get_default():
+    assert query_storage_values(lambda storage_keys: [], ['0x01'], 500, default_value='0x00') == ['0x00']
+
+
+def test_no_keys():
+    node = FakeNode({})
+
+    assert query_storage_values(node.query_storage_at, [], 500) == []
+    assert node.requests == []
+
+
+def query_squares(batch):
+    if 'invalid' in batch:
+        raise ValueError('Invalid item')
+    return [item * item for item in batch]
+
+
+def test_batches_are_queried_in_order():
+    batches = []
+
+    def query_batch(batch):
+        batches.append(batch)
+        return query_squares(batch)
+
+    assert query_in_batches(query_batch, [1, 2, 3, 4, 5], 2) == [1, 4, 9, 16, 25]
+    assert batches == [[1, 2], [3, 4], [5]]
+
+
+def test_failing_batch_is_queried_per_item():
+    errors = []
+
+    results = query_in_batches(
+        query_squares, [1, 2, 'invalid', 4, 5, 6], 3, on_error=lambda items, e: errors.append(items)
+    )
+
+    # Only the failing item gets None, the batch after it is not affected
+    assert results == [1, 4, None, 16, 25, 36]
+    assert errors == [[1, 2, 'invalid'], ['invalid']]
+
+
+def test_failing_single_item_batch_is_not_queried_again():
+    errors = []
+
+    assert query_in_batches(query_squares, ['invalid', 2], 1, on_error=lambda items, e: errors.append(items)) == [
+        None, 4
+    ]
+    assert errors == [['invalid']]
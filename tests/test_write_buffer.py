@@ -0,0 +1,93 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_write_buffer.py
+
+import pytest
+from sqlalchemy import text
+
+from app.models.base import WriteBuffer
+from app.models.data import Event, Log
+
+
+@pytest.fixture
+def session(db_session):
+    Event.__table__.create(db_session.get_bind())
+    Log.__table__.create(db_session.get_bind())
+    return db_session
+
+
+def create_event(event_idx, attributes=None):
+    return Event(
+        block_id=1, event_idx=event_idx, module_id='system', event_id='ExtrinsicSuccess', system=1, module=0,
+        phase=0, attributes=attributes
+    )
+
+
+def test_save_adds_accepted_models_to_buffer(session):
+    write_buffer = WriteBuffer((Event,))
+    session.info['write_buffer'] = write_buffer
+
+    event = create_event(0)
+    event.save(session)
+    # Saving the same object again doesn't insert it twice
+    event.save(session)
+
+    assert len(write_buffer) == 1
+    assert write_buffer.get(Event) == [event]
+    assert session.query(Event).count() == 0
+
+    write_buffer.flush(session)
+
+    assert len(write_buffer) == 0
+    assert session.query(Event).count() == 1
+
+
+def test_save_bypasses_buffer_for_other_models(session):
+    write_buffer = WriteBuffer((Event,))
+    session.info['write_buffer'] = write_buffer
+
+    Log(block_id=1, log_idx=0, type_id=0, type='Other', data={}).save(session)
+
+    assert len(write_buffer) == 0
+    assert session.query(Log).count() == 1
+
+
+def test_flush_executes_pending_deletes_first(session):
+    session.add(create_event(0))
+    session.commit()
+
+    # Delete and insert the same key again, as integrity_checks does for re-added blocks
+    session.delete(session.query(Event).one())
+
+    write_buffer = WriteBuffer((Event,))
+    write_buffer.add(create_event(0, attributes=[{'type': 'DispatchInfo'}]))
+    write_buffer.flush(session)
+    session.commit()
+
+    assert session.query(Event).one().attributes == [{'type': 'DispatchInfo'}]
+
+
+def test_flush_stores_unset_json_columns_as_sql_null(session):
+    write_buffer = WriteBuffer((Event,))
+    write_buffer.add(create_event(0))
+    write_buffer.add(create_event(1, attributes=[]))
+    write_buffer.flush(session)
+
+    assert session.execute(text('SELECT event_idx FROM data_event WHERE attributes IS NULL')).fetchall() == [(0,)]
+    assert session.query(Event).filter_by(event_idx=1).one().attributes == []